@@ -0,0 +1,128 @@
+import math
+import torch
+import torch.nn.functional as F
+
+
+def chunked_attention(query, key, value, query_chunk=1024, key_chunk=None):
+    # softmax(q kᵀ / √d) v over (batch, heads, length, head_dim) tensors, holding at most query_chunk × key_chunk
+    # scores per head at a time. Each query chunk goes to scaled_dot_product_attention with all keys, unless there
+    # are more than key_chunk keys: then it walks the key chunks with a running maximum and sum (the flash attention
+    # recurrence) in float32, which needs less memory but is several times slower than a fused kernel
+    scale = 1.0 / math.sqrt(query.shape[-1])
+    hidden_states = torch.empty_like(query)
+    for start in range(0, query.shape[2], query_chunk):
+        q = query[:, :, start:start + query_chunk]
+        if key_chunk is None or key.shape[2] <= key_chunk:
+            hidden_states[:, :, start:start + query_chunk] = F.scaled_dot_product_attention(q, key, value)
+            continue
+        q = q.float() * scale
+        maximum = total = accumulated = None
+        for key_start in range(0, key.shape[2], key_chunk):
+            scores = q @ key[:, :, key_start:key_start + key_chunk].float().transpose(-1, -2)
+            v = value[:, :, key_start:key_start + key_chunk].float()
+            chunk_maximum = scores.amax(dim=-1, keepdim=True)
+            if maximum is None:
+                maximum = chunk_maximum
+                weights = torch.exp(scores - maximum)
+                total = weights.sum(dim=-1, keepdim=True)
+                accumulated = weights @ v
+            else:
+                new_maximum = torch.maximum(maximum, chunk_maximum)
+                correction = torch.exp(maximum - new_maximum)
+                weights = torch.exp(scores - new_maximum)
+                total = total * correction + weights.sum(dim=-1, keepdim=True)
+                accumulated = accumulated * correction + weights @ v
+                maximum = new_maximum
+        hidden_states[:, :, start:start + query_chunk] = (accumulated / total).to(query.dtype)
+    return hidden_states
+
+
+def downsample_tokens(tokens, height, width, factor):
+    # (batch, height * width, channels) tokens of a feature map -> the tokens of the map shrunk by factor per side
+    # (nearest neighbour, as in ToDo: Token Downsampling for Efficient Generation of High-Resolution Images)
+    batch, length, channels = tokens.shape
+    x = tokens.transpose(1, 2).reshape(batch, channels, height, width)
+    x = F.interpolate(x, size=(max(1, round(height / factor)), max(1, round(width / factor))), mode='nearest-exact')
+    return x.flatten(2).transpose(1, 2)
+
+
+class ChunkedAttnProcessor:
+    # AttnProcessor2_0 with bounded memory for long sequences: once the (query length × key length) scores of a
+    # head exceed threshold², as in the self-attention of the highres pass and of the VAE mid-block, attention is
+    # computed in chunks by chunked_attention(), whichever kernel scaled_dot_product_attention would pick (the
+    # fused CPU kernels depend on the PyTorch version, dtype and head size). Shorter and masked attention goes to
+    # scaled_dot_product_attention as a whole; threshold None never chunks.
+    # While token_downsampling is set to (latent height, latent width, factor), self-attention at full latent
+    # resolution attends to keys and values downsampled by factor per side (queries and output keep every token).
+    def __init__(self, threshold=4096, query_chunk=1024, key_chunk=None):
+        self.threshold = threshold
+        self.query_chunk = query_chunk
+        self.key_chunk = key_chunk
+        self.token_downsampling = None
+
+    def self_attention_tokens(self, hidden_states):
+        if self.token_downsampling is None:
+            return hidden_states
+        height, width, factor = self.token_downsampling
+        if hidden_states.shape[1] != height * width:
+            return hidden_states  # a lower-resolution block
+        return downsample_tokens(hidden_states, height, width, factor)
+
+    def attention(self, query, key, value, attention_mask):
+        if attention_mask is not None or self.threshold is None or query.shape[2] * key.shape[2] <= self.threshold * self.threshold:
+            return F.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False)
+        return chunked_attention(query, key, value, self.query_chunk, self.key_chunk)
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None, *args, **kwargs):
+        # as AttnProcessor2_0.__call__ in diffusers 0.27, apart from the attention itself
+        residual = hidden_states
+        if attn.spatial_norm is not None:
+            hidden_states = attn.spatial_norm(hidden_states, temb)
+
+        input_ndim = hidden_states.ndim
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(batch_size, channel, height * width).transpose(1, 2)
+
+        batch_size, sequence_length, _ = hidden_states.shape if encoder_hidden_states is None else encoder_hidden_states.shape
+
+        if attention_mask is not None:
+            attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, batch_size)
+            attention_mask = attention_mask.view(batch_size, attn.heads, -1, attention_mask.shape[-1])
+
+        if attn.group_norm is not None:
+            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
+
+        query = attn.to_q(hidden_states)
+
+        if encoder_hidden_states is None:
+            encoder_hidden_states = self.self_attention_tokens(hidden_states)
+        elif attn.norm_cross:
+            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+
+        key = attn.to_k(encoder_hidden_states)
+        value = attn.to_v(encoder_hidden_states)
+
+        inner_dim = key.shape[-1]
+        head_dim = inner_dim // attn.heads
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        hidden_states = self.attention(query, key, value, attention_mask)
+
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+        hidden_states = hidden_states.to(query.dtype)
+
+        hidden_states = attn.to_out[0](hidden_states)
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
+
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+
+        hidden_states = hidden_states / attn.rescale_output_factor
+
+        return hidden_states
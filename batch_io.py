@@ -0,0 +1,267 @@
+import io
+import os
+import json
+import time
+import queue
+import tarfile
+import threading
+import numpy as np
+
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+
+
+_end_of_items = object()
+
+
+def prefetch(items, load_fn, depth):
+    # yields load_fn(item) for each item, decoding up to `depth` items ahead in a background thread
+    if depth <= 0:
+        for item in items:
+            yield load_fn(item)
+        return
+
+    loaded = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(value):
+        # blocks while the queue is full (backpressure), but gives up once the consumer has gone away
+        while not stop.is_set():
+            try:
+                loaded.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in items:
+                if not put((load_fn(item), None)):
+                    return
+        except BaseException as e:
+            put((None, e))
+            return
+        put((_end_of_items, None))
+
+    thread = threading.Thread(target=worker, name='prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            value, error = loaded.get()
+            if error is not None:
+                raise error
+            if value is _end_of_items:
+                return
+            yield value
+    finally:
+        stop.set()
+        thread.join()
+
+
+class AsyncWriter:
+    # runs write jobs on a thread pool; submit() blocks once `max_pending` jobs are in flight,
+    # so finished results cannot pile up in memory faster than they are encoded
+    def __init__(self, num_workers, max_pending=None):
+        self.executor = ThreadPoolExecutor(num_workers, thread_name_prefix='writer') if num_workers > 0 else None
+        self.slots = threading.BoundedSemaphore(max_pending or 2 * max(num_workers, 1))
+        self.futures = []
+
+    def submit(self, fn, *args, **kwargs):
+        if self.executor is None:
+            fn(*args, **kwargs)
+            return
+        self.raise_errors()
+        self.slots.acquire()
+        future = self.executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append(future)
+
+    def raise_errors(self):
+        pending = []
+        for future in self.futures:
+            if not future.done():
+                pending.append(future)
+            elif future.exception() is not None:
+                raise future.exception()
+        self.futures = pending
+
+    def close(self):
+        if self.executor is None:
+            return
+        self.executor.shutdown(wait=True)
+        self.raise_errors()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.executor is not None:
+            # finish what was submitted, but do not mask the original error with a writer error
+            self.executor.shutdown(wait=True)
+        return False
+
+
+def encode_array(array, output_format='png', png_compress_level=6):
+    # returns (bytes, extension)
+    buffer = io.BytesIO()
+    if output_format == 'npy':
+        np.save(buffer, array, allow_pickle=False)
+        return buffer.getvalue(), '.npy'
+    if array.dtype != np.uint8:
+        raise ValueError(f'{output_format} output needs uint8 images, got {array.dtype}; use output_format npy')
+    if output_format == 'png':
+        Image.fromarray(array).save(buffer, format='PNG', compress_level=png_compress_level)
+        return buffer.getvalue(), '.png'
+    if output_format == 'webp':
+        Image.fromarray(array).save(buffer, format='WEBP', lossless=True)
+        return buffer.getvalue(), '.webp'
+    raise ValueError(f'Unknown output format {output_format}')
+
+
+def sync(file):
+    # data written so far is on disk before the manifest records the item as done
+    file.flush()
+    os.fsync(file.fileno())
+
+
+def atomic_write(path, data):
+    # write to a temporary file next to path and rename it over path, so readers (and resumed runs)
+    # never see a half-written file
+    temp_path = f'{path}.tmp-{os.getpid()}-{threading.get_ident()}'
+    try:
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+            sync(file)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+class FileSink:
+    # one file per result in output_dir
+    def __init__(self, output_dir, **encode_kwargs):
+        self.output_dir = output_dir
+        self.encode_kwargs = encode_kwargs
+
+    def write(self, name, array):
+        data, extension = encode_array(array, **self.encode_kwargs)
+        path = os.path.join(self.output_dir, name + extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)  # names may be relative paths (a/1, b/1)
+        atomic_write(path, data)
+        return path
+
+    def close(self):
+        pass
+
+
+class TarSink:
+    # appends encoded results to uncompressed tar shards of at most shard_size members each
+    def __init__(self, output_dir, prefix='results', shard_size=1000, **encode_kwargs):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.encode_kwargs = encode_kwargs
+        self.lock = threading.Lock()
+        self.shard_index = 0
+        self.shard_count = 0
+        self.tar = None
+
+    def write(self, name, array):
+        data, extension = encode_array(array, **self.encode_kwargs)
+        info = tarfile.TarInfo(name + extension)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        with self.lock:
+            if self.tar is None or self.shard_count >= self.shard_size:
+                self.open_next_shard()
+            self.tar.addfile(info, io.BytesIO(data))
+            sync(self.tar.fileobj)
+            self.shard_count += 1
+            return f'{self.tar.name}:{info.name}'
+
+    def open_next_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.shard_index += 1
+        path = os.path.join(self.output_dir, f'{self.prefix}-{self.shard_index:05d}.tar')
+        while os.path.exists(path):  # never clobber the shards of an earlier run
+            self.shard_index += 1
+            path = os.path.join(self.output_dir, f'{self.prefix}-{self.shard_index:05d}.tar')
+        self.tar = tarfile.open(path, 'w')
+        self.shard_count = 0
+
+    def close(self):
+        with self.lock:
+            if self.tar is not None:
+                self.tar.close()
+                self.tar = None
+
+
+class MemmapSink:
+    # appends raw arrays to one .bin file and records name, offset, shape and dtype in a JSONL index,
+    # so any result can be read back with read_memmap_item() without decoding the others. As in RunManifest,
+    # a crash can at most leave a partial last index line, which readers skip and the next run does not extend.
+    def __init__(self, output_dir, prefix='results'):
+        self.data_path = os.path.join(output_dir, prefix + '.bin')
+        self.index_path = os.path.join(output_dir, prefix + '.index.jsonl')
+        self.lock = threading.Lock()
+        self.data = open(self.data_path, 'ab')
+        self.index = open(self.index_path, 'a')
+        if self.index.tell() > 0 and not ends_with_newline(self.index_path):
+            self.index.write('\n')  # do not glue the next entry onto a crashed run's partial line
+
+    def write(self, name, array):
+        array = np.ascontiguousarray(array)
+        with self.lock:
+            offset = self.data.tell()
+            self.data.write(array.tobytes())
+            sync(self.data)
+            entry = dict(name=name, offset=offset, shape=list(array.shape), dtype=array.dtype.str)
+            self.index.write(json.dumps(entry) + '\n')
+            sync(self.index)
+        return f'{self.data_path}:{offset}'
+
+    def close(self):
+        with self.lock:
+            self.data.close()
+            self.index.close()
+
+
+def ends_with_newline(path):
+    with open(path, 'rb') as file:
+        file.seek(-1, os.SEEK_END)
+        return file.read(1) == b'\n'
+
+
+def read_memmap_index(output_dir, prefix='results'):
+    entries = []
+    with open(os.path.join(output_dir, prefix + '.index.jsonl')) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue  # partially written last line of a crashed run
+    return entries
+
+
+def read_memmap_item(output_dir, entry, prefix='results'):
+    return np.memmap(os.path.join(output_dir, prefix + '.bin'), dtype=np.dtype(entry['dtype']), mode='r',
+                     offset=entry['offset'], shape=tuple(entry['shape']))
+
+
+def open_sink(output_dir, archive='none', output_format='png', png_compress_level=6, shard_size=1000, prefix='results'):
+    # prefix names the archive files; concurrent workers writing to one output_dir need distinct prefixes
+    encode_kwargs = dict(output_format=output_format, png_compress_level=png_compress_level)
+    if archive == 'none':
+        return FileSink(output_dir, **encode_kwargs)
+    if archive == 'tar':
+        return TarSink(output_dir, prefix=prefix, shard_size=shard_size, **encode_kwargs)
+    if archive == 'memmap':
+        return MemmapSink(output_dir, prefix=prefix)
+    raise ValueError(f'Unknown archive mode {archive}')
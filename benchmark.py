@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+import functools
+import numpy as np
+import torch
+
+import rmbg_onnx
+from briarmbg import BriaRMBG
+from matting import feed_size
+from image_utils import pytorch2numpy, numpy2pytorch, resize_and_center_crop, resize_without_crop, preprocess, upscale_decoded, make_gradient, gray_to_rgb, composite_alpha, estimate_normal
+
+
+# Micro-benchmarks for the CPU-side image utilities that run around the diffusion loop.
+# Every case has a budget in milliseconds per megapixel of output (times the number of samples it handles),
+# so a regression in any helper shows up as a failed case rather than as a slightly slower end-to-end run.
+
+BUDGETS_MS_PER_MPIX = {
+    'resize_and_center_crop': 150.0,
+    'resize_without_crop': 120.0,
+    'numpy2pytorch': 50.0,
+    'pytorch2numpy': 30.0,
+    'pytorch2numpy_float': 30.0,
+    'gradient': 30.0,
+    'composite_alpha': 40.0,
+    'estimate_normal': 400.0,
+    'preprocess_pil': 200.0,
+    'preprocess_pytorch': 200.0,
+    'upscale_decoded_pil': 150.0,
+    'upscale_decoded_pytorch': 150.0,
+    'rmbg_torch': 4000.0,
+    'rmbg_onnx': 4000.0,
+}
+
+# whole-model cases, only run when named in --cases; the budget is per megapixel of the BriaRMBG feed
+MODEL_CASES = {'rmbg_torch', 'rmbg_onnx'}
+
+# (PIL case, tensor-native case) pairs whose CPU time difference is reported as saved time
+COMPARISONS = [
+    ('preprocess_pil', 'preprocess_pytorch'),
+    ('upscale_decoded_pil', 'upscale_decoded_pytorch'),
+    ('rmbg_torch', 'rmbg_onnx'),
+]
+
+
+class Case:
+    def __init__(self, name, fn, megapixels, num_samples):
+        self.name = name
+        self.fn = fn
+        self.megapixels = megapixels
+        self.num_samples = num_samples
+
+    def budget_ms(self, budget_scale):
+        return BUDGETS_MS_PER_MPIX[self.name] * self.megapixels * self.num_samples * budget_scale
+
+
+def random_image(rng, width, height, channels=3):
+    return rng.integers(0, 256, size=(height, width, channels), dtype=np.uint8)
+
+
+@functools.lru_cache(maxsize=None)
+def rmbg_engines():
+    # randomly initialised BriaRMBG (latency does not depend on the weights) and its onnxruntime export
+    torch.manual_seed(0)
+    model = BriaRMBG().eval().optimize()
+    if rmbg_onnx.onnxruntime is None:
+        return model, None
+    path = os.path.join(tempfile.mkdtemp(), 'briarmbg.onnx')
+    rmbg_onnx.export(model, path)
+    return model, rmbg_onnx.OnnxRMBG(path)
+
+
+def build_cases(width, height, num_samples, rng, device):
+    # source portraits are typically larger than the generation size and of another aspect ratio
+    source = random_image(rng, int(width * 1.5), int(height * 1.25))
+    fg = random_image(rng, width, height)
+    samples = [random_image(rng, width, height) for _ in range(num_samples)]
+    highres_width = int(round(width * 1.5 / 64.0) * 64)
+    highres_height = int(round(height * 1.5 / 64.0) * 64)
+    pixels = torch.from_numpy(rng.uniform(-1, 1, size=(num_samples, 3, height, width)).astype(np.float32))
+    device_pixels = pixels.to(device)
+    alpha = rng.uniform(0, 1, size=(height, width, 1)).astype(np.float32)
+    lights = [rng.uniform(0, 1, size=(height, width, 3)).astype(np.float32) for _ in range(4)]
+    megapixels = width * height / 1e6
+    highres_megapixels = highres_width * highres_height / 1e6
+    rmbg_width, rmbg_height = feed_size(*source.shape[:2])
+    rmbg_feed = preprocess([source], rmbg_width, rmbg_height, 'cpu', torch.float32, crop=False, backend='pytorch')
+    rmbg_megapixels = rmbg_width * rmbg_height / 1e6
+
+    return [
+        Case('resize_and_center_crop', lambda: resize_and_center_crop(source, width, height), megapixels, 1),
+        Case('resize_without_crop', lambda: [resize_without_crop(p, highres_width, highres_height) for p in samples], highres_megapixels, num_samples),
+        Case('numpy2pytorch', lambda: numpy2pytorch(samples), megapixels, num_samples),
+        Case('pytorch2numpy', lambda: pytorch2numpy(device_pixels), megapixels, num_samples),
+        Case('pytorch2numpy_float', lambda: pytorch2numpy(device_pixels, quant=False), megapixels, num_samples),
+        Case('gradient', lambda: gray_to_rgb((make_gradient(192, 64, width, height) + make_gradient(192, 64, width, height, vertical=True)) / 2), megapixels, 1),
+        Case('composite_alpha', lambda: composite_alpha(fg, alpha, 16), megapixels, 1),
+        Case('estimate_normal', lambda: estimate_normal(*lights, alpha), megapixels, 1),
+        Case('preprocess_pil', lambda: preprocess([source], width, height, device, torch.float32, backend='pil'), megapixels, 1),
+        Case('preprocess_pytorch', lambda: preprocess([source], width, height, device, torch.float32, backend='pytorch'), megapixels, 1),
+        Case('upscale_decoded_pil', lambda: upscale_decoded(device_pixels, highres_width, highres_height, backend='pil').to(device), highres_megapixels, num_samples),
+        Case('upscale_decoded_pytorch', lambda: upscale_decoded(device_pixels, highres_width, highres_height, backend='pytorch'), highres_megapixels, num_samples),
+        Case('rmbg_torch', lambda: rmbg_engines()[0].predict_mask(rmbg_feed), rmbg_megapixels, 1),
+    ] + ([Case('rmbg_onnx', lambda: rmbg_engines()[1].predict_mask(rmbg_feed), rmbg_megapixels, 1)] if rmbg_onnx.onnxruntime is not None else [])
+
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_case(case, repeat, warmup, device):
+    for _ in range(warmup):
+        case.fn()
+    synchronize(device)
+    timings = []
+    cpu_timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        c0 = time.process_time()
+        case.fn()
+        synchronize(device)
+        cpu_timings.append((time.process_time() - c0) * 1000.0)
+        timings.append((time.perf_counter() - t0) * 1000.0)
+    return float(np.median(timings)), float(np.min(timings)), float(np.median(cpu_timings))
+
+
+def parse_size(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+parser = argparse.ArgumentParser(description="Micro-benchmarks for the IC-Light image utilities")
+parser.add_argument('--sizes', type=parse_size, nargs='+', default=[(512, 640), (768, 960)], help="Image sizes as WIDTHxHEIGHT")
+parser.add_argument('--num_samples', type=int, nargs='+', default=[1, 2, 4, 8], help="Batch sizes to benchmark")
+parser.add_argument('--cases', type=str, nargs='+', choices=list(BUDGETS_MS_PER_MPIX.keys()), default=None, help="Only run these cases (rmbg_torch and rmbg_onnx, CPU only, run only when listed here)")
+parser.add_argument('--repeat', type=int, default=10, help="Timed runs per case (median is reported)")
+parser.add_argument('--warmup', type=int, default=2, help="Untimed runs per case")
+parser.add_argument('--budget_scale', type=float, default=1.0, help="Multiply all budgets, e.g. 2.0 on slow machines")
+parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help="Device for the tensor-native cases")
+parser.add_argument('--threads', type=int, default=None, help="torch intra-op threads")
+parser.add_argument('--output', type=str, default=None, help="Write results as JSON to this path")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    rng = np.random.default_rng(12345)
+    results = []
+    failed = 0
+
+    print(f"{'case':<26}{'size':>10}{'n':>4}{'median ms':>12}{'min ms':>10}{'cpu ms':>10}{'budget ms':>12}  status")
+    for width, height in args.sizes:
+        for num_samples in args.num_samples:
+            for case in build_cases(width, height, num_samples, rng, args.device):
+                if case.name not in (args.cases or BUDGETS_MS_PER_MPIX.keys() - MODEL_CASES):
+                    continue
+                if case.num_samples == 1 and num_samples != args.num_samples[0]:
+                    continue  # per-image case, already timed for this size
+                median_ms, min_ms, cpu_ms = time_case(case, args.repeat, args.warmup, args.device)
+                budget_ms = case.budget_ms(args.budget_scale)
+                ok = median_ms <= budget_ms
+                failed += 0 if ok else 1
+                print(f"{case.name:<26}{f'{width}x{height}':>10}{case.num_samples:>4}{median_ms:>12.2f}{min_ms:>10.2f}{cpu_ms:>10.2f}{budget_ms:>12.2f}  {'ok' if ok else 'FAIL'}")
+                results.append(dict(case=case.name, width=width, height=height, num_samples=case.num_samples,
+                                    median_ms=median_ms, min_ms=min_ms, cpu_ms=cpu_ms, budget_ms=budget_ms, ok=ok))
+
+    by_key = {(r['case'], r['width'], r['height'], r['num_samples']): r for r in results}
+    for baseline, candidate in COMPARISONS:
+        for (name, width, height, num_samples), r in by_key.items():
+            other = by_key.get((candidate, width, height, num_samples))
+            if name == baseline and other is not None:
+                print(f"{candidate} vs {baseline} at {width}x{height} n={num_samples}: "
+                      f"{r['cpu_ms'] - other['cpu_ms']:.2f} ms CPU saved per call, {r['median_ms'] - other['median_ms']:.2f} ms wall")
+
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    print(f"{len(results) - failed} passed, {failed} failed")
+    raise SystemExit(1 if failed else 0)
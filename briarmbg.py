@@ -5,6 +5,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from huggingface_hub import PyTorchModelHubMixin
 
 
@@ -388,7 +389,66 @@ class BriaRMBG(nn.Module, PyTorchModelHubMixin):
 
         # self.outconv = nn.Conv2d(6*out_ch,out_ch,1)
 
+        self.channels_last = False
+
     def forward(self, x):
+        hx1d, hx2d, hx3d, hx4d, hx5d, hx6 = self.decode(x)
+
+        # side output
+        d1 = self.side1(hx1d)
+        d1 = _upsample_like(d1, x)
+
+        d2 = self.side2(hx2d)
+        d2 = _upsample_like(d2, x)
+
+        d3 = self.side3(hx3d)
+        d3 = _upsample_like(d3, x)
+
+        d4 = self.side4(hx4d)
+        d4 = _upsample_like(d4, x)
+
+        d5 = self.side5(hx5d)
+        d5 = _upsample_like(d5, x)
+
+        d6 = self.side6(hx6)
+        d6 = _upsample_like(d6, x)
+
+        return [
+            F.sigmoid(d1),
+            F.sigmoid(d2),
+            F.sigmoid(d3),
+            F.sigmoid(d4),
+            F.sigmoid(d5),
+            F.sigmoid(d6),
+        ], [hx1d, hx2d, hx3d, hx4d, hx5d, hx6]
+
+    def optimize(self, dtype=None, channels_last=False):
+        # inference only: folds every BatchNorm into the conv before it (conv -> ReLU instead of
+        # conv -> BatchNorm -> ReLU), then optionally casts to dtype and sets the memory format
+        # (channels_last, or back to contiguous so that a second call can undo the first)
+        self.eval()
+        for module in self.modules():
+            if isinstance(module, REBNCONV) and not isinstance(module.bn_s1, nn.Identity):
+                module.conv_s1 = fuse_conv_bn_eval(module.conv_s1, module.bn_s1)
+                module.bn_s1 = nn.Identity()
+            elif isinstance(module, myrebnconv) and not isinstance(module.bn, nn.Identity):
+                module.conv = fuse_conv_bn_eval(module.conv, module.bn)
+                module.bn = nn.Identity()
+        if dtype is not None:
+            self.to(dtype=dtype)
+        self.to(memory_format=torch.channels_last if channels_last else torch.contiguous_format)
+        self.channels_last = channels_last
+        return self
+
+    @torch.inference_mode()
+    def predict_mask(self, x):
+        # inference: only the first side output (forward(x)[0][0]), without the five other heads,
+        # their upsampling to input size and the decoder features
+        x = x.to(dtype=self.conv_in.weight.dtype, memory_format=torch.channels_last if self.channels_last else torch.contiguous_format)
+        hx1d = self.decode(x)[0]
+        return F.sigmoid(_upsample_like(self.side1(hx1d), x))
+
+    def decode(self, x):
         hx = x
 
         hxin = self.conv_in(hx)
@@ -433,30 +493,4 @@ class BriaRMBG(nn.Module, PyTorchModelHubMixin):
 
         hx1d = self.stage1d(torch.cat((hx2dup, hx1), 1))
 
-        # side output
-        d1 = self.side1(hx1d)
-        d1 = _upsample_like(d1, x)
-
-        d2 = self.side2(hx2d)
-        d2 = _upsample_like(d2, x)
-
-        d3 = self.side3(hx3d)
-        d3 = _upsample_like(d3, x)
-
-        d4 = self.side4(hx4d)
-        d4 = _upsample_like(d4, x)
-
-        d5 = self.side5(hx5d)
-        d5 = _upsample_like(d5, x)
-
-        d6 = self.side6(hx6)
-        d6 = _upsample_like(d6, x)
-
-        return [
-            F.sigmoid(d1),
-            F.sigmoid(d2),
-            F.sigmoid(d3),
-            F.sigmoid(d4),
-            F.sigmoid(d5),
-            F.sigmoid(d6),
-        ], [hx1d, hx2d, hx3d, hx4d, hx5d, hx6]
+        return hx1d, hx2d, hx3d, hx4d, hx5d, hx6
@@ -1,5 +1,6 @@
 import os
 import math
+import argparse
 import gradio as gr
 import numpy as np
 import torch
@@ -12,6 +13,9 @@ from diffusers import AutoencoderKL, UNet2DConditionModel, DDIMScheduler, EulerA
 from diffusers.models.attention_processor import AttnProcessor2_0
 from transformers import CLIPTextModel, CLIPTokenizer
 from briarmbg import BriaRMBG
+from image_utils import pytorch2numpy, numpy2pytorch, resize_and_center_crop, resize_without_crop, make_gradient, gray_to_rgb, composite_alpha, estimate_normal
+from memory_budget import MemoryBudget, with_fallbacks, vae_encode, vae_decode
+from metrics import stage, serve_metrics, ITEMS, IMAGES
 from enum import Enum
 from torch.hub import download_url_to_file
 
@@ -67,7 +71,7 @@ device = torch.device('cuda')
 text_encoder = text_encoder.to(device=device, dtype=torch.float16)
 vae = vae.to(device=device, dtype=torch.bfloat16)
 unet = unet.to(device=device, dtype=torch.float16)
-rmbg = rmbg.to(device=device, dtype=torch.float32)
+rmbg = rmbg.to(device=device, dtype=torch.float32).optimize()  # BatchNorm folded into the convs
 
 # SDP
 
@@ -104,29 +108,42 @@ dpmpp_2m_sde_karras_scheduler = DPMSolverMultistepScheduler(
 
 # Pipelines
 
-t2i_pipe = StableDiffusionPipeline(
-    vae=vae,
-    text_encoder=text_encoder,
-    tokenizer=tokenizer,
-    unet=unet,
-    scheduler=dpmpp_2m_sde_karras_scheduler,
-    safety_checker=None,
-    requires_safety_checker=False,
-    feature_extractor=None,
-    image_encoder=None
-)
+def make_pipelines(scheduler):
+    t2i_pipe = StableDiffusionPipeline(
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        unet=unet,
+        scheduler=scheduler,
+        safety_checker=None,
+        requires_safety_checker=False,
+        feature_extractor=None,
+        image_encoder=None
+    )
 
-i2i_pipe = StableDiffusionImg2ImgPipeline(
-    vae=vae,
-    text_encoder=text_encoder,
-    tokenizer=tokenizer,
-    unet=unet,
-    scheduler=dpmpp_2m_sde_karras_scheduler,
-    safety_checker=None,
-    requires_safety_checker=False,
-    feature_extractor=None,
-    image_encoder=None
-)
+    i2i_pipe = StableDiffusionImg2ImgPipeline(
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        unet=unet,
+        scheduler=scheduler,
+        safety_checker=None,
+        requires_safety_checker=False,
+        feature_extractor=None,
+        image_encoder=None
+    )
+
+    return t2i_pipe, i2i_pipe
+
+
+t2i_pipe, i2i_pipe = make_pipelines(dpmpp_2m_sde_karras_scheduler)
+
+
+def request_pipelines():
+    # Schedulers (timesteps, step index, solver history) and pipelines (guidance scale, cross attention
+    # kwargs) keep per-call state, so each request gets its own pair around the shared, read-only models.
+    scheduler = DPMSolverMultistepScheduler.from_config(dpmpp_2m_sde_karras_scheduler.config)
+    return make_pipelines(scheduler)
 
 
 @torch.inference_mode()
@@ -171,49 +188,36 @@ def encode_prompt_pair(positive_prompt, negative_prompt):
     return c, uc
 
 
-@torch.inference_mode()
-def pytorch2numpy(imgs, quant=True):
-    results = []
-    for x in imgs:
-        y = x.movedim(0, -1)
-
-        if quant:
-            y = y * 127.5 + 127.5
-            y = y.detach().float().cpu().numpy().clip(0, 255).astype(np.uint8)
-        else:
-            y = y * 0.5 + 0.5
-            y = y.detach().float().cpu().numpy().clip(0, 1).astype(np.float32)
-
-        results.append(y)
-    return results
+# num_samples の大きいバッチでメモリが足りなければ、UNet はマイクロバッチに分け、VAE は 1 枚ずつ、それでも足りなければタイルに分けてやり直す
+# (run_ic_light.py と同じ。予算は指定しないので、分けるのはメモリ不足で失敗したときだけ)
+memory_budget = MemoryBudget(device)
 
 
-@torch.inference_mode()
-def numpy2pytorch(imgs):
-    h = torch.from_numpy(np.stack(imgs, axis=0)).float() / 127.0 - 1.0  # so that 127 must be strictly 0.0
-    h = h.movedim(-1, 1)
-    return h
+def denoise(pipe, stage_name, conds, unconds, concat_conds, rng, num_samples, image=None, **kwargs):
+    # pipe(...).images を UNet のマイクロバッチに分けて計算する。デモの入力は 1 枚なので num_samples を分ける
+    def run(micro_batch):
+        latents = []
+        for start in range(0, num_samples, micro_batch):
+            stop = min(start + micro_batch, num_samples)
+            part = dict(prompt_embeds=conds, negative_prompt_embeds=unconds, num_images_per_prompt=stop - start,
+                        generator=rng, cross_attention_kwargs={'concat_conds': concat_conds})
+            if image is not None:
+                part['image'] = image[start:stop] if len(image) == num_samples else image
+            latents.append(pipe(**part, **kwargs).images)
+        return torch.cat(latents)
+
+    options = memory_budget.unet_micro_batches(num_samples, kwargs['width'], kwargs['height'], unet.dtype, stage_name)
+    return with_fallbacks(run, options, stage_name, [rng])
 
 
-def resize_and_center_crop(image, target_width, target_height):
-    pil_image = Image.fromarray(image)
-    original_width, original_height = pil_image.size
-    scale_factor = max(target_width / original_width, target_height / original_height)
-    resized_width = int(round(original_width * scale_factor))
-    resized_height = int(round(original_height * scale_factor))
-    resized_image = pil_image.resize((resized_width, resized_height), Image.LANCZOS)
-    left = (resized_width - target_width) / 2
-    top = (resized_height - target_height) / 2
-    right = (resized_width + target_width) / 2
-    bottom = (resized_height + target_height) / 2
-    cropped_image = resized_image.crop((left, top, right, bottom))
-    return np.array(cropped_image)
+def encode_latents(pixels, stage_name):
+    modes = memory_budget.vae_modes(len(pixels), pixels.shape[3], pixels.shape[2], vae.dtype, False, vae.tile_sample_min_size, stage_name)
+    return with_fallbacks(lambda mode: vae_encode(vae, pixels, mode), modes, stage_name) * vae.config.scaling_factor
 
 
-def resize_without_crop(image, target_width, target_height):
-    pil_image = Image.fromarray(image)
-    resized_image = pil_image.resize((target_width, target_height), Image.LANCZOS)
-    return np.array(resized_image)
+def decode_pixels(latents, stage_name):
+    modes = memory_budget.vae_modes(len(latents), latents.shape[3] * 8, latents.shape[2] * 8, vae.dtype, True, vae.tile_sample_min_size, stage_name)
+    return with_fallbacks(lambda mode: vae_decode(vae, latents, mode), modes, stage_name)
 
 
 @torch.inference_mode()
@@ -223,12 +227,12 @@ def run_rmbg(img, sigma=0.0):
     k = (256.0 / float(H * W)) ** 0.5
     feed = resize_without_crop(img, int(64 * round(W * k)), int(64 * round(H * k)))
     feed = numpy2pytorch([feed]).to(device=device, dtype=torch.float32)
-    alpha = rmbg(feed)[0][0]
+    with stage('rmbg'):
+        alpha = rmbg.predict_mask(feed)
     alpha = torch.nn.functional.interpolate(alpha, size=(H, W), mode="bilinear")
     alpha = alpha.movedim(1, -1)[0]
     alpha = alpha.detach().float().cpu().numpy().clip(0, 1)
-    result = 127 + (img.astype(np.float32) - 127 + sigma) * alpha
-    return result.clip(0, 255).astype(np.uint8), alpha
+    return composite_alpha(img, alpha, sigma), alpha
 
 
 @torch.inference_mode()
@@ -242,83 +246,73 @@ def process(input_fg, input_bg, prompt, image_width, image_height, num_samples,
     elif bg_source == BGSource.GREY:
         input_bg = np.zeros(shape=(image_height, image_width, 3), dtype=np.uint8) + 64
     elif bg_source == BGSource.LEFT:
-        gradient = np.linspace(224, 32, image_width)
-        image = np.tile(gradient, (image_height, 1))
-        input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
+        input_bg = gray_to_rgb(make_gradient(224, 32, image_width, image_height))
     elif bg_source == BGSource.RIGHT:
-        gradient = np.linspace(32, 224, image_width)
-        image = np.tile(gradient, (image_height, 1))
-        input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
+        input_bg = gray_to_rgb(make_gradient(32, 224, image_width, image_height))
     elif bg_source == BGSource.TOP:
-        gradient = np.linspace(224, 32, image_height)[:, None]
-        image = np.tile(gradient, (1, image_width))
-        input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
+        input_bg = gray_to_rgb(make_gradient(224, 32, image_width, image_height, vertical=True))
     elif bg_source == BGSource.BOTTOM:
-        gradient = np.linspace(32, 224, image_height)[:, None]
-        image = np.tile(gradient, (1, image_width))
-        input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
+        input_bg = gray_to_rgb(make_gradient(32, 224, image_width, image_height, vertical=True))
     else:
         raise 'Wrong background source!'
 
+    t2i_pipe, i2i_pipe = request_pipelines()
     rng = torch.Generator(device=device).manual_seed(seed)
 
-    fg = resize_and_center_crop(input_fg, image_width, image_height)
-    bg = resize_and_center_crop(input_bg, image_width, image_height)
-    concat_conds = numpy2pytorch([fg, bg]).to(device=vae.device, dtype=vae.dtype)
-    concat_conds = vae.encode(concat_conds).latent_dist.mode() * vae.config.scaling_factor
-    concat_conds = torch.cat([c[None, ...] for c in concat_conds], dim=1)
-
-    conds, unconds = encode_prompt_pair(positive_prompt=prompt + ', ' + a_prompt, negative_prompt=n_prompt)
-
-    latents = t2i_pipe(
-        prompt_embeds=conds,
-        negative_prompt_embeds=unconds,
-        width=image_width,
-        height=image_height,
-        num_inference_steps=steps,
-        num_images_per_prompt=num_samples,
-        generator=rng,
-        output_type='latent',
-        guidance_scale=cfg,
-        cross_attention_kwargs={'concat_conds': concat_conds},
-    ).images.to(vae.dtype) / vae.config.scaling_factor
-
-    pixels = vae.decode(latents).sample
-    pixels = pytorch2numpy(pixels)
-    pixels = [resize_without_crop(
-        image=p,
-        target_width=int(round(image_width * highres_scale / 64.0) * 64),
-        target_height=int(round(image_height * highres_scale / 64.0) * 64))
-    for p in pixels]
-
-    pixels = numpy2pytorch(pixels).to(device=vae.device, dtype=vae.dtype)
-    latents = vae.encode(pixels).latent_dist.mode() * vae.config.scaling_factor
-    latents = latents.to(device=unet.device, dtype=unet.dtype)
-
-    image_height, image_width = latents.shape[2] * 8, latents.shape[3] * 8
-    fg = resize_and_center_crop(input_fg, image_width, image_height)
-    bg = resize_and_center_crop(input_bg, image_width, image_height)
-    concat_conds = numpy2pytorch([fg, bg]).to(device=vae.device, dtype=vae.dtype)
-    concat_conds = vae.encode(concat_conds).latent_dist.mode() * vae.config.scaling_factor
-    concat_conds = torch.cat([c[None, ...] for c in concat_conds], dim=1)
-
-    latents = i2i_pipe(
-        image=latents,
-        strength=highres_denoise,
-        prompt_embeds=conds,
-        negative_prompt_embeds=unconds,
-        width=image_width,
-        height=image_height,
-        num_inference_steps=int(round(steps / highres_denoise)),
-        num_images_per_prompt=num_samples,
-        generator=rng,
-        output_type='latent',
-        guidance_scale=cfg,
-        cross_attention_kwargs={'concat_conds': concat_conds},
-    ).images.to(vae.dtype) / vae.config.scaling_factor
-
-    pixels = vae.decode(latents).sample
-    pixels = pytorch2numpy(pixels, quant=False)
+    with stage('encode'):
+        fg = resize_and_center_crop(input_fg, image_width, image_height)
+        bg = resize_and_center_crop(input_bg, image_width, image_height)
+        concat_conds = numpy2pytorch([fg, bg]).to(device=vae.device, dtype=vae.dtype)
+        concat_conds = vae.encode(concat_conds).latent_dist.mode() * vae.config.scaling_factor
+        concat_conds = torch.cat([c[None, ...] for c in concat_conds], dim=1)
+
+        conds, unconds = encode_prompt_pair(positive_prompt=prompt + ', ' + a_prompt, negative_prompt=n_prompt)
+
+    with stage('lowres'):
+        latents = denoise(
+            t2i_pipe, 'lowres', conds, unconds, concat_conds, rng, num_samples,
+            width=image_width,
+            height=image_height,
+            num_inference_steps=steps,
+            output_type='latent',
+            guidance_scale=cfg,
+        ).to(vae.dtype) / vae.config.scaling_factor
+
+    with stage('upscale'):
+        pixels = decode_pixels(latents, 'upscale')
+        pixels = pytorch2numpy(pixels)
+        pixels = [resize_without_crop(
+            image=p,
+            target_width=int(round(image_width * highres_scale / 64.0) * 64),
+            target_height=int(round(image_height * highres_scale / 64.0) * 64))
+        for p in pixels]
+
+        pixels = numpy2pytorch(pixels).to(device=vae.device, dtype=vae.dtype)
+        latents = encode_latents(pixels, 'upscale')
+        latents = latents.to(device=unet.device, dtype=unet.dtype)
+
+        image_height, image_width = latents.shape[2] * 8, latents.shape[3] * 8
+        fg = resize_and_center_crop(input_fg, image_width, image_height)
+        bg = resize_and_center_crop(input_bg, image_width, image_height)
+        concat_conds = numpy2pytorch([fg, bg]).to(device=vae.device, dtype=vae.dtype)
+        concat_conds = vae.encode(concat_conds).latent_dist.mode() * vae.config.scaling_factor
+        concat_conds = torch.cat([c[None, ...] for c in concat_conds], dim=1)
+
+    with stage('highres'):
+        latents = denoise(
+            i2i_pipe, 'highres', conds, unconds, concat_conds, rng, num_samples,
+            image=latents,
+            strength=highres_denoise,
+            width=image_width,
+            height=image_height,
+            num_inference_steps=int(round(steps / highres_denoise)),
+            output_type='latent',
+            guidance_scale=cfg,
+        ).to(vae.dtype) / vae.config.scaling_factor
+
+    with stage('decode'):
+        pixels = decode_pixels(latents, 'decode')
+        pixels = pytorch2numpy(pixels, quant=False)
 
     return pixels, [fg, bg]
 
@@ -328,6 +322,8 @@ def process_relight(input_fg, input_bg, prompt, image_width, image_height, num_s
     input_fg, matting = run_rmbg(input_fg)
     results, extra_images = process(input_fg, input_bg, prompt, image_width, image_height, num_samples, seed, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise, bg_source)
     results = [(x * 255.0).clip(0, 255).astype(np.uint8) for x in results]
+    ITEMS.inc(status='done', endpoint='relight')
+    IMAGES.inc(len(results))
     return results + extra_images
 
 
@@ -349,34 +345,14 @@ def process_normal(input_fg, input_bg, prompt, image_width, image_height, num_sa
 
     inner_results = [left * 2.0 - 1.0, right * 2.0 - 1.0, bottom * 2.0 - 1.0, top * 2.0 - 1.0]
 
-    ambient = (left + right + bottom + top) / 4.0
-    h, w, _ = ambient.shape
+    h, w, _ = left.shape
     matting = resize_and_center_crop((matting[..., 0] * 255.0).clip(0, 255).astype(np.uint8), w, h).astype(np.float32)[..., None] / 255.0
-
-    def safa_divide(a, b):
-        e = 1e-5
-        return ((a + e) / (b + e)) - 1.0
-
-    left = safa_divide(left, ambient)
-    right = safa_divide(right, ambient)
-    bottom = safa_divide(bottom, ambient)
-    top = safa_divide(top, ambient)
-
-    u = (right - left) * 0.5
-    v = (top - bottom) * 0.5
-
-    sigma = 10.0
-    u = np.mean(u, axis=2)
-    v = np.mean(v, axis=2)
-    h = (1.0 - u ** 2.0 - v ** 2.0).clip(0, 1e5) ** (0.5 * sigma)
-    z = np.zeros_like(h)
-
-    normal = np.stack([u, v, h], axis=2)
-    normal /= np.sum(normal ** 2.0, axis=2, keepdims=True) ** 0.5
-    normal = normal * matting + np.stack([z, z, 1 - z], axis=2) * (1 - matting)
+    normal, left, right, bottom, top = estimate_normal(left, right, bottom, top, matting)
 
     results = [normal, left, right, bottom, top] + inner_results
     results = [(x * 127.5 + 127.5).clip(0, 255).astype(np.uint8) for x in results]
+    ITEMS.inc(status='done', endpoint='normal')
+    IMAGES.inc(len(results))
     return results
 
 
@@ -403,7 +379,15 @@ class BGSource(Enum):
     GREY = "Ambient"
 
 
-block = gr.Blocks().queue()
+parser = argparse.ArgumentParser()
+parser.add_argument('--concurrency', type=int, default=1, help="Requests processed at the same time; they share the models, so GPU memory for activations grows with it")
+parser.add_argument('--metrics_port', type=int, default=None, help="Serve OpenMetrics stage latencies and request counts on http://<metrics_host>:<port>/metrics")
+parser.add_argument('--metrics_host', type=str, default='127.0.0.1', help="Address the metrics endpoint listens on (0.0.0.0 for a remote scraper)")
+args = parser.parse_args()
+if args.metrics_port is not None:
+    serve_metrics(args.metrics_port, host=args.metrics_host)
+
+block = gr.Blocks().queue(concurrency_count=args.concurrency)
 with block:
     with gr.Row():
         gr.Markdown("## IC-Light (Relighting with Foreground and Background Condition)")
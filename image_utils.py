@@ -0,0 +1,255 @@
+import threading
+import numpy as np
+import torch
+
+from PIL import Image
+
+
+_pinned_buffers = threading.local()
+
+
+def pinned_buffer(shape, dtype):
+    # reusable page-locked host buffer for non_blocking device-to-host copies. Each thread keeps only its most
+    # recent one, so varying output sizes (manifest overrides, gradio) replace it instead of piling up pinned memory
+    key = (tuple(shape), dtype)
+    if getattr(_pinned_buffers, 'key', None) != key:
+        _pinned_buffers.buffer = None  # release the old buffer before pinning the new one
+        _pinned_buffers.buffer = torch.empty(shape, dtype=dtype, pin_memory=torch.cuda.is_available())
+        _pinned_buffers.key = key
+    return _pinned_buffers.buffer
+
+
+@torch.inference_mode()
+def pytorch2numpy(imgs, quant=True):
+    if isinstance(imgs, (list, tuple)):
+        imgs = torch.stack(imgs, dim=0)
+
+    if imgs.device.type == 'cpu':
+        # already on the host, where NumPy clip/astype per image is the fastest option
+        results = []
+        for x in imgs:
+            y = x.movedim(0, -1)
+
+            if quant:
+                y = y * 127.5 + 127.5
+                y = y.detach().float().numpy().clip(0, 255).astype(np.uint8)
+            else:
+                y = y * 0.5 + 0.5
+                y = y.detach().float().numpy().clip(0, 1).astype(np.float32)
+
+            results.append(y)
+        return results
+
+    # scale, clamp and quantise the whole batch on the device, then do a single copy to the host
+    if quant:
+        y = imgs.detach() * 127.5 + 127.5
+        y = y.float().clamp_(0, 255).to(torch.uint8)
+    else:
+        y = imgs.detach() * 0.5 + 0.5
+        y = y.float().clamp_(0, 1)
+    y = y.movedim(1, -1).contiguous()
+    if y.device.type != 'cuda':
+        return list(y.cpu().numpy())
+
+    buffer = pinned_buffer(y.shape, y.dtype)
+    buffer.copy_(y, non_blocking=True)
+    torch.cuda.current_stream(y.device).synchronize()
+    return list(buffer.numpy().copy())
+
+
+@torch.inference_mode()
+def numpy2pytorch(imgs):
+    h = torch.from_numpy(np.stack(imgs, axis=0)).float() / 127.0 - 1.0  # so that 127 must be strictly 0.0
+    h = h.movedim(-1, 1)
+    return h
+
+
+def resize_and_center_crop(image, target_width, target_height):
+    pil_image = Image.fromarray(image)
+    original_width, original_height = pil_image.size
+    scale_factor = max(target_width / original_width, target_height / original_height)
+    resized_width = int(round(original_width * scale_factor))
+    resized_height = int(round(original_height * scale_factor))
+    resized_image = pil_image.resize((resized_width, resized_height), Image.LANCZOS)
+    left = (resized_width - target_width) / 2
+    top = (resized_height - target_height) / 2
+    right = (resized_width + target_width) / 2
+    bottom = (resized_height + target_height) / 2
+    cropped_image = resized_image.crop((left, top, right, bottom))
+    return np.array(cropped_image)
+
+
+def resize_without_crop(image, target_width, target_height):
+    pil_image = Image.fromarray(image)
+    resized_image = pil_image.resize((target_width, target_height), Image.LANCZOS)
+    return np.array(resized_image)
+
+
+def resize_pytorch(h, target_width, target_height, crop=True):
+    # h is a float NCHW tensor in [0, 255], resized with antialiasing wherever it lives
+    original_height, original_width = h.shape[2], h.shape[3]
+    if crop:
+        scale_factor = max(target_width / original_width, target_height / original_height)
+        resized_width = int(round(original_width * scale_factor))
+        resized_height = int(round(original_height * scale_factor))
+    else:
+        resized_width, resized_height = target_width, target_height
+    if (resized_width, resized_height) != (original_width, original_height):
+        h = torch.nn.functional.interpolate(h, size=(resized_height, resized_width), mode="bicubic", antialias=True, align_corners=False)
+        h = h.clamp(0, 255).round()
+    if crop:
+        # same box rounding as PIL's Image.crop
+        left = int(round((resized_width - target_width) / 2))
+        top = int(round((resized_height - target_height) / 2))
+        h = h[:, :, top:top + target_height, left:left + target_width]
+    return h
+
+
+@torch.inference_mode()
+def numpy2pytorch_resized(imgs, target_width, target_height, device, crop=True):
+    # tensor-native replacement for numpy2pytorch([resize_and_center_crop(x, ...) for x in imgs]):
+    # each uint8 image is copied to the device once and resized and normalised there
+    results = []
+    for img in imgs:
+        h = torch.from_numpy(np.ascontiguousarray(img)).to(device=device, non_blocking=True)
+        h = h.movedim(-1, 0)[None].float()
+        results.append(resize_pytorch(h, target_width, target_height, crop=crop))
+    return torch.cat(results, dim=0) / 127.0 - 1.0
+
+
+@torch.inference_mode()
+def pytorch_resized(imgs, target_width, target_height):
+    # tensor-native replacement for numpy2pytorch([resize_without_crop(x, ...) for x in pytorch2numpy(imgs)])
+    h = (imgs.float() * 127.5 + 127.5).clamp(0, 255).floor()
+    return resize_pytorch(h, target_width, target_height, crop=False) / 127.0 - 1.0
+
+
+@torch.inference_mode()
+def preprocess(imgs, target_width, target_height, device, dtype, crop=True, backend='pil'):
+    # uint8 HWC arrays -> normalised NCHW tensor on device; 'pil' is bit-exact with the original scripts
+    if backend == 'pil':
+        resize = resize_and_center_crop if crop else resize_without_crop
+        h = numpy2pytorch([resize(x, target_width, target_height) for x in imgs])
+    else:
+        h = numpy2pytorch_resized(imgs, target_width, target_height, device=device, crop=crop)
+    return h.to(device=device, dtype=dtype)
+
+
+@torch.inference_mode()
+def preprocess_images(imgs, target_width, target_height, device, dtype, crop=True, backend='pil'):
+    # preprocess() that also returns the resized uint8 HWC arrays, for outputs that show the conditioning images.
+    # 'pil' returns the arrays the tensor was made from; 'pytorch' requantises with numpy2pytorch's /127 scale,
+    # in float32 before the cast to dtype (a bfloat16 round trip changes over a third of the values)
+    if backend == 'pil':
+        resize = resize_and_center_crop if crop else resize_without_crop
+        images = [resize(x, target_width, target_height) for x in imgs]
+        h = numpy2pytorch(images)
+    else:
+        h = numpy2pytorch_resized(imgs, target_width, target_height, device=device, crop=crop)
+        images = list(((h + 1.0) * 127.0).round().clamp(0, 255).to(torch.uint8).movedim(1, -1).cpu().numpy())
+    return h.to(device=device, dtype=dtype), images
+
+
+@torch.inference_mode()
+def upscale_decoded(pixels, target_width, target_height, backend='pil'):
+    # decoded [-1, 1] NCHW tensor -> requantised, resized and renormalised tensor for the highres pass
+    if backend == 'pil':
+        pixels = pytorch2numpy(pixels)
+        pixels = [resize_without_crop(p, target_width, target_height) for p in pixels]
+        return numpy2pytorch(pixels)
+    return pytorch_resized(pixels, target_width, target_height)
+
+
+def make_gradient(start, stop, image_width, image_height, vertical=False):
+    # float (H, W) ramp from start to stop, left to right or top to bottom
+    if vertical:
+        gradient = np.linspace(start, stop, image_height)[:, None]
+        return np.tile(gradient, (1, image_width))
+    gradient = np.linspace(start, stop, image_width)
+    return np.tile(gradient, (image_height, 1))
+
+
+def gray_to_rgb(image):
+    return np.stack((image,) * 3, axis=-1).astype(np.uint8)
+
+
+def composite_alpha(img, alpha, sigma=0.0):
+    result = 127 + (img.astype(np.float32) - 127 + sigma) * alpha
+    return result.clip(0, 255).astype(np.uint8)
+
+
+def split_alpha(image, mask=None):
+    # PIL image (and optional PIL mask) -> RGB uint8 array and the supplied alpha as (H, W, 1) float32 in [0, 1],
+    # or None when there is none: a sidecar mask wins over the image's own alpha channel, and a fully opaque
+    # alpha channel counts as no mask
+    alpha = None
+    if mask is not None:
+        if mask.size != image.size:
+            raise ValueError(f'mask size {mask.size} does not match image size {image.size}')
+        alpha = np.array(mask.convert('L'))
+    elif image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        alpha = np.array(image.convert('RGBA').getchannel('A'))
+        if alpha.min() == 255:
+            alpha = None
+    rgb = np.array(image.convert('RGB'))
+    if alpha is not None:
+        alpha = alpha.astype(np.float32)[..., None] / 255.0
+    return rgb, alpha
+
+
+def estimate_normal(left, right, bottom, top, matting):
+    # left/right/bottom/top are float images in [0, 1], matting is (H, W, 1) in [0, 1]
+    ambient = (left + right + bottom + top) / 4.0
+
+    def safa_divide(a, b):
+        e = 1e-5
+        return ((a + e) / (b + e)) - 1.0
+
+    left = safa_divide(left, ambient)
+    right = safa_divide(right, ambient)
+    bottom = safa_divide(bottom, ambient)
+    top = safa_divide(top, ambient)
+
+    u = (right - left) * 0.5
+    v = (top - bottom) * 0.5
+
+    sigma = 10.0
+    u = np.mean(u, axis=2)
+    v = np.mean(v, axis=2)
+    h = (1.0 - u ** 2.0 - v ** 2.0).clip(0, 1e5) ** (0.5 * sigma)
+    z = np.zeros_like(h)
+
+    normal = np.stack([u, v, h], axis=2)
+    normal /= np.sum(normal ** 2.0, axis=2, keepdims=True) ** 0.5
+    normal = normal * matting + np.stack([z, z, 1 - z], axis=2) * (1 - matting)
+
+    return normal, left, right, bottom, top
+
+
+def psnr(a, b):
+    # uint8 images -> dB (inf when identical)
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float('inf') if mse == 0 else float(10.0 * np.log10(255.0 ** 2 / mse))
+
+
+@torch.inference_mode()
+def ssim(a, b):
+    # mean SSIM of two uint8 HWC images (11x11 Gaussian window, sigma 1.5, averaged over the channels)
+    x = torch.from_numpy(a).double().movedim(-1, 0)[:, None]
+    y = torch.from_numpy(b).double().movedim(-1, 0)[:, None]
+    coords = torch.arange(11, dtype=torch.float64) - 5
+    window = torch.exp(-coords ** 2 / (2 * 1.5 ** 2))
+    window = window / window.sum()
+    window = (window[:, None] * window[None, :])[None, None]
+
+    def blur(t):
+        return torch.nn.functional.conv2d(t, window)
+
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    mu_x, mu_y = blur(x), blur(y)
+    var_x = blur(x * x) - mu_x ** 2
+    var_y = blur(y * y) - mu_y ** 2
+    cov = blur(x * y) - mu_x * mu_y
+    s = ((2 * mu_x * mu_y + c1) * (2 * cov + c2)) / ((mu_x ** 2 + mu_y ** 2 + c1) * (var_x + var_y + c2))
+    return float(s.mean())
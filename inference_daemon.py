@@ -0,0 +1,139 @@
+import io
+import os
+import sys
+import json
+import socket
+import argparse
+import importlib
+import threading
+import traceback
+import contextlib
+
+
+class SocketStream(io.TextIOBase):
+    # stdout/stderr replacement that forwards everything a job prints to the client
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        if text:
+            self.send(dict(out=text))
+        return len(text)
+
+    def send(self, message):
+        with self.lock:
+            try:
+                self.conn.sendall((json.dumps(message) + '\n').encode())
+            except OSError:
+                pass  # the client went away; the job still runs to completion
+
+
+def exit_code(e):
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    print(e.code, file=sys.stderr)
+    return 1
+
+
+def run_job(pipeline, request, stream):
+    # runs one CLI invocation in this process, with the client's working directory and output
+    cwd = os.getcwd()
+    pid = os.getpid()
+    code = 0
+    with contextlib.redirect_stdout(stream), contextlib.redirect_stderr(stream):
+        try:
+            os.chdir(request['cwd'])
+            pipeline.main(request['argv'])
+        except SystemExit as e:
+            code = exit_code(e)
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os.chdir(cwd)
+    if os.getpid() != pid:
+        os._exit(code)  # a --cpu_workers child that finished its share must not return to the accept loop
+    return code
+
+
+def socket_in_use(socket_path):
+    # True if a daemon accepts connections on socket_path; a socket file left by a crashed daemon refuses them
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except OSError:
+        return False
+    finally:
+        probe.close()
+    return True
+
+
+def read_request(conn):
+    request = json.loads(conn.makefile('rb').readline())
+    if not isinstance(request, dict) or not isinstance(request.get('argv'), list) or not isinstance(request.get('cwd'), str):
+        raise ValueError('expected a JSON object with argv (a list) and cwd')
+    return request
+
+
+def serve(socket_path, script):
+    # imports the pipeline script once (model loading, offset merge and device transfer happen here)
+    # and then runs one job per connection, one at a time; waiting clients queue in the listen backlog
+    if os.path.exists(socket_path):
+        if socket_in_use(socket_path):
+            raise SystemExit(f'another inference daemon is serving {socket_path}')
+        os.remove(socket_path)
+    pipeline = importlib.import_module(script)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(16)
+    print(f'{script} ready on {socket_path}')
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                stream = SocketStream(conn)
+                try:
+                    request = read_request(conn)
+                except (ValueError, OSError) as e:
+                    # a malformed request (or a client that went away) fails that request only
+                    stream.send(dict(out=f'bad request: {e}\n'))
+                    stream.send(dict(exit=2))
+                    continue
+                stream.send(dict(exit=run_job(pipeline, request, stream)))
+    finally:
+        server.close()
+        os.remove(socket_path)
+
+
+def submit(socket_path, argv):
+    # thin client: forwards the CLI arguments, prints the job's output and returns its exit status
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(socket_path)
+    with conn:
+        conn.sendall((json.dumps(dict(argv=argv, cwd=os.getcwd())) + '\n').encode())
+        for line in conn.makefile('rb'):
+            message = json.loads(line)
+            if 'out' in message:
+                sys.stdout.write(message['out'])
+                sys.stdout.flush()
+            elif 'exit' in message:
+                return message['exit']
+    print('inference daemon closed the connection before the job finished', file=sys.stderr)
+    return 1
+
+
+parser = argparse.ArgumentParser(description="Keep the IC-Light models loaded in a daemon and submit CLI runs to it over a Unix socket. "
+                                             "Any argument not listed here is passed through to the pipeline script unchanged.")
+parser.add_argument('--socket', type=str, default='/tmp/ic_light.sock', help="Path of the Unix socket")
+parser.add_argument('--serve', action='store_true', help="Start the daemon instead of submitting a job")
+parser.add_argument('--script', type=str, default='run_ic_light', help="Pipeline module the daemon serves (run_ic_light or run_ic_light_bg)")
+
+if __name__ == '__main__':
+    args, pipeline_argv = parser.parse_known_args()
+    if args.serve:
+        serve(args.socket, args.script)
+    else:
+        raise SystemExit(submit(args.socket, pipeline_argv))
@@ -0,0 +1,315 @@
+import io
+import sys
+import json
+import math
+import time
+import base64
+import hashlib
+import argparse
+import importlib
+import threading
+import collections
+import numpy as np
+
+from PIL import Image
+from concurrent.futures import Future, TimeoutError
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from image_utils import split_alpha
+from memory_budget import MemoryBudget
+from metrics import render, cache_lookup, reset_peak_memory, CONTENT_TYPE, QUEUE_WAIT_SECONDS, QUEUE_DEPTH, BATCH_SIZE, ITEMS, IMAGES
+
+
+SCRIPTS = {'fc': 'run_ic_light', 'fbc': 'run_ic_light_bg'}
+
+# sampler settings shared by every request in one UNet batch, besides the variant and the prompt length
+BATCH_PARAMS = {
+    'fc': ('image_width', 'image_height', 'num_samples', 'steps', 'a_prompt', 'n_prompt', 'cfg', 'highres_scale', 'highres_denoise', 'lowres_denoise', 'bg_source'),
+    'fbc': ('image_width', 'image_height', 'num_samples', 'steps', 'a_prompt', 'n_prompt', 'cfg', 'highres_scale', 'highres_denoise', 'bg_source'),
+}
+DEFAULT_BG_SOURCE = {'fc': 'None', 'fbc': 'Use Background Image'}
+
+
+class QueueFull(Exception):
+    pass
+
+
+class NotFound(Exception):
+    pass
+
+
+class MicroBatcher:
+    # collects submitted items per key and runs them through run_batch(key, items) in one call once
+    # max_batch_size items with the key of the oldest waiting item are queued, or that item has waited
+    # max_delay seconds. Keys are served oldest first, so a rare key is delayed by at most one window.
+    def __init__(self, run_batch, max_batch_size=4, max_delay=0.05, max_queue=64):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.max_queue = max_queue
+        self.pending = []
+        self.condition = threading.Condition()
+        self.batch_sizes = collections.Counter()
+        self.thread = threading.Thread(target=self.loop, name='micro-batcher', daemon=True)
+        self.thread.start()
+
+    def submit(self, key, item):
+        future = Future()
+        with self.condition:
+            if len(self.pending) >= self.max_queue:
+                raise QueueFull(f'{len(self.pending)} requests waiting')
+            self.pending.append((key, item, future, time.monotonic()))
+            QUEUE_DEPTH.set(len(self.pending), queue='batch')
+            self.condition.notify()
+        return future
+
+    def next_batch(self):
+        with self.condition:
+            while True:
+                if not self.pending:
+                    self.condition.wait()
+                    continue
+                key, _, _, arrival = self.pending[0]
+                batch = [p for p in self.pending if p[0] == key][:self.max_batch_size]
+                remaining = arrival + self.max_delay - time.monotonic()
+                if len(batch) >= self.max_batch_size or remaining <= 0:
+                    chosen = set(id(p) for p in batch)
+                    self.pending = [p for p in self.pending if id(p) not in chosen]
+                    QUEUE_DEPTH.set(len(self.pending), queue='batch')
+                    return key, batch
+                self.condition.wait(remaining)
+
+    def loop(self):
+        while True:
+            key, batch = self.next_batch()
+            self.batch_sizes[len(batch)] += 1
+            BATCH_SIZE.observe(len(batch))
+            started = time.monotonic()
+            for _, _, _, arrival in batch:
+                QUEUE_WAIT_SECONDS.observe(started - arrival, queue='batch')
+            try:
+                results = self.run_batch(key, [item for _, item, _, _ in batch])
+            except Exception as e:
+                for _, _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, _, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+
+def decode_image(data):
+    return np.array(Image.open(io.BytesIO(base64.b64decode(data))).convert('RGB'))
+
+
+def decode_foreground(request):
+    # RGB foreground and its alpha from an RGBA PNG or a separate 'mask' image, if any (then matting skips BriaRMBG)
+    mask = Image.open(io.BytesIO(base64.b64decode(request['mask']))) if request.get('mask') else None
+    return split_alpha(Image.open(io.BytesIO(base64.b64decode(request['input_fg']))), mask)
+
+
+def encode_image(array):
+    buffer = io.BytesIO()
+    Image.fromarray(array).save(buffer, format='PNG')
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def prompt_chunks(module, text):
+    # number of 75-token CLIP chunks encode_prompt_inner() produces; prompts batch together only if equal
+    tokens = module.tokenizer(text, truncation=False, add_special_tokens=False)["input_ids"]
+    return math.ceil(len(tokens) / (module.tokenizer.model_max_length - 2))
+
+
+class RelightService:
+    # request handling shared by all HTTP threads: matting runs in the request thread, process() calls
+    # go through the micro-batcher, and identical requests in flight at the same time are computed once
+    def __init__(self, models, max_batch_size=4, max_delay=0.05, max_queue=64, timeout=600.0):
+        self.models = models
+        self.timeout = timeout
+        self.batcher = MicroBatcher(self.run_batch, max_batch_size=max_batch_size, max_delay=max_delay, max_queue=max_queue)
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.deduplicated = 0
+
+    def handle(self, path, request):
+        variant, _, endpoint = path.strip('/').partition('/')
+        handler = {('fc', 'relight'): self.relight_fc, ('fbc', 'relight'): self.relight_fbc, ('fbc', 'normal'): self.normal_fbc}.get((variant, endpoint))
+        if handler is None or variant not in self.models:
+            raise NotFound(path)
+
+        key = hashlib.sha256(json.dumps([path, request], sort_keys=True).encode()).hexdigest()
+        with self.lock:
+            self.requests += 1
+            future = self.inflight.get(key)
+            owner = not cache_lookup('dedup', future is not None)
+            if owner:
+                future = self.inflight[key] = Future()
+            else:
+                self.deduplicated += 1
+        if owner:
+            try:
+                response = handler(variant, request)
+                future.set_result(response)
+                ITEMS.inc(status='done', endpoint=path)
+                IMAGES.inc(len(response['images']))
+            except Exception as e:
+                future.set_exception(e)
+                ITEMS.inc(status='failed', endpoint=path)
+            finally:
+                with self.lock:
+                    del self.inflight[key]
+        return future.result()
+
+    def params(self, variant, request):
+        module = self.models[variant]
+        params = {name: request.get(name, module.parser.get_default(name)) for name in BATCH_PARAMS[variant]}
+        if 'bg_source' not in request:
+            params['bg_source'] = DEFAULT_BG_SOURCE[variant]
+        return params
+
+    def submit(self, variant, params, item):
+        # requests with several samples keep the single-generator sampling of the CLI and run alone
+        module = self.models[variant]
+        chunks = max(prompt_chunks(module, item['prompt'] + ', ' + params['a_prompt']), prompt_chunks(module, params['n_prompt']))
+        nonce = None if params['num_samples'] == 1 else object()
+        key = (variant, tuple(sorted(params.items())), chunks, nonce)
+        return self.batcher.submit(key, item)
+
+    def run_batch(self, key, items):
+        variant, params = key[0], dict(key[1])
+        module = self.models[variant]
+        inputs = dict(input_fgs=[item['input_fg'] for item in items], prompts=[item['prompt'] for item in items], seeds=[item['seed'] for item in items])
+        if variant == 'fbc':
+            inputs['input_bgs'] = [item['input_bg'] for item in items]
+        return module.process_batch(**inputs, **params)
+
+    def item(self, request, input_fg):
+        return dict(input_fg=input_fg, prompt=request['prompt'], seed=int(request.get('seed', 12345)))
+
+    def relight_fc(self, variant, request):
+        module = self.models[variant]
+        input_fg, alpha = decode_foreground(request)
+        input_fg, matting = module.run_rmbg(input_fg, alpha=alpha)
+        future = self.submit(variant, self.params(variant, request), self.item(request, input_fg))
+        results = future.result(timeout=self.timeout)
+        return dict(foreground=encode_image(input_fg), images=[encode_image(x) for x in results])
+
+    def relight_fbc(self, variant, request):
+        module = self.models[variant]
+        input_fg, alpha = decode_foreground(request)
+        input_fg, matting = module.run_rmbg(input_fg, alpha=alpha)
+        item = self.item(request, input_fg)
+        item['input_bg'] = decode_image(request['input_bg']) if request.get('input_bg') else None
+        params = self.params(variant, request)
+        if item['input_bg'] is None and params['bg_source'] in ('Use Background Image', 'Use Flipped Background Image'):
+            raise ValueError(f"bg_source {params['bg_source']} needs input_bg")
+        results, extra_images = self.submit(variant, params, item).result(timeout=self.timeout)
+        results = [(x * 255.0).clip(0, 255).astype(np.uint8) for x in results]
+        return dict(images=[encode_image(x) for x in results + extra_images])
+
+    def normal_fbc(self, variant, request):
+        # the four directional passes are submitted together, so they batch with other requests' passes
+        module = self.models[variant]
+        input_fg, alpha = decode_foreground(request)
+        input_fg, matting = module.run_rmbg(input_fg, sigma=16, alpha=alpha)
+        item = self.item(request, input_fg)
+        item['input_bg'] = None
+        params = dict(self.params(variant, request), num_samples=1)
+        futures = [self.submit(variant, dict(params, bg_source=module.BGSource[direction].value), item)
+                   for direction in ('LEFT', 'RIGHT', 'BOTTOM', 'TOP')]
+        left, right, bottom, top = [future.result(timeout=self.timeout)[0][0] for future in futures]
+        results = module.normal_results(left, right, bottom, top, matting)
+        return dict(images=[encode_image(x) for x in results])
+
+    def stats(self):
+        with self.batcher.condition:
+            pending = len(self.batcher.pending)
+            batch_sizes = dict(self.batcher.batch_sizes)
+        return dict(models=sorted(self.models), pending=pending, requests=self.requests, deduplicated=self.deduplicated, batch_sizes=batch_sizes)
+
+
+class Handler(BaseHTTPRequestHandler):
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, self.server.service.stats())
+        elif self.path == '/metrics':
+            data = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_json(404, dict(error=f'unknown path {self.path}'))
+
+    def do_POST(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            self.send_json(200, self.server.service.handle(self.path, request))
+        except NotFound as e:
+            self.send_json(404, dict(error=f'unknown path {e}'))
+        except (KeyError, ValueError) as e:
+            self.send_json(400, dict(error=f'{type(e).__name__}: {e}'))
+        except QueueFull as e:
+            self.send_json(503, dict(error=f'queue full: {e}'))
+        except TimeoutError:
+            self.send_json(504, dict(error='request did not finish within the timeout'))
+        except Exception as e:
+            self.send_json(500, dict(error=f'{type(e).__name__}: {e}'))
+
+
+parser = argparse.ArgumentParser(description="HTTP server for IC-Light relighting with micro-batching of concurrent requests. "
+                                             "POST JSON with base64 PNG images (input_fg, optionally mask or an RGBA input_fg) to /fc/relight, /fbc/relight or /fbc/normal; GET /health for statistics and /metrics for OpenMetrics.")
+parser.add_argument('--host', type=str, default='127.0.0.1', help="Address to listen on")
+parser.add_argument('--port', type=int, default=8000, help="Port to listen on")
+parser.add_argument('--variants', type=str, nargs='+', choices=sorted(SCRIPTS), default=['fc'], help="Models to load (each one loads its own UNet, VAE and text encoder)")
+parser.add_argument('--max_batch_size', type=int, default=4, help="Maximum number of requests in one UNet batch")
+parser.add_argument('--max_delay_ms', type=float, default=50.0, help="How long the oldest waiting request may wait for others to batch with")
+parser.add_argument('--max_queue', type=int, default=64, help="Requests waiting for the UNet beyond this are rejected with 503")
+parser.add_argument('--timeout', type=float, default=600.0, help="Seconds after which a waiting request is answered with 504")
+parser.add_argument('--preprocess', type=str, choices=['pytorch', 'pil'], default='pil', help="Resize backend, as in the CLI")
+parser.add_argument('--rmbg_dtype', type=str, choices=['float32', 'bfloat16', 'float16'], default='float32', help="BriaRMBG precision, as in the CLI")
+parser.add_argument('--rmbg_channels_last', action='store_true', help="Run BriaRMBG in channels_last memory format, as in the CLI")
+parser.add_argument('--int8', action='store_true', help="CPU only: dynamic int8 quantisation of the UNet and text encoder, as in the CLI")
+parser.add_argument('--rmbg_onnx', type=str, default=None, help="Run BriaRMBG with onnxruntime from this ONNX file, as in the CLI")
+parser.add_argument('--attention', type=str, choices=['sdpa', 'chunked', 'auto'], default='sdpa', help="UNet and VAE attention, as in the CLI")
+parser.add_argument('--attention_threshold', type=int, default=4096, help="Sequence length above which --attention chunked splits the attention")
+parser.add_argument('--attention_chunk', type=int, default=1024, help="Queries per chunk with --attention chunked")
+parser.add_argument('--attention_key_chunk', type=int, default=None, help="Also split the keys into chunks of this many")
+parser.add_argument('--token_downsampling', type=float, default=None, help="Downsample the keys and values of the UNet's full-resolution self-attention in the highres pass, as in the CLI")
+parser.add_argument('--token_downsampling_lowres', action='store_true', help="Apply --token_downsampling in the lowres pass too")
+parser.add_argument('--memory_budget', type=float, default=None, help="GiB of device memory to stay under by splitting UNet batches and VAE work, as in the CLI")
+parser.add_argument('--offload', action='store_true', help="Keep only the model in use on the device, as in the CLI; the variants take turns with one device-resident model between them")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.offload and args.int8:
+        parser.error("--offload cannot be combined with --int8")
+    models = {}
+    residency = None
+    for variant in args.variants:
+        models[variant] = importlib.import_module(SCRIPTS[variant])
+        models[variant].args = argparse.Namespace(preprocess=args.preprocess, rmbg_dtype=args.rmbg_dtype, rmbg_channels_last=args.rmbg_channels_last,
+                                                     rmbg_onnx=args.rmbg_onnx)
+        models[variant].memory_budget = MemoryBudget(models[variant].device, None if args.memory_budget is None else int(args.memory_budget * 2**30))
+        models[variant].set_attention(args.attention, args.attention_threshold, args.attention_chunk, args.attention_key_chunk,
+                                      args.token_downsampling, ('lowres', 'highres') if args.token_downsampling_lowres else ('highres',))
+        if args.int8:
+            models[variant].quantize_models()
+        if args.offload:
+            residency = models[variant].enable_offload(residency)
+    reset_peak_memory()
+    service = RelightService(models, max_batch_size=args.max_batch_size, max_delay=args.max_delay_ms / 1000.0,
+                             max_queue=args.max_queue, timeout=args.timeout)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.service = service
+    print(f'serving {", ".join(args.variants)} on http://{args.host}:{args.port}')
+    sys.stdout.flush()
+    server.serve_forever()
@@ -0,0 +1,165 @@
+import os
+import csv
+import json
+import argparse
+import numpy as np
+
+
+# Per-item overrides a manifest record may carry on top of the CLI arguments.
+OVERRIDE_FIELDS = {
+    'seed': int,
+    'image_width': int,
+    'image_height': int,
+    'num_samples': int,
+    'steps': int,
+    'cfg': float,
+    'prompt': str,
+}
+
+
+def record_name(image, base_dir):
+    # the image path relative to base_dir, so that a/1.png and b/1.png get distinct outputs, manifest entries and
+    # checkpoints; an image outside base_dir keeps its absolute path without the leading separator, so that no
+    # name climbs out of the output directory
+    name = os.path.normpath(os.path.relpath(image, base_dir))
+    if name == os.pardir or name.startswith(os.pardir + os.sep):
+        name = os.path.abspath(image).lstrip(os.sep)
+    return name
+
+
+def normalize_record(record, base_dir):
+    # one manifest line -> {'name', 'image', 'mask', 'light_source', 'hair_color', 'overrides'}; mask is an optional
+    # sidecar alpha image that replaces BriaRMBG matting for this item
+    if not record.get('image'):
+        raise ValueError(f'Manifest record without an image: {record}')
+    image = record['image']
+    if not os.path.isabs(image):
+        image = os.path.join(base_dir, image)
+    mask = record.get('mask') or None
+    if mask is not None and not os.path.isabs(mask):
+        mask = os.path.join(base_dir, mask)
+    overrides = {k: cast(record[k]) for k, cast in OVERRIDE_FIELDS.items() if record.get(k) not in (None, '')}
+    return dict(
+        name=record.get('name') or record_name(image, base_dir),
+        image=image,
+        mask=mask,
+        light_source=record.get('light_source') or '',
+        hair_color=record.get('hair_color') or '',
+        overrides=overrides,
+    )
+
+
+def csv_records(file):
+    # (byte offset, fields) of each CSV record from the binary file's current position. A quoted field may span
+    # lines, so records come from csv.reader over the decoded lines, and a record's offset is that of its first line
+    pending = []
+
+    def lines():
+        while True:
+            offset = file.tell()
+            line = file.readline()
+            if not line:
+                return
+            pending.append(offset)
+            yield line.decode('utf-8-sig' if offset == 0 else 'utf-8')
+
+    for fields in csv.reader(lines()):
+        offset = pending[0]
+        pending.clear()  # csv.reader reads no further than the end of the record it returns
+        if fields:
+            yield offset, fields
+
+
+def offset_index_path(path):
+    return path + '.offsets.npy'
+
+
+def build_offset_index(path):
+    # byte offset of every record, so a shard can seek straight to its first record
+    offsets = []
+    with open(path, 'rb') as file:
+        if path.endswith('.csv'):
+            offsets = [offset for offset, fields in csv_records(file)][1:]  # without the header
+        else:
+            while True:
+                offset = file.tell()
+                line = file.readline()
+                if not line:
+                    break
+                if line.strip():
+                    offsets.append(offset)
+    offsets = np.array(offsets, dtype=np.int64)
+    # concurrent shard workers may build the index at the same time; each renames a complete file into place
+    index_path = offset_index_path(path)
+    temp_path = f'{index_path}.tmp-{os.getpid()}'
+    with open(temp_path, 'wb') as file:
+        np.save(file, offsets)
+    os.replace(temp_path, index_path)
+    return offsets
+
+
+def load_offset_index(path):
+    index_path = offset_index_path(path)
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(path):
+        return np.load(index_path)
+    return build_offset_index(path)
+
+
+def iter_records(path, start=0, stop=None):
+    # streams records [start, stop) of a .jsonl or .csv manifest without reading the whole file;
+    # a non-zero start seeks through the offset index instead of scanning
+    base_dir = os.path.dirname(os.path.abspath(path))
+    is_csv = path.endswith('.csv')
+    # binary mode: the index holds byte offsets, while a text file only seeks to its own tell() cookies
+    with open(path, 'rb') as file:
+        fieldnames = next(csv_records(file), (0, []))[1] if is_csv else None
+        if start > 0:
+            offsets = load_offset_index(path)
+            if start >= len(offsets):
+                return
+            file.seek(int(offsets[start]))
+        if is_csv:
+            records = (dict(zip(fieldnames, fields)) for offset, fields in csv_records(file))
+        else:
+            records = (json.loads(line) for line in file if line.strip())
+        index = start
+        for record in records:
+            if stop is not None and index >= stop:
+                return
+            yield index, normalize_record(record, base_dir)
+            index += 1
+
+
+def legacy_records(input_dir, source_info_file, color_info_file, truncate=False):
+    # the old three-input form: sorted *.png in input_dir paired line by line with the two text files
+    images = [f for f in sorted(os.listdir(input_dir)) if f.endswith('.png')]
+    with open(source_info_file, "r") as file:
+        light_directions = [line.strip() for line in file]
+    with open(color_info_file, "r") as file:
+        hair_colors = [line.strip() for line in file]
+    if not len(images) == len(light_directions) == len(hair_colors):
+        message = f'{len(images)} images, {len(light_directions)} light sources and {len(hair_colors)} hair colors do not line up'
+        if not truncate:
+            raise ValueError(message + '; pass truncate=True (--truncate) to pair only the first items')
+        print(f'Warning: {message}, only the first {min(len(images), len(light_directions), len(hair_colors))} are processed')
+    for image, light_source, hair_color in zip(images, light_directions, hair_colors):
+        yield dict(name=image, image=os.path.abspath(os.path.join(input_dir, image)), light_source=light_source, hair_color=hair_color)
+
+
+def write_manifest(records, path):
+    with open(path, 'w') as file:
+        for record in records:
+            file.write(json.dumps(record, ensure_ascii=False) + '\n')
+    build_offset_index(path)
+
+
+parser = argparse.ArgumentParser(description="Translate the old --input_dir/--source_info_file/--color_info_file inputs into a JSONL input manifest")
+parser.add_argument('--input_dir', type=str, required=True, help="Path to the input foreground dir")
+parser.add_argument('--source_info_file', type=str, required=True, help="Path to the light source file")
+parser.add_argument('--color_info_file', type=str, required=True, help="Path to the hair color file")
+parser.add_argument('--output', type=str, required=True, help="Path of the JSONL manifest to write")
+parser.add_argument('--truncate', action='store_true', help="Pair only as many items as the shortest input instead of failing")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    write_manifest(legacy_records(args.input_dir, args.source_info_file, args.color_info_file, truncate=args.truncate), args.output)
@@ -0,0 +1,82 @@
+import json
+import time
+import base64
+import argparse
+import threading
+import numpy as np
+import urllib.error
+import urllib.request
+
+
+def post(url, body, timeout):
+    request = urllib.request.Request(url, data=json.dumps(body).encode(), headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def run_load(url, bodies, concurrency, timeout):
+    # sends bodies from `concurrency` threads as fast as answers come back; returns (latencies, statuses, seconds)
+    latencies = [None] * len(bodies)
+    statuses = [None] * len(bodies)
+    next_index = iter(range(len(bodies)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                index = next(next_index, None)
+            if index is None:
+                return
+            t0 = time.perf_counter()
+            statuses[index] = post(url, bodies[index], timeout)
+            latencies[index] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses, time.perf_counter() - t0
+
+
+parser = argparse.ArgumentParser(description="Local load generator for inference_server.py")
+parser.add_argument('--url', type=str, default='http://127.0.0.1:8000', help="Server base URL")
+parser.add_argument('--endpoint', type=str, default='/fc/relight', help="/fc/relight, /fbc/relight or /fbc/normal")
+parser.add_argument('--input_fg', type=str, required=True, help="Foreground image sent with every request")
+parser.add_argument('--input_bg', type=str, default=None, help="Background image for /fbc/relight")
+parser.add_argument('--prompt', type=str, default='beautiful woman, detailed face, sunshine from window', help="Prompt")
+parser.add_argument('--requests', type=int, default=32, help="Total number of requests")
+parser.add_argument('--concurrency', type=int, default=8, help="Requests in flight at once")
+parser.add_argument('--duplicates', type=float, default=0.0, help="Fraction of requests that repeat an earlier seed (exercises deduplication)")
+parser.add_argument('--params', type=str, default='{}', help="Extra JSON fields sent with every request, e.g. '{\"steps\": 10}'")
+parser.add_argument('--timeout', type=float, default=3600.0, help="Client timeout per request in seconds")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    base = dict(json.loads(args.params), prompt=args.prompt)
+    with open(args.input_fg, 'rb') as file:
+        base['input_fg'] = base64.b64encode(file.read()).decode()
+    if args.input_bg is not None:
+        with open(args.input_bg, 'rb') as file:
+            base['input_bg'] = base64.b64encode(file.read()).decode()
+
+    rng = np.random.default_rng(0)
+    seeds = [i if i == 0 or rng.random() >= args.duplicates else int(rng.integers(i)) for i in range(args.requests)]
+    bodies = [dict(base, seed=seed) for seed in seeds]
+
+    latencies, statuses, elapsed = run_load(args.url.rstrip('/') + args.endpoint, bodies, args.concurrency, args.timeout)
+    ok = [latency for latency, status in zip(latencies, statuses) if status == 200]
+    print(f'{len(ok)}/{args.requests} ok in {elapsed:.2f}s, {args.requests / elapsed:.2f} requests/s')
+    if ok:
+        p50, p95, p99 = np.percentile(ok, [50, 95, 99])
+        print(f'latency p50 {p50:.3f}s  p95 {p95:.3f}s  p99 {p99:.3f}s  max {max(ok):.3f}s')
+    errors = sorted(set(s for s in statuses if s != 200))
+    if errors:
+        print(f'errors: ' + ', '.join(f'{s} x{statuses.count(s)}' for s in errors))
+    with urllib.request.urlopen(args.url.rstrip('/') + '/health') as response:
+        print('server:', response.read().decode())
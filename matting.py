@@ -0,0 +1,209 @@
+import os
+import hashlib
+import argparse
+import numpy as np
+import torch
+
+from PIL import Image
+from briarmbg import BriaRMBG
+from image_utils import preprocess, split_alpha
+from input_manifest import iter_records, normalize_record
+from metrics import stage
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+
+def feed_size(height, width):
+    # about 1024x1024 pixels (256 tiles of 64x64) with the image's aspect ratio, the size run_rmbg has always used;
+    # it depends only on the aspect ratio, so portraits of one camera or crop share a bucket
+    k = (256.0 / float(height * width)) ** 0.5
+    return int(64 * round(width * k)), int(64 * round(height * k))
+
+
+def buckets(imgs, batch_size=8):
+    # (feed size, indices) with the images grouped by feed size, at most batch_size per group. Images are not
+    # padded to a shared size, since BriaRMBG's mask near the border depends on what it sees there.
+    groups = {}
+    for index, img in enumerate(imgs):
+        groups.setdefault(feed_size(*img.shape[:2]), []).append(index)
+    for size, indices in groups.items():
+        for start in range(0, len(indices), batch_size):
+            yield size, indices[start:start + batch_size]
+
+
+@torch.inference_mode()
+def predict_alphas(model, imgs, device, batch_size=8, backend='pil'):
+    # uint8 RGB images of any sizes -> (H, W, 1) float32 alphas in [0, 1] at each image's own resolution,
+    # with one BriaRMBG pass per feed-size bucket instead of one per image
+    alphas = [None] * len(imgs)
+    for (width, height), indices in buckets(imgs, batch_size):
+        feed = preprocess([imgs[i] for i in indices], width, height, device=device, dtype=torch.float32, crop=False, backend=backend)
+        with stage('rmbg'):
+            masks = model.predict_mask(feed).float()
+        for i, mask in zip(indices, masks):
+            H, W = imgs[i].shape[:2]
+            alpha = torch.nn.functional.interpolate(mask[None], size=(H, W), mode="bilinear")
+            alphas[i] = alpha.movedim(1, -1)[0].cpu().numpy().clip(0, 1)
+    return alphas
+
+
+class MissingMask(ValueError):
+    pass
+
+
+def skip_unmasked(loaded, on_missing):
+    # --require_mask: passes on the loaded (record, (img, alpha)) inputs that come with an alpha; every other one
+    # goes to on_missing(record, error) instead, so that one unmasked input does not end the whole batch
+    for record, (img, alpha) in loaded:
+        if alpha is None:
+            on_missing(record, MissingMask(f"{record['image']} has no alpha channel or mask (--require_mask)"))
+            continue
+        yield record, (img, alpha)
+
+
+class MaskCache:
+    # content-addressed alphas on disk: the key is a hash of the image pixels and of version (model and matting
+    # settings), the value an 8-bit PNG. Once over max_bytes, the least recently used entries are removed.
+    # Alphas come back quantised to 1/255 on a miss too, so a rerun gives the same result as the first run.
+    # Workers share the directory and max_bytes: the size is re-measured on disk after every 1% of max_bytes
+    # written here, so the others' entries count too.
+    def __init__(self, cache_dir, version, max_bytes):
+        self.cache_dir = cache_dir
+        self.version = version
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.measure()
+
+    def measure(self):
+        self.total_bytes = sum(size for mtime, size, path in self.entries())
+        self.unmeasured_bytes = 0
+
+    def path(self, img):
+        digest = hashlib.sha256(f'{self.version}:{img.shape}:{img.dtype}'.encode())
+        digest.update(np.ascontiguousarray(img).data)
+        key = digest.hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.png')
+
+    def get(self, img):
+        path = self.path(img)
+        try:
+            alpha = np.array(Image.open(path))
+            os.utime(path)  # mtime is the last use
+        except FileNotFoundError:
+            return None
+        return alpha.astype(np.float32)[..., None] / 255.0
+
+    def put(self, img, alpha):
+        alpha = (alpha[..., 0] * 255.0).round().astype(np.uint8)
+        path = self.path(img)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.tmp-{os.getpid()}'
+        Image.fromarray(alpha).save(temp_path, format='PNG')
+        os.replace(temp_path, path)
+        size = os.path.getsize(path)
+        self.total_bytes += size
+        self.unmeasured_bytes += size
+        if self.unmeasured_bytes > self.max_bytes * 0.01:
+            self.measure()
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+        return alpha.astype(np.float32)[..., None] / 255.0
+
+    def entries(self):
+        result = []
+        for root, dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.png'):
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except FileNotFoundError:
+                        continue  # evicted by another worker meanwhile
+                    result.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+        return result
+
+    def evict(self):
+        # down to 90% of max_bytes, so that not every put() has to rescan the directory
+        entries = sorted(self.entries())
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.total_bytes = total
+        self.unmeasured_bytes = 0
+
+
+def mask_name(name):
+    # file name of an input's mask, as looked up by --mask_dir in the pipeline scripts
+    return os.path.splitext(name)[0] + '.png'
+
+
+def input_records(args):
+    if args.input_manifest is not None:
+        return (record for index, record in iter_records(args.input_manifest))
+    names = sorted(f for f in os.listdir(args.input_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+    return (normalize_record(dict(image=name), args.input_dir) for name in names)
+
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+parser = argparse.ArgumentParser(description="Matting pre-pass: write a BriaRMBG mask for every input, batched by feed size, "
+                                             "for use with --mask_dir of run_ic_light.py / run_ic_light_bg.py")
+parser.add_argument('--input_dir', type=str, default=None, help="Directory of input foregrounds")
+parser.add_argument('--input_manifest', type=str, default=None, help="JSONL/CSV input manifest instead of --input_dir")
+parser.add_argument('--output_dir', type=str, required=True, help="Directory the <name>.png masks are written to")
+parser.add_argument('--model', type=str, default=None, help="BriaRMBG weights, hub name or local directory (default: as in the pipeline scripts)")
+parser.add_argument('--batch_size', type=int, default=8, help="Images of one feed size per BriaRMBG pass")
+parser.add_argument('--chunk_size', type=int, default=256, help="Images decoded and bucketed together")
+parser.add_argument('--rmbg_dtype', type=str, choices=['float32', 'bfloat16', 'float16'], default='float32', help="BriaRMBG precision, as in the pipeline scripts")
+parser.add_argument('--rmbg_channels_last', action='store_true', help="Run BriaRMBG in channels_last memory format")
+parser.add_argument('--preprocess', type=str, choices=['pytorch', 'pil'], default='pil', help="Resize backend, as in the pipeline scripts")
+parser.add_argument('--overwrite', action='store_true', help="Recompute masks that already exist")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if (args.input_dir is None) == (args.input_manifest is None):
+        parser.error("exactly one of --input_dir and --input_manifest is required")
+    model_path = args.model
+    if model_path is None:
+        model_path = '/app/iei-seisaku-pipe-v3/IC-Light/models/briaai-RMBG-1.4'
+        if not os.path.isdir(model_path):
+            model_path = 'briaai/RMBG-1.4'
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    model = BriaRMBG.from_pretrained(model_path).to(device=device, dtype=torch.float32)
+    model.optimize(dtype=getattr(torch, args.rmbg_dtype), channels_last=args.rmbg_channels_last)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    written = skipped = 0
+    for records in chunks(input_records(args), args.chunk_size):
+        todo = []
+        for record in records:
+            path = os.path.join(args.output_dir, mask_name(record['name']))
+            if record['mask'] is not None or (os.path.exists(path) and not args.overwrite):
+                skipped += 1
+                continue
+            img, alpha = split_alpha(Image.open(record['image']))
+            if alpha is not None:
+                skipped += 1  # the input carries its own alpha channel
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            todo.append((path, img))
+        alphas = predict_alphas(model, [img for path, img in todo], device, batch_size=args.batch_size, backend=args.preprocess)
+        for (path, img), alpha in zip(todo, alphas):
+            Image.fromarray((alpha[..., 0] * 255.0).round().astype(np.uint8)).save(path)
+        written += len(todo)
+        print(f'{written} masks written, {skipped} inputs skipped')
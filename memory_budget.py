@@ -0,0 +1,127 @@
+import gc
+import torch
+
+from metrics import MEMORY_FALLBACKS
+
+
+# Rough, deliberately generous per-row estimates of the working memory of each stage, on top of the weights.
+# They only choose how to split a stage up front; a stage that still runs out of memory falls back at run time.
+UNET_ELEMENTS_PER_TOKEN = 320 * 64  # UNet activations at 1/8 resolution, per latent pixel (cfg doubles the rows)
+VAE_DECODE_ELEMENTS_PER_PIXEL = 1024  # decoder up blocks at full resolution, per output pixel
+VAE_ENCODE_ELEMENTS_PER_PIXEL = 512
+
+
+def unet_row_bytes(width, height, dtype):
+    tokens = (width // 8) * (height // 8)
+    return 2 * tokens * UNET_ELEMENTS_PER_TOKEN * dtype.itemsize
+
+
+def vae_row_bytes(width, height, dtype, decode):
+    # the mid-block self-attention over all latent pixels has a single head, so its scores are tokens²
+    tokens = (width // 8) * (height // 8)
+    elements = VAE_DECODE_ELEMENTS_PER_PIXEL if decode else VAE_ENCODE_ELEMENTS_PER_PIXEL
+    return (width * height * elements + tokens * tokens) * dtype.itemsize
+
+
+def current_bytes(device):
+    # memory the process holds now: allocated CUDA memory, or the resident set on the CPU
+    if device.type == 'cuda':
+        return torch.cuda.memory_allocated(device)
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def halvings(n):
+    # n, n // 2, ..., 1
+    result = [n]
+    while n > 1:
+        n //= 2
+        result.append(n)
+    return result
+
+
+class MemoryBudget:
+    # plans how each stage is split so that the process stays under budget_bytes (device memory on CUDA, resident
+    # set on the CPU). Every plan is a list of options, most preferred first; with_fallbacks() moves on to the next
+    # one when a stage runs out of memory anyway. Without a budget the first option is the unsplit stage.
+    def __init__(self, device, budget_bytes=None):
+        self.device = torch.device(device)
+        self.budget_bytes = budget_bytes
+
+    def available(self):
+        return self.budget_bytes - current_bytes(self.device)
+
+    def unet_micro_batches(self, rows, width, height, dtype, stage):
+        micro_batch = rows
+        if self.budget_bytes is not None:
+            micro_batch = int(max(1, min(rows, self.available() // unet_row_bytes(width, height, dtype))))
+            if micro_batch < rows:
+                MEMORY_FALLBACKS.inc(stage=stage, reason='budget')
+        return halvings(micro_batch)
+
+    def vae_modes(self, rows, width, height, dtype, decode, tile_size, stage):
+        # 'batch': all rows at once, 'slices': one row at a time, 'tiles': one row at a time in overlapping tiles
+        modes = ['batch', 'slices', 'tiles'] if rows > 1 else ['batch', 'tiles']
+        if self.budget_bytes is None:
+            return modes
+        available = self.available()
+        needs = {'batch': rows * vae_row_bytes(width, height, dtype, decode),
+                 'slices': vae_row_bytes(width, height, dtype, decode),
+                 'tiles': vae_row_bytes(min(width, tile_size), min(height, tile_size), dtype, decode)}
+        start = next((i for i, mode in enumerate(modes) if needs[mode] <= available), len(modes) - 1)
+        if start > 0:
+            MEMORY_FALLBACKS.inc(stage=stage, reason='budget')
+        return modes[start:]
+
+
+def is_out_of_memory(e):
+    if isinstance(e, (torch.cuda.OutOfMemoryError, MemoryError)):
+        return True
+    return isinstance(e, RuntimeError) and ('out of memory' in str(e) or "can't allocate memory" in str(e))
+
+
+def free_memory():
+    gc.collect()
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        torch.cuda.empty_cache()
+
+
+def with_fallbacks(run, options, stage, generators=()):
+    # run(option) with the first option; after an out-of-memory error the random generators are rewound and the
+    # next option is tried, so one oversized stage does not fail the whole batch
+    states = [generator.get_state() for generator in generators]
+    for option in options[:-1]:
+        try:
+            return run(option)
+        except (RuntimeError, MemoryError) as e:
+            if not is_out_of_memory(e):
+                raise
+        # outside the except block, so that the traceback no longer holds the failed attempt's tensors
+        MEMORY_FALLBACKS.inc(stage=stage, reason='out_of_memory')
+        free_memory()
+        for generator, state in zip(generators, states):
+            generator.set_state(state)
+    return run(options[-1])
+
+
+def vae_encode(vae, pixels, mode):
+    # latent_dist.mode() of vae.encode(pixels), computed as planned by MemoryBudget.vae_modes()
+    if mode == 'batch':
+        return vae.encode(pixels).latent_dist.mode()
+    if mode == 'slices':
+        return torch.cat([vae.encode(x).latent_dist.mode() for x in pixels.split(1)])
+    return torch.cat([vae.tiled_encode(x).latent_dist.mode() for x in pixels.split(1)])
+
+
+def vae_decode(vae, latents, mode):
+    if mode == 'batch':
+        return vae.decode(latents).sample
+    if mode == 'slices':
+        return torch.cat([vae.decode(z).sample for z in latents.split(1)])
+    return torch.cat([vae.tiled_decode(z).sample for z in latents.split(1)])
@@ -0,0 +1,255 @@
+import os
+import time
+import bisect
+import atexit
+import resource
+import threading
+import contextlib
+import torch
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+_metrics = []
+_exporters = {}  # (kind, target, pid) -> metrics server or file path started in this process
+
+
+def format_labels(labels):
+    # labels is a tuple of (name, value) pairs
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name + '_total', key, value) for key, value in self.values.items()]
+
+
+class Gauge:
+    # either set() explicitly or computed at scrape time by a function returning {labels tuple: value}
+    kind = 'gauge'
+
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.lock = threading.Lock()
+        self.values = {}
+        _metrics.append(self)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        if self.function is not None:
+            values.update(self.function())
+        return [(self.name, key, value) for key, value in values.items()]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.values = {}
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        samples = []
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', key + (('le', '+Inf' if bound == float('inf') else repr(bound)),), cumulative))
+            samples.append((self.name + '_count', key, cumulative))
+            samples.append((self.name + '_sum', key, total))
+        return samples
+
+
+def peak_rss():
+    # VmHWM, which reset_peak_memory() can reset, where /proc has it; ru_maxrss (KiB on Linux) otherwise
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_memory():
+    # starts the high-water marks afresh, e.g. once the models are set up, so they show what processing needs
+    # rather than the peak of loading and merging the weights
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        for index in range(torch.cuda.device_count()):
+            torch.cuda.reset_peak_memory_stats(index)
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+
+def device_memory():
+    values = {}
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        for index in range(torch.cuda.device_count()):
+            values[(('device', f'cuda:{index}'),)] = torch.cuda.max_memory_allocated(index)
+    values[(('device', 'cpu'),)] = peak_rss()
+    return values
+
+
+def memory_report():
+    return ', '.join(f'{labels[0][1]} {value / 2**30:.2f} GiB' for labels, value in device_memory().items())
+
+
+# Metrics fed by the pipeline scripts, the inference server and the gradio demos
+STAGE_SECONDS = Histogram('iclight_stage_seconds', 'Wall time of each pipeline stage (device work included)')
+QUEUE_WAIT_SECONDS = Histogram('iclight_queue_wait_seconds', 'Time a request or input waited before processing started')
+BATCH_SIZE = Histogram('iclight_batch_size', 'Requests per UNet batch', buckets=(1, 2, 4, 8, 16, 32))
+ITEMS = Counter('iclight_items', 'Processed inputs or requests by status')
+IMAGES = Counter('iclight_images', 'Result images produced')
+CACHE_REQUESTS = Counter('iclight_cache_requests', 'Cache lookups by cache and result (hit or miss)')
+MEMORY_FALLBACKS = Counter('iclight_memory_fallbacks', 'Stages split into micro-batches, slices or tiles, by stage and reason (budget or out_of_memory)')
+QUEUE_DEPTH = Gauge('iclight_queue_depth', 'Requests or inputs waiting to be processed, by queue')
+DEVICE_MAX_MEMORY = Gauge('iclight_device_max_memory_bytes', 'High-water mark of allocated device memory (peak RSS for the CPU); the pipeline scripts and the server reset it once the models are set up', function=device_memory)
+
+
+@contextlib.contextmanager
+def stage(name):
+    # times a pipeline stage; waits for queued CUDA kernels so the time lands in the stage that issued them
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+        STAGE_SECONDS.observe(time.perf_counter() - t0, stage=name)
+
+
+def cache_lookup(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+    return hit
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        for name, labels, value in metric.samples():
+            lines.append(f'{name}{format_labels(labels)} {value}')
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        data = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port, host='127.0.0.1'):
+    # /metrics on a background thread, for a local Prometheus-compatible scraper. Started once per process and
+    # address: later calls (e.g. the next job of inference_daemon.py) get the running server back
+    key = ('http', (host, port), os.getpid())
+    if key not in _exporters:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        _exporters[key] = server
+    return _exporters[key]
+
+
+def write_metrics(path):
+    temp_path = f'{path}.tmp-{os.getpid()}'
+    with open(temp_path, 'w') as file:
+        file.write(render())
+    os.replace(temp_path, path)
+
+
+def start_file_exporter(path, interval=15.0):
+    # rewrites path atomically every interval seconds and once more at exit (textfile-collector style);
+    # once per process and path, like serve_metrics()
+    key = ('file', path, os.getpid())
+    if key in _exporters:
+        return
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            write_metrics(path)
+
+    threading.Thread(target=loop, name='metrics-file', daemon=True).start()
+    atexit.register(write_metrics, path)
+    _exporters[key] = path
+
+
+def timed_iter(iterable, histogram=QUEUE_WAIT_SECONDS, **labels):
+    # observes how long each next() blocks, e.g. the main loop waiting for prefetched inputs
+    iterator = iter(iterable)
+    while True:
+        t0 = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        histogram.observe(time.perf_counter() - t0, **labels)
+        yield item
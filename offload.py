@@ -0,0 +1,86 @@
+import os
+import threading
+import contextlib
+import torch
+
+
+class ExecutionDevice:
+    # stands in for accelerate's hook on an offloaded model: diffusers pipelines take their device from
+    # model._hf_hook.execution_device instead of from the weights, which may be on the CPU or not loaded
+    def __init__(self, device):
+        self.execution_device = device
+
+
+class ModelResidency:
+    # sequential model residency: of the models added, only the one in use() is held on the device.
+    # On CUDA the others wait in CPU memory. On the CPU their weights are dropped (replaced by meta tensors)
+    # and memory-mapped back from their weights file when next used; mapped pages belong to the page cache,
+    # so they are not part of the process' memory while the model is idle and are shared between processes.
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.lock = threading.RLock()
+        self.paths = {}
+        self.active = None
+        self.stack = []  # models of the open use() blocks; only the thread holding the lock has any open
+
+    def add(self, model, path=None, key=None):
+        # path: the weights file (CPU only); key identifies the weights (e.g. model names and files), and the
+        # file is rewritten when it changes
+        with self.lock:
+            model._hf_hook = ExecutionDevice(self.device)
+            if self.device.type == 'cpu':
+                if not self.saved(path, key):
+                    temp_path = f'{path}.tmp-{os.getpid()}'
+                    torch.save(dict(key=key, state=model.state_dict()), temp_path)
+                    os.replace(temp_path, path)
+                self.paths[id(model)] = path
+            if model is not self.active:
+                self.release(model)
+        return model
+
+    def remove(self, model):
+        # forgets a model that is being replaced; waits for the use() blocks of other threads
+        with self.lock:
+            if model is self.active:
+                self.release(model)
+                self.active = None
+            self.paths.pop(id(model), None)
+
+    def saved(self, path, key):
+        if not os.path.exists(path):
+            return False
+        return torch.load(path, mmap=True, weights_only=True).get('key') == key
+
+    def release(self, model):
+        if self.device.type == 'cpu':
+            model.load_state_dict({k: v.to('meta') for k, v in model.state_dict().items()}, assign=True)
+        else:
+            model.to('cpu')
+
+    def load(self, model):
+        if self.device.type == 'cpu':
+            model.load_state_dict(torch.load(self.paths[id(model)], mmap=True, weights_only=True)['state'], assign=True)
+        else:
+            model.to(self.device)
+
+    @contextlib.contextmanager
+    def use(self, model):
+        # model is on the device inside the block; other threads wait for it. Nested blocks in the same thread
+        # switch models and switch back on exit. After the outermost block the model stays until another is used.
+        with self.lock:
+            self.stack.append(model)
+            self.switch(model)
+            try:
+                yield model
+            finally:
+                self.stack.pop()
+                if self.stack:
+                    self.switch(self.stack[-1])
+
+    def switch(self, model):
+        if model is self.active:
+            return
+        if self.active is not None:
+            self.release(self.active)
+        self.load(model)
+        self.active = model
@@ -0,0 +1,106 @@
+import os
+import glob
+import time
+import shlex
+import argparse
+import tempfile
+import importlib
+import numpy as np
+import db_examples
+
+from PIL import Image
+from image_utils import split_alpha, psnr, ssim
+
+
+# Output quality and latency of the pipeline's speed options (e.g. --int8) against a reference run. Every example
+# is relit with the reference arguments, then with the candidate arguments (the options this script does not know
+# itself), with the same seed and matting, and the results are compared by PSNR and SSIM. The check fails when the
+# mean PSNR or the lowest SSIM falls below the given bounds. Options that change the models, such as --int8,
+# cannot be undone in the process, so the reference always runs first. With --examples the examples are those of the
+# gradio demos (db_examples.py), each with its own prompt, size and seed.
+
+
+def load_items(pattern, num_images, light_source):
+    paths = sorted(glob.glob(pattern))[:num_images]
+    items = []
+    for path in paths:
+        img, alpha = split_alpha(Image.open(path))
+        record = dict(name=os.path.basename(path), image=path, mask=None, light_source=light_source, hair_color='', overrides={})
+        items.append((record, img, alpha))
+    return items
+
+
+def load_db_examples(script, num_images):
+    # gradio demo examples: (image, prompt, light, width, height, seed, output) for run_ic_light; the background
+    # examples also name a background image, which run_ic_light_bg.py has no input for (it relights on gray)
+    if script == 'run_ic_light_bg':
+        examples = [[image] + rest for image, background, *rest in db_examples.background_conditioned_examples]
+    else:
+        examples = db_examples.foreground_conditioned_examples
+    items = []
+    for n, (image, prompt, light, width, height, seed, _) in enumerate(examples[:num_images]):
+        img, alpha = split_alpha(Image.open(image))
+        light_source = {'Left Light': 'Left', 'Right Light': 'Right'}.get(light, '')
+        overrides = dict(prompt=prompt, image_width=width, image_height=height, seed=seed)
+        record = dict(name=f'{n}:{os.path.basename(image)}', image=image, mask=None, light_source=light_source, hair_color='', overrides=overrides)
+        items.append((record, img, alpha))
+    return items
+
+
+def run(module, cli_args, items):
+    # relights every item with cli_args; returns the result images and seconds per item
+    module.args = cli_args
+    module.apply_model_options()
+    outputs = []
+    seconds = []
+    for record, img, alpha in items:
+        t0 = time.perf_counter()
+        outputs.append(module.relight(img, alpha, record, module.item_arguments(record)))
+        seconds.append(time.perf_counter() - t0)
+    return outputs, seconds
+
+
+parser = argparse.ArgumentParser(description="Compare the relighting results of pipeline options with a reference run by PSNR/SSIM and time. "
+                                             "Arguments not listed here are the candidate's pipeline arguments, e.g. --int8.")
+parser.add_argument('--script', type=str, default='run_ic_light', help="Pipeline module (run_ic_light or run_ic_light_bg)")
+parser.add_argument('--images', type=str, default='imgs/i*.png', help="Glob of the example foregrounds")
+parser.add_argument('--examples', action='store_true', help="Use the examples of the gradio demos (db_examples.py) with their prompts, sizes and seeds instead of --images")
+parser.add_argument('--num_images', type=int, default=4, help="Use the first this many examples")
+parser.add_argument('--prompt', type=str, default='beautiful woman, detailed face, sunshine from window', help="Prompt for both runs")
+parser.add_argument('--light_source', type=str, default='Left', help="Light source of every example (run_ic_light)")
+parser.add_argument('--reference', type=str, default='', help="Pipeline arguments of the reference run, as one string")
+parser.add_argument('--min_psnr', type=float, default=25.0, help="Minimum mean PSNR in dB")
+parser.add_argument('--min_ssim', type=float, default=0.85, help="Minimum SSIM of any result")
+
+if __name__ == '__main__':
+    args, candidate_argv = parser.parse_known_args()
+    module = importlib.import_module(args.script)
+    if args.examples:
+        items = load_db_examples(args.script, args.num_images)
+    else:
+        items = load_items(args.images, args.num_images, args.light_source)
+    if not items:
+        raise SystemExit(f'no images match {args.images}')
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        base_argv = ['--output_dir', output_dir, '--prompt', args.prompt]
+        reference_args = module.parser.parse_args(base_argv + shlex.split(args.reference))
+        candidate_args = module.parser.parse_args(base_argv + shlex.split(args.reference) + candidate_argv)
+        reference, reference_seconds = run(module, reference_args, items)
+        candidate, candidate_seconds = run(module, candidate_args, items)
+
+    print(f"{'image':<24}{'ref s':>8}{'cand s':>8}{'PSNR dB':>9}{'SSIM':>8}")
+    psnrs = []
+    ssims = []
+    for (record, img, alpha), ref, cand, ref_s, cand_s in zip(items, reference, candidate, reference_seconds, candidate_seconds):
+        values = [(psnr(a, b), ssim(a, b)) for a, b in zip(ref, cand)]
+        psnrs += [p for p, s in values]
+        ssims += [s for p, s in values]
+        print(f"{record['name']:<24}{ref_s:>8.1f}{cand_s:>8.1f}{np.mean([p for p, s in values]):>9.2f}{min(s for p, s in values):>8.4f}")
+
+    speedup = sum(reference_seconds) / sum(candidate_seconds)
+    mean_psnr = float(np.mean(np.minimum(psnrs, 100.0)))  # identical results count as 100 dB
+    ok = mean_psnr >= args.min_psnr and min(ssims) >= args.min_ssim
+    print(f"candidate {' '.join(candidate_argv) or '(same arguments)'}: {speedup:.2f}x speed, mean PSNR {mean_psnr:.2f} dB, "
+          f"min SSIM {min(ssims):.4f}  {'ok' if ok else 'FAIL'}")
+    raise SystemExit(0 if ok else 1)
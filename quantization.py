@@ -0,0 +1,60 @@
+import os
+import torch
+import torch.nn as nn
+import torch.ao.nn.quantized.dynamic as nnqd
+
+
+def replace_linear(module, make):
+    # replaces every nn.Linear below module (subclasses included, e.g. diffusers' LoRACompatibleLinear) by make(linear)
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            setattr(module, name, make(child))
+        else:
+            replace_linear(child, make)
+    return module
+
+
+def int8_linear(linear):
+    # dynamic int8: weights quantised symmetrically per output channel once, activations per batch at run time
+    weight = linear.weight.detach().float()
+    scales = (weight.abs().amax(dim=1) / 127.0).clamp(min=1e-8).double()
+    zero_points = torch.zeros(weight.shape[0], dtype=torch.long)
+    qweight = torch.quantize_per_channel(weight, scales, zero_points, 0, torch.qint8)
+    qlinear = nnqd.Linear(linear.in_features, linear.out_features, bias_=linear.bias is not None, dtype=torch.qint8)
+    qlinear.set_weight_bias(qweight, None if linear.bias is None else linear.bias.detach().float())
+    return qlinear
+
+
+def linear_names(module):
+    return {name for name, child in module.named_modules() if isinstance(child, nn.Linear)}
+
+
+def empty_int8_linear(linear):
+    return nnqd.Linear(linear.in_features, linear.out_features, bias_=linear.bias is not None, dtype=torch.qint8)
+
+
+def quantize_int8(modules, cache_path, key):
+    # quantises the Linear layers of {name: module} in place (CPU only). The int8 weights are cached in cache_path
+    # and reused while key (which should identify the float weights) is unchanged.
+    cached = None
+    if os.path.exists(cache_path):
+        cached = torch.load(cache_path, weights_only=False)
+        # a cache written for other modules or layers is a miss too, checked before any module is touched
+        layers = cached.get('layers', {})
+        if cached.get('key') != key or any(set(layers.get(name, {})) != linear_names(module) for name, module in modules.items()):
+            cached = None
+    states = {}
+    for name, module in modules.items():
+        if cached is not None:
+            replace_linear(module, empty_int8_linear)
+            layers = dict(module.named_modules())
+            for layer_name, state in cached['layers'][name].items():
+                layers[layer_name].load_state_dict(state)
+        else:
+            replace_linear(module, int8_linear)
+            states[name] = {n: m.state_dict() for n, m in module.named_modules() if isinstance(m, nnqd.Linear)}
+    if cached is None:
+        temp_path = f'{cache_path}.tmp-{os.getpid()}'
+        torch.save(dict(key=key, layers=states), temp_path)
+        os.replace(temp_path, cache_path)
+    return cached is not None
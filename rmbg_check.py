@@ -0,0 +1,99 @@
+import os
+import copy
+import glob
+import time
+import argparse
+import numpy as np
+import torch
+
+from PIL import Image
+from briarmbg import BriaRMBG
+from image_utils import preprocess
+from matting import feed_size
+
+
+# Mask accuracy and latency of the BriaRMBG inference configurations (BatchNorm folded into the convs,
+# reduced precision, channels_last) against the unmodified float32 model, on the example images.
+# A configuration fails when its mean IoU (masks thresholded at 0.5) or its worst MAE is out of bounds.
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+
+def load_images(pattern):
+    paths = sorted(p for p in glob.glob(pattern, recursive=True) if p.lower().endswith(IMAGE_EXTENSIONS))
+    return [(p, np.array(Image.open(p).convert('RGB'))) for p in paths]
+
+
+def feeds(images, device):
+    return [preprocess([img], *feed_size(*img.shape[:2]), device=device, dtype=torch.float32, crop=False) for path, img in images]
+
+
+@torch.inference_mode()
+def masks(model, inputs, device):
+    # masks as float32 numpy arrays and the median seconds per image
+    results = []
+    timings = []
+    for feed in inputs:
+        model.predict_mask(feed)  # warm-up for this shape
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        t0 = time.perf_counter()
+        mask = model.predict_mask(feed)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        timings.append(time.perf_counter() - t0)
+        results.append(mask.float().cpu().numpy()[0, 0])
+    return results, float(np.median(timings))
+
+
+def iou(a, b, threshold=0.5):
+    a = a >= threshold
+    b = b >= threshold
+    union = np.logical_or(a, b).sum()
+    return 1.0 if union == 0 else float(np.logical_and(a, b).sum() / union)
+
+
+parser = argparse.ArgumentParser(description="Check BriaRMBG masks of the fused / reduced-precision / channels_last modes against float32")
+parser.add_argument('--model', type=str, default='briaai/RMBG-1.4', help="BriaRMBG weights (hub name or local directory)")
+parser.add_argument('--images', type=str, default='imgs/**/*', help="Glob of the images to check")
+parser.add_argument('--dtypes', type=str, nargs='+', choices=['float32', 'bfloat16', 'float16'], default=['float32', 'bfloat16', 'float16'], help="Precisions to check")
+parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help="Device to run on")
+parser.add_argument('--threads', type=int, default=None, help="torch intra-op threads")
+parser.add_argument('--min_iou', type=float, default=0.98, help="Minimum mean IoU against float32")
+parser.add_argument('--max_mae', type=float, default=0.01, help="Maximum per-image mean absolute error against float32")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+
+    images = load_images(args.images)
+    if not images:
+        raise SystemExit(f'no images match {args.images}')
+    inputs = feeds(images, device)
+    reference = BriaRMBG.from_pretrained(args.model).to(device=device, dtype=torch.float32).eval()
+    reference_masks, reference_time = masks(reference, inputs, device)
+    print(f'{len(images)} images from {args.images}, float32 reference {reference_time * 1000:.1f} ms/image')
+
+    failed = 0
+    print(f"{'configuration':<28}{'ms/image':>10}{'speedup':>9}{'mean IoU':>10}{'min IoU':>9}{'max MAE':>9}  status")
+    for dtype in args.dtypes:
+        for channels_last in (False, True):
+            name = f"fused {dtype}{' channels_last' if channels_last else ''}"
+            model = copy.deepcopy(reference).optimize(dtype=getattr(torch, dtype), channels_last=channels_last)
+            try:
+                candidate_masks, candidate_time = masks(model, inputs, device)
+            except RuntimeError as e:
+                print(f'{name:<28}  not supported on {device.type}: {e}')
+                continue
+            ious = [iou(a, b) for a, b in zip(reference_masks, candidate_masks)]
+            maes = [float(np.abs(a - b).mean()) for a, b in zip(reference_masks, candidate_masks)]
+            ok = np.mean(ious) >= args.min_iou and max(maes) <= args.max_mae
+            failed += 0 if ok else 1
+            print(f'{name:<28}{candidate_time * 1000:>10.1f}{reference_time / candidate_time:>9.2f}{np.mean(ious):>10.4f}{min(ious):>9.4f}{max(maes):>9.4f}  {"ok" if ok else "FAIL"}')
+            if not ok:
+                worst = int(np.argmax(maes))
+                print(f'  worst image: {os.path.relpath(images[worst][0])} (IoU {ious[worst]:.4f}, MAE {maes[worst]:.4f})')
+
+    raise SystemExit(1 if failed else 0)
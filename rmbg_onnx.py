@@ -0,0 +1,124 @@
+import os
+import copy
+import glob
+import time
+import argparse
+import numpy as np
+import torch
+
+from PIL import Image
+from briarmbg import BriaRMBG
+from image_utils import preprocess
+from matting import feed_size, IMAGE_EXTENSIONS
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+class MaskGraph(torch.nn.Module):
+    # the graph that gets exported: image batch -> d1 mask, nothing else
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image):
+        return self.model.predict_mask(image)
+
+
+def export(model, path, opset=17):
+    # BriaRMBG (float32, BatchNorm folded) -> ONNX with dynamic batch and spatial axes; folds a copy, the
+    # caller's model keeps its dtype and weights. Written to a temp file first so a concurrent load() never
+    # sees a half-written model
+    model = copy.deepcopy(model).float().eval().optimize()
+    axes = {0: 'batch', 2: 'height', 3: 'width'}
+    example = torch.zeros(1, 3, 1024, 768)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = f'{path}.tmp-{os.getpid()}'
+    with torch.inference_mode():
+        torch.onnx.export(MaskGraph(model), (example,), temp_path, input_names=['image'], output_names=['mask'],
+                          dynamic_axes={'image': axes, 'mask': axes}, opset_version=opset, dynamo=False)
+    os.replace(temp_path, path)
+    return path
+
+
+class OnnxRMBG:
+    # onnxruntime stand-in for BriaRMBG in predict_alphas(): predict_mask() takes and returns torch tensors
+    def __init__(self, path, threads=None):
+        self.path = path
+        self.threads = threads
+        self.session = None
+        self.pid = None
+
+    def get_session(self):
+        # created on first use in each process: an onnxruntime session does not survive fork(), and a forked
+        # CPU worker should only use its share of the cores (torch.get_num_threads() is set per worker)
+        if self.session is None or self.pid != os.getpid():
+            options = onnxruntime.SessionOptions()
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            options.intra_op_num_threads = self.threads or torch.get_num_threads()
+            self.session = onnxruntime.InferenceSession(self.path, options, providers=['CPUExecutionProvider'])
+            self.pid = os.getpid()
+        return self.session
+
+    def predict_mask(self, x):
+        mask = self.get_session().run(None, {'image': x.detach().float().cpu().numpy()})[0]
+        return torch.from_numpy(mask).to(x.device)
+
+
+def load(path, model_path, threads=None):
+    # the ONNX engine for path, exporting it from the BriaRMBG weights at model_path first if needed
+    if not os.path.exists(path):
+        export(BriaRMBG.from_pretrained(model_path), path)
+    return OnnxRMBG(path, threads=threads)
+
+
+def median_seconds(fn, repeat):
+    fn()
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - t0)
+    return float(np.median(timings))
+
+
+parser = argparse.ArgumentParser(description="Export BriaRMBG to ONNX and check the onnxruntime engine against PyTorch (max abs mask difference and latency)")
+parser.add_argument('--model', type=str, default='briaai/RMBG-1.4', help="BriaRMBG weights (hub name or local directory)")
+parser.add_argument('--output', type=str, default='./models/briarmbg.onnx', help="Path of the ONNX model")
+parser.add_argument('--opset', type=int, default=17, help="ONNX opset")
+parser.add_argument('--images', type=str, default='imgs/**/*', help="Glob of the images to check on")
+parser.add_argument('--max_diff', type=float, default=1e-3, help="Largest allowed absolute mask difference")
+parser.add_argument('--repeat', type=int, default=3, help="Timed runs per image")
+parser.add_argument('--threads', type=int, default=None, help="Intra-op threads for both engines")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if onnxruntime is None:
+        raise SystemExit('onnxruntime is not installed (pip install onnxruntime)')
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    model = BriaRMBG.from_pretrained(args.model).float().eval().optimize()
+    export(model, args.output, opset=args.opset)
+    print(f'exported {args.output}')
+    engine = OnnxRMBG(args.output, threads=args.threads)
+
+    paths = sorted(p for p in glob.glob(args.images, recursive=True) if p.lower().endswith(IMAGE_EXTENSIONS))
+    worst = 0.0
+    torch_seconds = []
+    onnx_seconds = []
+    with torch.inference_mode():
+        for path in paths:
+            img = np.array(Image.open(path).convert('RGB'))
+            feed = preprocess([img], *feed_size(*img.shape[:2]), device='cpu', dtype=torch.float32, crop=False)
+            diff = float((model.predict_mask(feed) - engine.predict_mask(feed)).abs().max())
+            worst = max(worst, diff)
+            torch_seconds.append(median_seconds(lambda: model.predict_mask(feed), args.repeat))
+            onnx_seconds.append(median_seconds(lambda: engine.predict_mask(feed), args.repeat))
+            print(f'{os.path.relpath(path):<40}{tuple(feed.shape[2:])!s:>14}  max diff {diff:.2e}  '
+                  f'torch {torch_seconds[-1] * 1000:.1f} ms  onnxruntime {onnx_seconds[-1] * 1000:.1f} ms')
+    if paths:
+        print(f'{len(paths)} images: max diff {worst:.2e}, torch {np.median(torch_seconds) * 1000:.1f} ms, '
+              f'onnxruntime {np.median(onnx_seconds) * 1000:.1f} ms median per image')
+    raise SystemExit(0 if worst <= args.max_diff else 1)
@@ -1,5 +1,8 @@
 import os
+import glob
 import math
+import threading
+import contextlib
 import numpy as np
 import torch
 import safetensors.torch as sf
@@ -11,6 +14,19 @@ from diffusers import AutoencoderKL, UNet2DConditionModel, DDIMScheduler, EulerA
 from diffusers.models.attention_processor import AttnProcessor2_0
 from transformers import CLIPTextModel, CLIPTokenizer
 from briarmbg import BriaRMBG
+import rmbg_onnx
+from batch_io import prefetch, AsyncWriter, open_sink
+from run_manifest import RunManifest, latents_key, save_latents_checkpoint, load_latents_checkpoint, save_input_checkpoint, load_input_checkpoint
+from input_manifest import iter_records, legacy_records, normalize_record
+from matting import predict_alphas, mask_name, MaskCache, MissingMask, skip_unmasked
+from quantization import quantize_int8
+from offload import ModelResidency
+from attention import ChunkedAttnProcessor
+from memory_budget import MemoryBudget, with_fallbacks, vae_encode, vae_decode
+from work_queue import parse_shard, static_shard, default_worker_id, LockFileQueue
+from worker_pool import share_weights, fork_workers, TicketCounter, StageHandoff, claim_in_order
+from metrics import stage, cache_lookup, timed_iter, serve_metrics, start_file_exporter, reset_peak_memory, memory_report, ITEMS, IMAGES
+from image_utils import pytorch2numpy, preprocess, preprocess_images, split_alpha, upscale_decoded, resize_and_center_crop, make_gradient, gray_to_rgb, composite_alpha, estimate_normal
 from enum import Enum
 from torch.hub import download_url_to_file
 
@@ -26,7 +42,7 @@ if os.path.isdir("/app/iei-seisaku-pipe-v3"):
     text_encoder = CLIPTextModel.from_pretrained(f"{local_sd15_path}/text_encoder")
     vae = AutoencoderKL.from_pretrained(f"{local_sd15_path}/vae")
     unet = UNet2DConditionModel.from_pretrained(f"{local_sd15_path}/unet")
-    rmbg = BriaRMBG.from_pretrained(local_rmbg_path)
+    rmbg_path = local_rmbg_path
 else:
     # 'stablediffusionapi/realistic-vision-v51'
     # 'runwayml/stable-diffusion-v1-5'
@@ -35,7 +51,7 @@ else:
     text_encoder = CLIPTextModel.from_pretrained(sd15_name, subfolder="text_encoder")
     vae = AutoencoderKL.from_pretrained(sd15_name, subfolder="vae")
     unet = UNet2DConditionModel.from_pretrained(sd15_name, subfolder="unet")
-    rmbg = BriaRMBG.from_pretrained("briaai/RMBG-1.4")
+    rmbg_path = "briaai/RMBG-1.4"
 
 # Change UNet
 
@@ -77,17 +93,144 @@ del sd_offset, sd_origin, sd_merged, keys
 
 # Device
 
-device = torch.device('cuda')
-text_encoder = text_encoder.to(device=device, dtype=torch.float16)
-vae = vae.to(device=device, dtype=torch.bfloat16)
-unet = unet.to(device=device, dtype=torch.float16)
-rmbg = rmbg.to(device=device, dtype=torch.float32)
+device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+# CPU では半精度の畳み込みが遅いため float32 のまま
+text_encoder = text_encoder.to(device=device, dtype=torch.float16 if device.type == 'cuda' else torch.float32)
+vae = vae.to(device=device, dtype=torch.bfloat16 if device.type == 'cuda' else torch.float32)
+unet = unet.to(device=device, dtype=torch.float16 if device.type == 'cuda' else torch.float32)
+
+# BriaRMBG はマスクの無い入力が来たときに初めて読み込む (RGBA 入力やマスク指定だけなら読み込まない)
+# 読み込み時に BatchNorm を conv に畳み込み、--rmbg_dtype / --rmbg_channels_last を適用する
+# --rmbg_onnx を指定し onnxruntime が入っていれば、エクスポートした ONNX モデルを onnxruntime で動かす
+rmbg = None
+rmbg_key = None  # rmbg を読み込んだときの rmbg_engine() (ONNX ならファイルも)
+rmbg_lock = threading.Lock()
+mask_cache = None
+
+
+def rmbg_engine():
+    # load_rmbg() が使うエンジン。エンジンごとにマスクが僅かに異なるため、マスクキャッシュのキーに含める
+    if args.rmbg_onnx is not None and device.type == 'cpu' and rmbg_onnx.onnxruntime is not None:
+        return 'onnx'
+    return f"torch:{args.rmbg_dtype}:{'channels_last' if args.rmbg_channels_last else 'contiguous'}"
+
+
+def load_rmbg():
+    # 後のジョブ (inference_daemon.py, quality_check.py の候補) がエンジンを変えたら読み込み直す
+    # 古いエンジンのマスクが新しいエンジンのキーでマスクキャッシュに入らないようにするため
+    global rmbg, rmbg_key
+    with rmbg_lock:
+        engine = rmbg_engine()
+        # ONNX はファイルごとに別のモデル (--rmbg_onnx を別のファイルに変えたジョブも読み込み直す)
+        key = (engine, os.path.abspath(args.rmbg_onnx)) if engine == 'onnx' else engine
+        if rmbg is not None and rmbg_key != key:
+            if residency is not None and isinstance(rmbg, torch.nn.Module):
+                residency.remove(rmbg)
+            rmbg = None
+        if rmbg is None and engine == 'onnx':
+            rmbg = rmbg_onnx.load(args.rmbg_onnx, rmbg_path)
+        if rmbg is None:
+            if args.rmbg_onnx is not None and device.type == 'cpu':
+                print('onnxruntime is not installed, running BriaRMBG with PyTorch')
+            rmbg = BriaRMBG.from_pretrained(rmbg_path).to(device=device, dtype=torch.float32)
+            rmbg.optimize(dtype=getattr(torch, args.rmbg_dtype), channels_last=args.rmbg_channels_last)
+            if residency is not None:
+                residency.add(rmbg, f'{offload_prefix}.rmbg.pt', key=(rmbg_path, engine))
+        rmbg_key = key
+    return rmbg
+
+
+# --int8 (CPU のみ): マージ済みの UNet と text encoder の Linear を int8 の動的量子化に置き換える
+# 量子化した重みは IC-Light モデルの隣 (<model>.int8.pt) にキャッシュし、モデルが変わらない限り再利用する
+models_int8 = False
+
+
+def quantize_models():
+    global models_int8
+    if not models_int8:
+        stat = os.stat(model_path)
+        key = (unet.config._name_or_path, text_encoder.config._name_or_path, os.path.abspath(model_path), stat.st_size, stat.st_mtime)
+        quantize_int8(dict(unet=unet, text_encoder=text_encoder), os.path.splitext(model_path)[0] + '.int8.pt', key)
+        models_int8 = True
+
+
+# --offload: デバイスには使用中のモデルだけを置く (matting 中は rmbg、プロンプトのエンコード中は text_encoder、
+# サンプリング中は unet、encode/decode 中は vae)。CUDA では他のモデルを CPU メモリに退避し、CPU では重みを捨てて
+# <model>.offload.<name>.pt から mmap で読み直す (page cache はワーカー間で共有され、使っていないモデルは RSS に入らない)
+residency = None
+offload_prefix = os.path.splitext(model_path)[0] + '.offload'
+
+
+def enable_offload(shared=None):
+    # shared: 別のスクリプトのモデルと一つの ModelResidency を共有する場合 (inference_server.py の複数 variant)
+    global residency
+    if residency is None:
+        residency = shared or ModelResidency(device)
+        stat = os.stat(model_path)
+        residency.add(text_encoder, f'{offload_prefix}.text_encoder.pt', key=(text_encoder.config._name_or_path,))
+        residency.add(vae, f'{offload_prefix}.vae.pt', key=(vae.config._name_or_path,))
+        residency.add(unet, f'{offload_prefix}.unet.pt', key=(unet.config._name_or_path, os.path.abspath(model_path), stat.st_size, stat.st_mtime))
+        # rmbg は今の args ではなく読み込んだときの形式 (rmbg_key) のまま。--rmbg_dtype 等が変わっていれば次の load_rmbg() で読み直す
+        if isinstance(rmbg, torch.nn.Module):
+            residency.add(rmbg, f'{offload_prefix}.rmbg.pt', key=(rmbg_path, rmbg_key))
+    return residency
+
+
+def resident(model):
+    # with resident(model): の中では model がデバイス上にある (--offload でなければ何もしない)
+    if residency is None or not isinstance(model, torch.nn.Module):
+        return contextlib.nullcontext(model)
+    return residency.use(model)
+
+
+def apply_model_options():
+    # args のうちモデル自体を変えるオプション (--int8, --offload, --attention) を適用する。main() と quality_check.py から呼ぶ
+    set_attention(args.attention, args.attention_threshold, args.attention_chunk, args.attention_key_chunk,
+                  args.token_downsampling, ('lowres', 'highres') if args.token_downsampling_lowres else ('highres',))
+    if args.int8:
+        quantize_models()
+    if args.offload:
+        enable_offload()
 
 # SDP
 
 unet.set_attn_processor(AttnProcessor2_0())
 vae.set_attn_processor(AttnProcessor2_0())
 
+
+# --token_downsampling: highres パス (--token_downsampling_lowres なら lowres も) の UNet の最高解像度の self-attention で、
+# key/value を縦横 1/factor に縮小する (ToDo)。(factor, 対象パス) と、そのとき UNet に設定している processor
+token_downsampling = None
+unet_attention = None
+
+
+def set_attention(mode='sdpa', threshold=4096, query_chunk=1024, key_chunk=None, token_factor=None, token_passes=('highres',)):
+    # --attention chunked: しきい値より長い attention (highres の self-attention、VAE の mid-block) をチャンクに分けて計算する
+    # auto は CPU では chunked、CUDA では sdpa (fused kernel のままでメモリは増えない)
+    global token_downsampling, unet_attention
+    if mode == 'auto':
+        mode = 'chunked' if device.type == 'cpu' else 'sdpa'
+    vae_attention = ChunkedAttnProcessor(threshold, query_chunk, key_chunk) if mode == 'chunked' else AttnProcessor2_0()
+    unet_attention = vae_attention
+    if token_factor is not None:
+        unet_attention = ChunkedAttnProcessor(threshold if mode == 'chunked' else None, query_chunk, key_chunk)
+    token_downsampling = None if token_factor is None else (token_factor, tuple(token_passes))
+    unet.set_attn_processor(unet_attention)
+    vae.set_attn_processor(vae_attention)
+
+
+@contextlib.contextmanager
+def downsampled_tokens(pass_name, image_width, image_height):
+    # pass_name ('lowres' / 'highres') の UNet の間だけ token downsampling を有効にする
+    if token_downsampling is None or pass_name not in token_downsampling[1]:
+        yield
+        return
+    unet_attention.token_downsampling = (image_height // 8, image_width // 8, token_downsampling[0])
+    try:
+        yield
+    finally:
+        unet_attention.token_downsampling = None
+
 # Samplers
 
 ddim_scheduler = DDIMScheduler(
@@ -159,7 +302,8 @@ def encode_prompt_inner(txt: str):
     chunks = [pad(ck, id_pad, max_length) for ck in chunks]
 
     token_ids = torch.tensor(chunks).to(device=device, dtype=torch.int64)
-    conds = text_encoder(token_ids).last_hidden_state
+    with resident(text_encoder):
+        conds = text_encoder(token_ids).last_hidden_state
 
     return conds
 
@@ -185,70 +329,67 @@ def encode_prompt_pair(positive_prompt, negative_prompt):
     return c, uc
 
 
-@torch.inference_mode()
-def pytorch2numpy(imgs, quant=True):
-    results = []
-    for x in imgs:
-        y = x.movedim(0, -1)
-
-        if quant:
-            y = y * 127.5 + 127.5
-            y = y.detach().float().cpu().numpy().clip(0, 255).astype(np.uint8)
-        else:
-            y = y * 0.5 + 0.5
-            y = y.detach().float().cpu().numpy().clip(0, 1).astype(np.float32)
-
-        results.append(y)
-    return results
+# --memory_budget: ステージごとに必要なメモリを見積もり、予算を超えるなら UNet をマイクロバッチに、VAE を 1 枚ずつやタイルに分ける
+# 見積もりに関係なく、メモリ不足で失敗したステージは分け方を細かくしてやり直す (乱数状態は巻き戻す)
+memory_budget = MemoryBudget(device)
 
 
-@torch.inference_mode()
-def numpy2pytorch(imgs):
-    h = torch.from_numpy(np.stack(imgs, axis=0)).float() / 127.0 - 1.0  # so that 127 must be strictly 0.0
-    h = h.movedim(-1, 1)
-    return h
+def denoise(pipe, stage_name, conds, unconds, concat_conds, rng, num_samples, image=None, **kwargs):
+    # pipe(...).images を UNet のマイクロバッチに分けて計算する
+    # 入力ごとに乱数生成器を持つ複数入力のバッチは分けても結果が (丸め誤差を除き) 同じ。1 入力の num_samples を分けると乱数の使い方が変わる
+    rows = len(conds) * num_samples
 
+    def run(micro_batch):
+        latents = []
+        for start in range(0, rows, micro_batch):
+            stop = min(start + micro_batch, rows)
+            if len(conds) > 1:
+                part = dict(prompt_embeds=conds[start:stop], negative_prompt_embeds=unconds[start:stop], num_images_per_prompt=1,
+                            generator=rng[start:stop], cross_attention_kwargs={'concat_conds': concat_conds[start:stop]})
+            else:
+                part = dict(prompt_embeds=conds, negative_prompt_embeds=unconds, num_images_per_prompt=stop - start,
+                            generator=rng, cross_attention_kwargs={'concat_conds': concat_conds})
+            if image is not None:
+                part['image'] = image[start:stop] if len(image) == rows else image
+            latents.append(pipe(**part, **kwargs).images)
+        return torch.cat(latents)
 
-def resize_and_center_crop(image, target_width, target_height):
-    pil_image = Image.fromarray(image)
-    original_width, original_height = pil_image.size
-    scale_factor = max(target_width / original_width, target_height / original_height)
-    resized_width = int(round(original_width * scale_factor))
-    resized_height = int(round(original_height * scale_factor))
-    resized_image = pil_image.resize((resized_width, resized_height), Image.LANCZOS)
-    left = (resized_width - target_width) / 2
-    top = (resized_height - target_height) / 2
-    right = (resized_width + target_width) / 2
-    bottom = (resized_height + target_height) / 2
-    cropped_image = resized_image.crop((left, top, right, bottom))
-    return np.array(cropped_image)
+    options = memory_budget.unet_micro_batches(rows, kwargs['width'], kwargs['height'], unet.dtype, stage_name)
+    return with_fallbacks(run, options, stage_name, rng if isinstance(rng, list) else [rng])
 
 
-def resize_without_crop(image, target_width, target_height):
-    pil_image = Image.fromarray(image)
-    resized_image = pil_image.resize((target_width, target_height), Image.LANCZOS)
-    return np.array(resized_image)
+def encode_latents(pixels, stage_name):
+    modes = memory_budget.vae_modes(len(pixels), pixels.shape[3], pixels.shape[2], vae.dtype, False, vae.tile_sample_min_size, stage_name)
+    return with_fallbacks(lambda mode: vae_encode(vae, pixels, mode), modes, stage_name) * vae.config.scaling_factor
 
 
-@torch.inference_mode()
-def run_rmbg(img, sigma=0.0):
-    H, W, C = img.shape
-    assert C == 3
-    k = (256.0 / float(H * W)) ** 0.5
-    feed = resize_without_crop(img, int(64 * round(W * k)), int(64 * round(H * k)))
-    feed = numpy2pytorch([feed]).to(device=device, dtype=torch.float32)
-    alpha = rmbg(feed)[0][0]
-    alpha = torch.nn.functional.interpolate(alpha, size=(H, W), mode="bilinear")
-    alpha = alpha.movedim(1, -1)[0]
-    alpha = alpha.detach().float().cpu().numpy().clip(0, 1)
-    result = 127 + (img.astype(np.float32) - 127 + sigma) * alpha
-    return result.clip(0, 255).astype(np.uint8), alpha
+def decode_pixels(latents, stage_name):
+    modes = memory_budget.vae_modes(len(latents), latents.shape[3] * 8, latents.shape[2] * 8, vae.dtype, True, vae.tile_sample_min_size, stage_name)
+    return with_fallbacks(lambda mode: vae_decode(vae, latents, mode), modes, stage_name)
 
 
 @torch.inference_mode()
-def process(input_fg, input_bg, prompt, image_width, image_height, num_samples, seed, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise, bg_source):
-    bg_source = BGSource(bg_source)
-
+def run_rmbg(img, sigma=0.0, alpha=None):
+    # alpha: 入力に付いてきたマスク (H, W, 1)。あればそれを matting としてそのまま使い、BriaRMBG は動かさない
+    H, W, C = img.shape
+    assert C == 3
+    if alpha is not None:
+        return composite_alpha(img, alpha, sigma), alpha
+    # --mask_cache: 同じ画像 (画素が同じ) のマスクは前回の結果を使う。sigma は合成にしか効かないのでキーに含めない
+    if mask_cache is not None:
+        alpha = mask_cache.get(img)
+        if cache_lookup('mask', alpha is not None):
+            return composite_alpha(img, alpha, sigma), alpha
+    model = load_rmbg()
+    with resident(model):
+        alpha = predict_alphas(model, [img], device, backend=args.preprocess)[0]
+    if mask_cache is not None:
+        alpha = mask_cache.put(img, alpha)
+    return composite_alpha(img, alpha, sigma), alpha
+
+
+def background(input_bg, bg_source, image_width, image_height):
+    # bg_source に応じた背景画像 (UPLOAD 系はアップロード画像、それ以外は生成したグラデーション)
     if bg_source == BGSource.UPLOAD:
         pass
     elif bg_source == BGSource.UPLOAD_FLIP:
@@ -256,128 +397,145 @@ def process(input_fg, input_bg, prompt, image_width, image_height, num_samples,
     elif bg_source == BGSource.GREY:
         input_bg = np.zeros(shape=(image_height, image_width, 3), dtype=np.uint8) + 64
     elif bg_source == BGSource.LEFT:
-        gradient = np.linspace(224, 32, image_width)
-        image = np.tile(gradient, (image_height, 1))
-        input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
+        input_bg = gray_to_rgb(make_gradient(224, 32, image_width, image_height))
     elif bg_source == BGSource.RIGHT:
-        gradient = np.linspace(32, 224, image_width)
-        image = np.tile(gradient, (image_height, 1))
-        input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
+        input_bg = gray_to_rgb(make_gradient(32, 224, image_width, image_height))
     elif bg_source == BGSource.TOP:
-        gradient = np.linspace(224, 32, image_height)[:, None]
-        image = np.tile(gradient, (1, image_width))
-        input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
+        input_bg = gray_to_rgb(make_gradient(224, 32, image_width, image_height, vertical=True))
     elif bg_source == BGSource.BOTTOM:
-        gradient = np.linspace(32, 224, image_height)[:, None]
-        image = np.tile(gradient, (1, image_width))
-        input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
+        input_bg = gray_to_rgb(make_gradient(32, 224, image_width, image_height, vertical=True))
     elif bg_source == BGSource.CUSTOM_LEFT:
-        gradient = np.linspace(192, 64, image_width)
-        image_1 = np.tile(gradient, (image_height, 1))
-        gradient = np.linspace(192, 64, image_height)[:, None]
-        image_2 = np.tile(gradient, (1, image_width))
-        image = (image_1 + image_2) / 2
-        input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
+        image_1 = make_gradient(192, 64, image_width, image_height)
+        image_2 = make_gradient(192, 64, image_width, image_height, vertical=True)
+        input_bg = gray_to_rgb((image_1 + image_2) / 2)
     elif bg_source == BGSource.CUSTOM_LEFT_HIGH:
-        gradient = np.linspace(224, 32, image_width)
-        image_1 = np.tile(gradient, (image_height, 1))
-        gradient = np.linspace(224, 32, image_height)[:, None]
-        image_2 = np.tile(gradient, (1, image_width))
-        image = (image_1 + image_2) / 2
-        input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
+        image_1 = make_gradient(224, 32, image_width, image_height)
+        image_2 = make_gradient(224, 32, image_width, image_height, vertical=True)
+        input_bg = gray_to_rgb((image_1 + image_2) / 2)
     elif bg_source == BGSource.CUSTOM_RIGHT:
-        gradient = np.linspace(64, 192, image_width)
-        image_1 = np.tile(gradient, (image_height, 1))
-        gradient = np.linspace(192, 64, image_height)[:, None]
-        image_2 = np.tile(gradient, (1, image_width))
-        image = (image_1 + image_2) / 2
-        input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
+        image_1 = make_gradient(64, 192, image_width, image_height)
+        image_2 = make_gradient(192, 64, image_width, image_height, vertical=True)
+        input_bg = gray_to_rgb((image_1 + image_2) / 2)
     elif bg_source == BGSource.CUSTOM_RIGHT_HIGH:
-        gradient = np.linspace(32, 224, image_width)
-        image_1 = np.tile(gradient, (image_height, 1))
-        gradient = np.linspace(224, 32, image_height)[:, None]
-        image_2 = np.tile(gradient, (1, image_width))
-        image = (image_1 + image_2) / 2
-        input_bg = np.stack((image,) * 3, axis=-1).astype(np.uint8)
+        image_1 = make_gradient(32, 224, image_width, image_height)
+        image_2 = make_gradient(224, 32, image_width, image_height, vertical=True)
+        input_bg = gray_to_rgb((image_1 + image_2) / 2)
     elif bg_source == BGSource.CUSTOM_GRAY:
         input_bg = np.zeros(shape=(image_height, image_width, 3), dtype=np.uint8) + 100
     else:
         raise 'Wrong background source!'
+    return input_bg
+
+
+# 'lowres' のプロセスでは process_batch() が lowres の checkpoint を書いた時点で戻る (--stage_workers)
+pipeline_stage = 'all'
+
+
+@torch.inference_mode()
+def process(input_fg, input_bg, prompt, image_width, image_height, num_samples, seed, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise, bg_source, checkpoint_prefix=None):
+    return process_batch([input_fg], [input_bg], [prompt], [seed], image_width, image_height, num_samples, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise, bg_source, checkpoint_prefix=checkpoint_prefix)[0]
 
-    rng = torch.Generator(device=device).manual_seed(seed)
-
-    fg = resize_and_center_crop(input_fg, image_width, image_height)
-    bg = resize_and_center_crop(input_bg, image_width, image_height)
-    concat_conds = numpy2pytorch([fg, bg]).to(device=vae.device, dtype=vae.dtype)
-    concat_conds = vae.encode(concat_conds).latent_dist.mode() * vae.config.scaling_factor
-    concat_conds = torch.cat([c[None, ...] for c in concat_conds], dim=1)
-
-    conds, unconds = encode_prompt_pair(positive_prompt=prompt + ', ' + a_prompt, negative_prompt=n_prompt)
-
-    latents = t2i_pipe(
-        prompt_embeds=conds,
-        negative_prompt_embeds=unconds,
-        width=image_width,
-        height=image_height,
-        num_inference_steps=steps,
-        num_images_per_prompt=num_samples,
-        generator=rng,
-        output_type='latent',
-        guidance_scale=cfg,
-        cross_attention_kwargs={'concat_conds': concat_conds},
-    ).images.to(vae.dtype) / vae.config.scaling_factor
-
-    pixels = vae.decode(latents).sample
-    pixels = pytorch2numpy(pixels)
-    pixels = [resize_without_crop(
-        image=p,
-        target_width=int(round(image_width * highres_scale / 64.0) * 64),
-        target_height=int(round(image_height * highres_scale / 64.0) * 64))
-    for p in pixels]
-
-    pixels = numpy2pytorch(pixels).to(device=vae.device, dtype=vae.dtype)
-    latents = vae.encode(pixels).latent_dist.mode() * vae.config.scaling_factor
-    latents = latents.to(device=unet.device, dtype=unet.dtype)
-
-    image_height, image_width = latents.shape[2] * 8, latents.shape[3] * 8
-    fg = resize_and_center_crop(input_fg, image_width, image_height)
-    bg = resize_and_center_crop(input_bg, image_width, image_height)
-    concat_conds = numpy2pytorch([fg, bg]).to(device=vae.device, dtype=vae.dtype)
-    concat_conds = vae.encode(concat_conds).latent_dist.mode() * vae.config.scaling_factor
-    concat_conds = torch.cat([c[None, ...] for c in concat_conds], dim=1)
-
-    latents = i2i_pipe(
-        image=latents,
-        strength=highres_denoise,
-        prompt_embeds=conds,
-        negative_prompt_embeds=unconds,
-        width=image_width,
-        height=image_height,
-        num_inference_steps=int(round(steps / highres_denoise)),
-        num_images_per_prompt=num_samples,
-        generator=rng,
-        output_type='latent',
-        guidance_scale=cfg,
-        cross_attention_kwargs={'concat_conds': concat_conds},
-    ).images.to(vae.dtype) / vae.config.scaling_factor
-
-    pixels = vae.decode(latents).sample
-    pixels = pytorch2numpy(pixels, quant=False)
-
-    return pixels, [fg, bg]
+
+@torch.inference_mode()
+def process_batch(input_fgs, input_bgs, prompts, seeds, image_width, image_height, num_samples, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise, bg_source, checkpoint_prefix=None):
+    # 複数の入力を 1 回の UNet バッチで処理し、入力ごとの (結果, 前景・背景) を返す
+    # 入力ごとに乱数生成器を持つため、各結果は process(..., num_samples=1, seed=seed) と同じ
+    # (複数入力のときは num_samples=1、同じ長さの prompt のみ。checkpoint は単一入力のみ)
+    bg_source = BGSource(bg_source)
+    batch_size = len(input_fgs)
+    assert batch_size == 1 or (num_samples == 1 and checkpoint_prefix is None)
+    input_bgs = [background(input_bg, bg_source, image_width, image_height) for input_bg in input_bgs]
+
+    rngs = [torch.Generator(device=device).manual_seed(seed) for seed in seeds]
+    rng = rngs[0] if batch_size == 1 else rngs
+
+    with stage('encode'):
+        with resident(vae):
+            fg_bg = preprocess([x for pair in zip(input_fgs, input_bgs) for x in pair], image_width, image_height, device=vae.device, dtype=vae.dtype, backend=args.preprocess)
+            concat_conds = encode_latents(fg_bg, 'encode')
+            concat_conds = concat_conds.reshape(batch_size, -1, *concat_conds.shape[2:])
+
+        prompt_pairs = [encode_prompt_pair(positive_prompt=prompt + ', ' + a_prompt, negative_prompt=n_prompt) for prompt in prompts]
+        conds = torch.cat([c for c, uc in prompt_pairs], dim=0)
+        unconds = torch.cat([uc for c, uc in prompt_pairs], dim=0)
+
+    # 中断したジョブの再開用に、lowres の latent と乱数状態を保存・復元する
+    # 入力・seed・サイズ・プロンプト・サンプラー設定が保存時と違う checkpoint は使わずに計算し直す
+    checkpoint_path = None if checkpoint_prefix is None else f"{checkpoint_prefix}.{bg_source.name.lower()}.pt"
+    checkpoint_key = None
+    if checkpoint_path is not None:
+        checkpoint_key = latents_key(*input_fgs, *input_bgs, seeds, image_width, image_height, num_samples, steps, cfg, prompts, a_prompt, n_prompt, bg_source.value)
+
+    with stage('lowres'), resident(unet), downsampled_tokens('lowres', image_width, image_height):
+        latents = None
+        if checkpoint_path is not None:
+            latents = load_latents_checkpoint(checkpoint_path, rng, device=device, dtype=vae.dtype, key=checkpoint_key)
+            cache_lookup('latents_checkpoint', latents is not None)
+        if latents is None:
+            latents = denoise(
+                t2i_pipe, 'lowres', conds, unconds, concat_conds, rng, num_samples,
+                width=image_width,
+                height=image_height,
+                num_inference_steps=steps,
+                output_type='latent',
+                guidance_scale=cfg,
+            ).to(vae.dtype) / vae.config.scaling_factor
+
+        if checkpoint_path is not None:
+            save_latents_checkpoint(checkpoint_path, latents, rng, key=checkpoint_key)
+
+    if pipeline_stage == 'lowres':
+        # --stage_workers の lowres ワーカーは checkpoint を書いたところで終え、highres 以降は highres ワーカーが行う
+        return [([], []) for _ in range(batch_size)]
+
+    with stage('upscale'), resident(vae):
+        pixels = decode_pixels(latents, 'upscale')
+        pixels = upscale_decoded(
+            pixels,
+            target_width=int(round(image_width * highres_scale / 64.0) * 64),
+            target_height=int(round(image_height * highres_scale / 64.0) * 64),
+            backend=args.preprocess)
+
+        pixels = pixels.to(device=vae.device, dtype=vae.dtype)
+        latents = encode_latents(pixels, 'upscale')
+        latents = latents.to(device=device, dtype=unet.dtype)
+
+        image_height, image_width = latents.shape[2] * 8, latents.shape[3] * 8
+        # 結果と一緒に返す fg/bg は正規化したテンソルからではなく、リサイズした uint8 画像のまま返す (元のスクリプトと同じ)
+        fg_bg, extra_images = preprocess_images([x for pair in zip(input_fgs, input_bgs) for x in pair], image_width, image_height, device=vae.device, dtype=vae.dtype, backend=args.preprocess)
+        concat_conds = encode_latents(fg_bg, 'upscale')
+        concat_conds = concat_conds.reshape(batch_size, -1, *concat_conds.shape[2:])
+
+    with stage('highres'), resident(unet), downsampled_tokens('highres', image_width, image_height):
+        latents = denoise(
+            i2i_pipe, 'highres', conds, unconds, concat_conds, rng, num_samples,
+            image=latents,
+            strength=highres_denoise,
+            width=image_width,
+            height=image_height,
+            num_inference_steps=int(round(steps / highres_denoise)),
+            output_type='latent',
+            guidance_scale=cfg,
+        ).to(vae.dtype) / vae.config.scaling_factor
+
+    with stage('decode'), resident(vae):
+        pixels = decode_pixels(latents, 'decode')
+        results = pytorch2numpy(pixels, quant=False)
+
+    return [(results[i * num_samples:(i + 1) * num_samples], extra_images[2 * i:2 * i + 2]) for i in range(batch_size)]
 
 
 @torch.inference_mode()
-def process_relight(input_fg, input_bg, prompt, image_width, image_height, num_samples, seed, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise, bg_source):
-    input_fg, matting = run_rmbg(input_fg)
-    results, extra_images = process(input_fg, input_bg, prompt, image_width, image_height, num_samples, seed, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise, bg_source)
+def process_relight(input_fg, input_bg, prompt, image_width, image_height, num_samples, seed, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise, bg_source, checkpoint_prefix=None, alpha=None):
+    input_fg, matting = run_rmbg(input_fg, alpha=alpha)
+    results, extra_images = process(input_fg, input_bg, prompt, image_width, image_height, num_samples, seed, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise, bg_source, checkpoint_prefix=checkpoint_prefix)
     results = [(x * 255.0).clip(0, 255).astype(np.uint8) for x in results]
     return results + extra_images
 
 
 @torch.inference_mode()
-def process_normal(input_fg, input_bg, prompt, image_width, image_height, num_samples, seed, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise, bg_source):
-    input_fg, matting = run_rmbg(input_fg, sigma=16)
+def process_normal(input_fg, input_bg, prompt, image_width, image_height, num_samples, seed, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise, bg_source, alpha=None):
+    input_fg, matting = run_rmbg(input_fg, sigma=16, alpha=alpha)
 
     print('left ...')
     left = process(input_fg, input_bg, prompt, image_width, image_height, 1, seed, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise, BGSource.LEFT.value)[0][0]
@@ -391,33 +549,16 @@ def process_normal(input_fg, input_bg, prompt, image_width, image_height, num_sa
     print('top ...')
     top = process(input_fg, input_bg, prompt, image_width, image_height, 1, seed, steps, a_prompt, n_prompt, cfg, highres_scale, highres_denoise, BGSource.TOP.value)[0][0]
 
-    inner_results = [left * 2.0 - 1.0, right * 2.0 - 1.0, bottom * 2.0 - 1.0, top * 2.0 - 1.0]
-
-    ambient = (left + right + bottom + top) / 4.0
-    h, w, _ = ambient.shape
-    matting = resize_and_center_crop((matting[..., 0] * 255.0).clip(0, 255).astype(np.uint8), w, h).astype(np.float32)[..., None] / 255.0
-
-    def safa_divide(a, b):
-        e = 1e-5
-        return ((a + e) / (b + e)) - 1.0
+    return normal_results(left, right, bottom, top, matting)
 
-    left = safa_divide(left, ambient)
-    right = safa_divide(right, ambient)
-    bottom = safa_divide(bottom, ambient)
-    top = safa_divide(top, ambient)
 
-    u = (right - left) * 0.5
-    v = (top - bottom) * 0.5
-
-    sigma = 10.0
-    u = np.mean(u, axis=2)
-    v = np.mean(v, axis=2)
-    h = (1.0 - u ** 2.0 - v ** 2.0).clip(0, 1e5) ** (0.5 * sigma)
-    z = np.zeros_like(h)
+def normal_results(left, right, bottom, top, matting):
+    # 4 方向の relight 結果と matting から法線マップ等の出力一式を作る
+    inner_results = [left * 2.0 - 1.0, right * 2.0 - 1.0, bottom * 2.0 - 1.0, top * 2.0 - 1.0]
 
-    normal = np.stack([u, v, h], axis=2)
-    normal /= np.sum(normal ** 2.0, axis=2, keepdims=True) ** 0.5
-    normal = normal * matting + np.stack([z, z, 1 - z], axis=2) * (1 - matting)
+    h, w, _ = left.shape
+    matting = resize_and_center_crop((matting[..., 0] * 255.0).clip(0, 255).astype(np.uint8), w, h).astype(np.float32)[..., None] / 255.0
+    normal, left, right, bottom, top = estimate_normal(left, right, bottom, top, matting)
 
     results = [normal, left, right, bottom, top] + inner_results
     results = [(x * 127.5 + 127.5).clip(0, 255).astype(np.uint8) for x in results]
@@ -454,7 +595,7 @@ class BGSource(Enum):
 
 # Setup argument parser  元のコードのblock以降を次のように変更（+ impoortにargparse追加）
 parser = argparse.ArgumentParser(description="IC-Light (Relighting with Foreground Condition)")
-parser.add_argument('--input_dir', type=str, required=True, help="Path to the input foreground dir")
+parser.add_argument('--input_dir', type=str, default=None, help="Path to the input foreground dir")
 parser.add_argument('--output_dir', type=str, required=True, help="Path to output dir")
 parser.add_argument('--prompt', type=str, required=True, help="Prompt for text-to-image generation")
 parser.add_argument('--bg_source', type=str, choices=[e.value for e in BGSource], default='None', help="Lighting Preference (Initial Latent)")
@@ -468,71 +609,293 @@ parser.add_argument('--highres_scale', type=float, default=1.5, help="Highres Sc
 parser.add_argument('--highres_denoise', type=float, default=0.5, help="Highres Denoise")
 parser.add_argument('--a_prompt', type=str, default='best quality', help="Added prompt")
 parser.add_argument('--n_prompt', type=str, default='fog, haze, faded, washed-out, lowres, bad anatomy, bad hands, cropped, worst quality, illustration, 3d, 2d, painting, cartoons, sketch, shadow, shade', help="Negative prompt")
-parser.add_argument('--source_info_file', type=str, required=True, help="Path to the light source file")
-parser.add_argument('--color_info_file', type=str, required=True, help="Path to the hair color file")
-
-args = parser.parse_args()
-
-# 出力フォルダが存在しない場合は作成
-if not os.path.exists(args.output_dir):
-    os.makedirs(args.output_dir)
-
-# 指定フォルダ内の全ての画像ファイル名を取得
-image_files = sorted(os.listdir(args.input_dir))
-images = [f for f in image_files if f.endswith('.png')]
-
-# 光源推定結果、髪色推定結果を読み込んで、各行をリストとして保持
-with open(args.source_info_file, "r") as file:
-    light_directions = [line.strip() for line in file]
-with open(args.color_info_file, "r") as file:
-    hair_colors = [line.strip() for line in file]
-
-for image, light_source, hair_color in zip(images, light_directions, hair_colors):
-    base_name = image.split('.')[0]
-    image_path = os.path.join(args.input_dir, image)
-
-    # Process function call with argparse arguments
-    input_fg = np.array(Image.open(image_path))
-
-    prompt = args.prompt
-    if hair_color == "gray hair":
+parser.add_argument('--source_info_file', type=str, default=None, help="Path to the light source file")
+parser.add_argument('--color_info_file', type=str, default=None, help="Path to the hair color file")
+parser.add_argument('--input_manifest', type=str, default=None, help="JSONL/CSV manifest with image, light_source, hair_color and optional per-item seed/image_width/image_height/prompt (replaces --input_dir/--source_info_file/--color_info_file)")
+parser.add_argument('--manifest_start', type=int, default=0, help="First manifest record to process")
+parser.add_argument('--manifest_stop', type=int, default=None, help="Stop before this manifest record")
+parser.add_argument('--mask_dir', type=str, default=None, help="Directory with a <name>.png mask per input (e.g. from matting.py), used as the matting instead of BriaRMBG (a manifest 'mask' field or the input PNG's own alpha channel also works)")
+parser.add_argument('--require_mask', action='store_true', help="Skip inputs that come without alpha channel or mask (recorded as failed in the manifest) instead of running BriaRMBG, which is then never loaded")
+parser.add_argument('--rmbg_dtype', type=str, choices=['float32', 'bfloat16', 'float16'], default='float32', help="BriaRMBG precision; check the masks with rmbg_check.py first (bfloat16 suits recent CPUs, float16 GPUs)")
+parser.add_argument('--rmbg_channels_last', action='store_true', help="Run BriaRMBG in channels_last memory format (usually faster on CPU, especially with bfloat16)")
+parser.add_argument('--rmbg_onnx', type=str, default=None, help="CPU only: run BriaRMBG with onnxruntime from this ONNX file, exported there first if missing (falls back to PyTorch without onnxruntime)")
+parser.add_argument('--mask_cache', type=str, default=None, help="Directory of a persistent BriaRMBG mask cache keyed by image content, shared by runs and workers (masks are stored as 8-bit PNG)")
+parser.add_argument('--mask_cache_size', type=float, default=2.0, help="GiB the mask cache may use before the least recently used masks are removed")
+parser.add_argument('--preprocess', type=str, choices=['pytorch', 'pil'], default='pil', help="Resize with PIL LANCZOS on the CPU ('pil', the outputs of earlier runs) or on the device ('pytorch', opt-in: slightly different outputs; compare with benchmark.py, it pays off for batches on CUDA rather than single images)")
+parser.add_argument('--prefetch', type=int, default=0, help="Number of inputs decoded ahead in a background thread (0 = serial)")
+parser.add_argument('--writers', type=int, default=0, help="Number of threads encoding and saving outputs (0 = serial)")
+parser.add_argument('--max_pending_writes', type=int, default=None, help="Maximum results waiting to be written before inference blocks (default: 2 * writers)")
+parser.add_argument('--output_format', type=str, choices=['png', 'webp', 'npy'], default='png', help="png, lossless webp, or raw npy arrays")
+parser.add_argument('--png_compress_level', type=int, default=6, help="PNG zlib level, 0 (fastest) to 9 (smallest)")
+parser.add_argument('--archive', type=str, choices=['none', 'tar', 'memmap'], default='none', help="Write one file per result, append to tar shards, or append raw arrays to one .bin file with a JSONL index")
+parser.add_argument('--archive_shard_size', type=int, default=1000, help="Results per tar shard")
+parser.add_argument('--manifest', type=str, default=None, help="Path of the run manifest (default: <output_dir>/manifest.jsonl)")
+parser.add_argument('--resume', action='store_true', help="Skip items the manifest records as done")
+parser.add_argument('--checkpoint_latents', action='store_true', help="Save lowres latents per item so a resumed run can skip the lowres pass")
+parser.add_argument('--shard', type=parse_shard, default=None, help="Static partition i/n: process only every n-th input, starting at i")
+parser.add_argument('--work_queue', type=str, default=None, help="Shared directory through which several workers claim inputs dynamically")
+parser.add_argument('--worker_id', type=str, default=None, help="Name of this worker (default: <hostname>-<pid>)")
+parser.add_argument('--lease_timeout', type=float, default=900.0, help="Seconds after which an unfinished claim of another worker is taken over")
+parser.add_argument('--offload', action='store_true', help="Keep only the model in use on the device (rmbg, text encoder, UNet or VAE): on CUDA the others wait in CPU memory, on the CPU their weights are dropped and memory-mapped back from <model>.offload.*.pt")
+parser.add_argument('--memory_budget', type=float, default=None, help="GiB of device memory (resident set on the CPU) to stay under: larger stages run as UNet micro-batches or with sliced or tiled VAE encode/decode. Stages that run out of memory are retried split finer either way")
+parser.add_argument('--attention', type=str, choices=['sdpa', 'chunked', 'auto'], default='sdpa', help="Attention of the UNet and VAE: scaled_dot_product_attention, chunked above --attention_threshold, or auto (chunked on the CPU, sdpa on CUDA)")
+parser.add_argument('--attention_threshold', type=int, default=4096, help="Sequence length above which --attention chunked splits the attention (for cross-attention, the geometric mean of the query and key lengths)")
+parser.add_argument('--attention_chunk', type=int, default=1024, help="Queries per chunk with --attention chunked")
+parser.add_argument('--attention_key_chunk', type=int, default=None, help="Also split the keys into chunks of this many (less memory, but slower than the fused kernel)")
+parser.add_argument('--token_downsampling', type=float, default=None, help="Downsample the keys and values of the UNet's full-resolution self-attention by this factor per side in the highres pass (e.g. 2: a quarter of the tokens); check quality with quality_check.py --examples")
+parser.add_argument('--token_downsampling_lowres', action='store_true', help="Apply --token_downsampling in the lowres pass too")
+parser.add_argument('--int8', action='store_true', help="CPU only: dynamic int8 quantisation of the UNet and text encoder Linear layers (cached next to the IC-Light model; check quality with quality_check.py)")
+parser.add_argument('--cpu_workers', type=int, default=1, help="CPU only: fork this many worker processes that share one copy of the model weights")
+parser.add_argument('--stage_workers', type=int, nargs=2, default=None, metavar=('LOWRES', 'HIGHRES'), help="CPU only: pipeline the lowres and highres passes across this many forked workers each; lowres latents, the decoded input and its matting are handed over through checkpoint files")
+parser.add_argument('--threads_per_worker', type=int, default=None, help="Intra-op threads per CPU worker (default: its share of the cores)")
+parser.add_argument('--metrics_port', type=int, default=None, help="Serve OpenMetrics stage latencies, queue wait, image counts and cache hits on http://<metrics_host>:<port>/metrics (CPU worker n uses port + n)")
+parser.add_argument('--metrics_host', type=str, default='127.0.0.1', help="Address the metrics endpoint listens on (0.0.0.0 for a remote scraper)")
+parser.add_argument('--metrics_file', type=str, default=None, help="Rewrite the same metrics to this file every 15 s and at exit (CPU worker n writes <file>.cpu<n>)")
+
+bg_source_by_light_source = {
+    "Left": "CUSTOM_LEFT",
+    "Left_High": "CUSTOM_LEFT_HIGH",
+    "Right": "CUSTOM_RIGHT",
+    "Right_High": "CUSTOM_RIGHT_HIGH",
+}
+
+
+def load_input(record):
+    # アルファ付き PNG やマスクファイル (manifest の mask、または --mask_dir の同名ファイル) があれば、その alpha も返す
+    mask_path = record['mask']
+    if mask_path is None and args.mask_dir is not None:
+        mask_path = os.path.join(args.mask_dir, mask_name(record['name']))
+        if not os.path.exists(mask_path):
+            mask_path = None
+    mask = Image.open(mask_path) if mask_path is not None else None
+    return record, split_alpha(Image.open(record['image']), mask)
+
+
+def load_handoff(record):
+    # --stage_workers の highres ワーカー: lowres ワーカーが保存したデコード済みの入力と alpha を読む (デコードと matting を繰り返さない)
+    return record, load_input_checkpoint(record['handoff'])
+
+
+def item_arguments(record):
+    # CLI arguments with the record's per-item overrides (seed, size, prompt, ...) applied
+    return argparse.Namespace(**{**vars(args), **record['overrides']})
+
+
+def relight(input_fg, alpha, record, item_args, checkpoint_prefix=None):
+    if alpha is None and args.require_mask:
+        raise MissingMask(f"{record['image']} has no alpha channel or mask (--require_mask)")
+    prompt = item_args.prompt
+    if record['hair_color'] == "gray hair":
         prompt = "white hair " + prompt
 
-    if light_source == "Left":
-        bg_source = "CUSTOM_LEFT"
-    elif light_source == "Left_High":
-        bg_source = "CUSTOM_LEFT_HIGH"
-    elif light_source == "Right":
-        bg_source = "CUSTOM_RIGHT"
-    elif light_source == "Right_High":
-        bg_source = "CUSTOM_RIGHT_HIGH"
-    else:
-        bg_source = "CUSTOM_GRAY"
-
+    bg_source = bg_source_by_light_source.get(record['light_source'], "CUSTOM_GRAY")
     bg_source = "CUSTOM_GRAY"  # use CUSTOM_GRAY for all estimated light direction
 
-    results = process_relight(
+    return process_relight(
         input_fg=input_fg,
         input_bg=None,
-        prompt=args.prompt,
-        image_width=args.image_width,
-        image_height=args.image_height,
-        num_samples=args.num_samples,
-        seed=args.seed,
-        steps=args.steps,
-        a_prompt=args.a_prompt,
-        n_prompt=args.n_prompt,
-        cfg=args.cfg,
-        highres_scale=args.highres_scale,
-        highres_denoise=args.highres_denoise,
-        bg_source=bg_source
+        prompt=item_args.prompt,
+        image_width=item_args.image_width,
+        image_height=item_args.image_height,
+        num_samples=item_args.num_samples,
+        seed=item_args.seed,
+        steps=item_args.steps,
+        a_prompt=item_args.a_prompt,
+        n_prompt=item_args.n_prompt,
+        cfg=item_args.cfg,
+        highres_scale=item_args.highres_scale,
+        highres_denoise=item_args.highres_denoise,
+        bg_source=bg_source,
+        checkpoint_prefix=checkpoint_prefix,
+        alpha=alpha
     )
 
-    # Save or display results
+
+def save_results(record, results, item_args, checkpoint_prefix=None):
+    image = record['name']
+    outputs = []
     for i, result in enumerate(results):
-        result_img = Image.fromarray(result)
         if i==0:
-            save_path = os.path.join(args.output_dir, image)
-            result_img.save(save_path)
+            outputs.append(sink.write(os.path.splitext(image)[0], result))
+
+    manifest.update(image, 'done', image=record['image'], seed=item_args.seed, light_source=record['light_source'], hair_color=record['hair_color'],
+                    overrides=record['overrides'], outputs=outputs)
+    remove_checkpoints(checkpoint_prefix)
+    ITEMS.inc(status='done')
+    IMAGES.inc(len(outputs))
+    if work_queue is not None:
+        work_queue.mark_done(image)
 
     print(f"Processing completed. Results saved as {image}_*.png")
+
+
+def skip_input(record, error):
+    # 入力単体の問題 (--require_mask でマスクが無い) は manifest に failed と記録して次の入力に進む
+    # 他のワーカーがやり直しても同じなので、--work_queue でも終わった扱いにする
+    print(f"Skipping {record['image']}: {error}")
+    manifest.update(record['name'], 'failed', image=record['image'], seed=item_arguments(record).seed, error=repr(error))
+    ITEMS.inc(status='failed')
+    if work_queue is not None:
+        work_queue.mark_done(record['name'])
+
+
+def remove_checkpoints(checkpoint_prefix):
+    if checkpoint_prefix is None:
+        return
+    for path in glob.glob(glob.escape(checkpoint_prefix) + '.*.pt') + glob.glob(glob.escape(checkpoint_prefix) + '.input.npz'):
+        os.remove(path)
+
+
+def main(argv=None):
+    global args, sink, manifest, work_queue, pipeline_stage, mask_cache, memory_budget
+    args = parser.parse_args(argv)
+    if args.input_manifest is None and None in (args.input_dir, args.source_info_file, args.color_info_file):
+        parser.error("either --input_manifest or all of --input_dir, --source_info_file and --color_info_file are required")
+    if (args.cpu_workers > 1 or args.stage_workers is not None) and device.type != 'cpu':
+        parser.error("--cpu_workers and --stage_workers are only supported when running on the CPU")
+    if args.stage_workers is not None and (args.cpu_workers > 1 or min(args.stage_workers) < 1):
+        parser.error("--stage_workers needs at least one worker per stage and cannot be combined with --cpu_workers")
+    if args.int8 and device.type != 'cpu':
+        parser.error("--int8 is only supported when running on the CPU")
+    if models_int8 and not args.int8:
+        parser.error("the models in this process were already quantised by an earlier --int8 run")
+    if args.offload and args.int8:
+        parser.error("--offload cannot be combined with --int8")
+    if residency is not None and not args.offload:
+        parser.error("the models in this process were already offloaded by an earlier --offload run")
+    apply_model_options()
+
+    # 出力フォルダが存在しない場合は作成
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    # 入力 manifest を逐次読み込み (旧形式の input_dir + 光源ファイル + 髪色ファイルも同じレコード形式に変換)
+    if args.input_manifest is not None:
+        records = iter_records(args.input_manifest, start=args.manifest_start, stop=args.manifest_stop)
+    else:
+        records = enumerate(normalize_record(r, args.input_dir) for r in legacy_records(args.input_dir, args.source_info_file, args.color_info_file, truncate=True))
+
+    # 実行条件と各画像の処理状況を manifest に記録し、--resume では完了済みの画像をスキップ
+    # 複数ワーカーで同じ output_dir に書く場合は、manifest とアーカイブのファイル名をワーカーごとに分ける
+    runtime_args = ('resume', 'manifest', 'prefetch', 'writers', 'max_pending_writes', 'shard', 'work_queue', 'worker_id', 'lease_timeout',
+                    'cpu_workers', 'stage_workers', 'threads_per_worker', 'metrics_port', 'metrics_host', 'metrics_file', 'require_mask', 'mask_cache_size', 'offload', 'memory_budget')
+    worker_id = args.worker_id or default_worker_id()
+    if args.work_queue is not None:
+        worker_tag = worker_id
+    elif args.shard is not None:
+        worker_tag = f"shard{args.shard[0]}of{args.shard[1]}"
+    else:
+        worker_tag = None
+    manifest_name = 'manifest.jsonl' if worker_tag is None else f'manifest-{worker_tag}.jsonl'
+    manifest = RunManifest(args.manifest or os.path.join(args.output_dir, manifest_name))
+    manifest.start_run({k: v for k, v in vars(args).items() if k not in runtime_args})
+
+    mask_cache = None
+    if args.mask_cache is not None:
+        mask_cache = MaskCache(args.mask_cache, f'{rmbg_path}:{rmbg_engine()}:{args.preprocess}', int(args.mask_cache_size * 2**30))
+
+    memory_budget = MemoryBudget(device, None if args.memory_budget is None else int(args.memory_budget * 2**30))
+
+    checkpoint_dir = os.path.join(args.output_dir, '.checkpoints')
+    use_checkpoints = args.checkpoint_latents or args.stage_workers is not None
+    if use_checkpoints:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    # --cpu_workers: モデル読み込み済みのプロセスを fork し、共有メモリ上の重みを全ワーカーで共用
+    # 各ワーカーは共有カウンタから次の番号を取って処理し、manifest は共用、アーカイブはワーカーごとに分ける
+    sink_prefix = 'results' if worker_tag is None else f'results-{worker_tag}'
+    # --stage_workers: 同じ仕組みで lowres 用と highres 用のワーカーに分け、lowres の latent を checkpoint ファイルで受け渡す
+    pool_counter = None
+    cpu_worker = None
+    handoff = None
+    pipeline_stage = 'all'
+    num_workers = sum(args.stage_workers) if args.stage_workers is not None else args.cpu_workers
+    if num_workers > 1:
+        # --offload では重みが mmap したファイルなので、共有メモリに移さなくても page cache を共有する
+        if residency is None:
+            share_weights(text_encoder, vae, unet)
+        if not args.require_mask:
+            # マスクの無い入力に備えて BriaRMBG も fork 前に読み込み、全ワーカーで共有する
+            model = load_rmbg()
+            if isinstance(model, torch.nn.Module) and residency is None:
+                share_weights(model)
+        pool_counter = TicketCounter()
+        if args.stage_workers is not None:
+            handoff = StageHandoff(*args.stage_workers)
+        cpu_worker = fork_workers(num_workers, args.threads_per_worker)
+        worker_id = f'{worker_id}-cpu{cpu_worker}'
+        sink_prefix = f'{sink_prefix}-cpu{cpu_worker}'
+        if handoff is not None:
+            pipeline_stage = 'lowres' if cpu_worker < args.stage_workers[0] else 'highres'
+            if pipeline_stage == 'highres':
+                handoff.register_consumer(cpu_worker - args.stage_workers[0])
+            else:
+                handoff.register_producer(cpu_worker)
+
+    # 処理時間・待ち時間・枚数・キャッシュヒットを OpenMetrics 形式で公開
+    if args.metrics_port is not None:
+        serve_metrics(args.metrics_port + (cpu_worker or 0), host=args.metrics_host)
+    if args.metrics_file is not None:
+        start_file_exporter(args.metrics_file if cpu_worker is None else f'{args.metrics_file}.cpu{cpu_worker}')
+
+    # 読み込み(prefetch)・推論(メインスレッド)・書き出し(writers)を並行して実行
+    if args.shard is not None:
+        records = static_shard(records, *args.shard)
+    items = (record for index, record in records)
+    if pool_counter is not None:
+        items = claim_in_order(items, pool_counter)
+    if args.resume:
+        items = (record for record in items if not manifest.is_done(record['name']))
+    work_queue = None
+    if args.work_queue is not None:
+        work_queue = LockFileQueue(args.work_queue, worker_id=worker_id, lease_timeout=args.lease_timeout)
+        items = work_queue.claim(items)
+    # ピークメモリは処理中のものを報告する (モデルの読み込み・マージ時のピークは含めない)
+    reset_peak_memory()
+    sink = open_sink(args.output_dir, archive=args.archive, output_format=args.output_format, png_compress_level=args.png_compress_level,
+                     shard_size=args.archive_shard_size, prefix=sink_prefix)
+    try:
+        with AsyncWriter(args.writers, max_pending=args.max_pending_writes) as writer:
+            if pipeline_stage == 'highres':
+                loaded = timed_iter(prefetch(iter(handoff), load_handoff, args.prefetch), queue='handoff')
+            else:
+                loaded = timed_iter(prefetch(items, load_input, args.prefetch), queue='input')
+            if args.require_mask:
+                loaded = skip_unmasked(loaded, skip_input)
+            for record, (input_fg, alpha) in loaded:
+                item_args = item_arguments(record)
+                checkpoint_prefix = os.path.join(checkpoint_dir, record['name']) if use_checkpoints else None
+                if checkpoint_prefix is not None:
+                    os.makedirs(os.path.dirname(checkpoint_prefix), exist_ok=True)  # names may be relative paths
+                if work_queue is not None and record.get('lease') is not None:
+                    # lowres ワーカーが claim した項目の lease を引き継ぎ、完了まで更新して最後に解放する
+                    work_queue.adopt(record['name'], record['lease'])
+                try:
+                    if pipeline_stage == 'lowres' and alpha is None:
+                        # matting はここで一度だけ行い、alpha を入力と一緒に highres ワーカーへ渡す
+                        alpha = run_rmbg(input_fg)[1]
+                    results = relight(input_fg, alpha, record, item_args, checkpoint_prefix)
+                except Exception as e:
+                    manifest.update(record['name'], 'failed', image=record['image'], seed=item_args.seed, error=repr(e))
+                    ITEMS.inc(status='failed')
+                    if work_queue is not None:
+                        work_queue.release(record['name'])
+                    raise
+                if pipeline_stage == 'lowres':
+                    handoff_path = f'{checkpoint_prefix}.input.npz'
+                    save_input_checkpoint(handoff_path, input_fg, alpha)
+                    handoff.put(dict(record, handoff=handoff_path, lease=None if work_queue is None else work_queue.lease(record['name'])))
+                else:
+                    writer.submit(save_results, record, results, item_args, checkpoint_prefix)
+    finally:
+        if pipeline_stage == 'lowres':
+            handoff.close()
+        if work_queue is not None:
+            work_queue.close()
+        sink.close()
+        manifest.close()
+    print(f'peak memory: {memory_report()}')
+
+
+if __name__ == '__main__':
+    main()
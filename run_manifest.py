@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import numpy as np
+import torch
+
+
+class RunManifest:
+    # append-only JSONL log of a batch run: one "run" record with the parameters per invocation,
+    # then one record per item status change. Every record is a single line written with one
+    # write() + fsync, so a crash can at most lose (or truncate) the last line, which is ignored on load.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.items = {}
+        self.params = None
+        truncated = False
+        if os.path.exists(path):
+            truncated = self.load()
+        self.file = open(path, 'a')
+        if truncated:
+            self.file.write('\n')  # do not glue the next record onto a crashed run's partial line
+
+    def load(self):
+        line = '\n'
+        with open(self.path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # partially written last line of a crashed run
+                if 'params' in record:
+                    self.params = record['params']
+                elif 'item' in record:
+                    self.items[record['item']] = record
+        return not line.endswith('\n')
+
+    def append(self, record):
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def start_run(self, params):
+        if self.params is not None and self.params != params:
+            changed = sorted(k for k in set(params) | set(self.params) if params.get(k) != self.params.get(k))
+            print(f"Manifest {self.path} was written with different parameters: {', '.join(changed)}")
+        self.params = params
+        self.append(dict(params=params, time=time.time()))
+
+    def update(self, item, status, **fields):
+        record = dict(item=item, status=status, time=time.time(), **fields)
+        with self.lock:
+            self.items[item] = record
+        self.append(record)
+
+    def is_done(self, item):
+        record = self.items.get(item)
+        if record is None or record['status'] != 'done':
+            return False
+        # outputs are file paths, or "container:member" locations inside tar shards / memmap files
+        return all(os.path.exists(o) or os.path.exists(o.rsplit(':', 1)[0]) for o in record.get('outputs', []))
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def latents_key(*params):
+    # digest of everything the lowres latents depend on (input pixels, seeds, size, prompts, sampler settings)
+    digest = hashlib.sha256()
+    for param in params:
+        if isinstance(param, np.ndarray):
+            digest.update(f'{param.shape}:{param.dtype}'.encode())
+            digest.update(np.ascontiguousarray(param).data)
+        else:
+            digest.update(repr(param).encode())
+    return digest.hexdigest()
+
+
+def save_latents_checkpoint(path, latents, rng, key=None):
+    # the generator state is saved too, so a resumed highres pass draws the same noise as an uninterrupted run
+    temp_path = f'{path}.tmp-{os.getpid()}-{threading.get_ident()}'
+    torch.save(dict(latents=latents.detach().cpu(), rng_state=rng.get_state(), key=key), temp_path)
+    os.replace(temp_path, path)
+
+
+def load_latents_checkpoint(path, rng, device, dtype, key=None):
+    # None when there is no checkpoint, or it was saved with a different key (the parameters of the run changed)
+    try:
+        checkpoint = torch.load(path, map_location='cpu')
+    except FileNotFoundError:
+        return None
+    if checkpoint.get('key') != key:
+        print(f'Ignoring {path}: saved with different inputs or parameters')
+        return None
+    rng.set_state(checkpoint['rng_state'])
+    return checkpoint['latents'].to(device=device, dtype=dtype)
+
+
+def save_input_checkpoint(path, img, alpha):
+    # decoded input and its matting alpha, for the --stage_workers process that finishes the item
+    temp_path = f'{path}.tmp-{os.getpid()}-{threading.get_ident()}'
+    with open(temp_path, 'wb') as file:
+        np.savez(file, img=img, alpha=alpha)
+    os.replace(temp_path, path)
+
+
+def load_input_checkpoint(path):
+    with np.load(path) as data:
+        return data['img'], data['alpha']
@@ -0,0 +1,32 @@
+import tarfile
+import numpy as np
+
+from batch_io import TarSink, MemmapSink, encode_array, read_memmap_index, read_memmap_item
+
+
+def test_tar_member_is_readable_before_the_shard_is_closed(tmp_path):
+    # the manifest marks an item done as soon as write() returns, so its bytes must already be in the shard
+    sink = TarSink(str(tmp_path), shard_size=10)
+    image = np.arange(4 * 4 * 3, dtype=np.uint8).reshape(4, 4, 3)
+    location = sink.write('item', image)
+    path, member = location.rsplit(':', 1)
+    with tarfile.open(path) as tar:
+        assert tar.extractfile(member).read() == encode_array(image)[0]
+    sink.close()
+
+
+def test_memmap_index_survives_a_partial_last_line(tmp_path):
+    sink = MemmapSink(str(tmp_path))
+    first = np.full((2, 2, 3), 7, dtype=np.uint8)
+    sink.write('a', first)
+    sink.close()
+    with open(tmp_path / 'results.index.jsonl', 'a') as file:
+        file.write('{"name": "b", "off')  # killed mid-write
+
+    sink = MemmapSink(str(tmp_path))
+    second = np.full((2, 2, 3), 9, dtype=np.uint8)
+    sink.write('c', second)
+    sink.close()
+    entries = read_memmap_index(str(tmp_path))
+    assert [entry['name'] for entry in entries] == ['a', 'c']
+    np.testing.assert_array_equal(read_memmap_item(str(tmp_path), entries[1]), second)
@@ -0,0 +1,12 @@
+import torch
+
+from briarmbg import BriaRMBG
+
+
+def test_optimize_switches_the_memory_format_both_ways():
+    model = BriaRMBG().optimize(channels_last=True)
+    assert model.channels_last
+    assert model.conv_in.weight.is_contiguous(memory_format=torch.channels_last)
+    model.optimize(channels_last=False)
+    assert not model.channels_last
+    assert all(p.is_contiguous() for p in model.parameters())
@@ -0,0 +1,33 @@
+import threading
+import numpy as np
+import torch
+
+from image_utils import pinned_buffer, _pinned_buffers, preprocess_images, resize_and_center_crop, numpy2pytorch_resized
+
+
+def test_pinned_buffer_keeps_only_the_latest_shape_per_thread():
+    first = pinned_buffer((2, 64, 64, 3), torch.uint8)
+    assert pinned_buffer((2, 64, 64, 3), torch.uint8) is first
+    for size in range(65, 75):
+        pinned_buffer((1, size, size, 3), torch.uint8)
+    assert _pinned_buffers.key == ((1, 74, 74, 3), torch.uint8)
+    assert [k for k in vars(_pinned_buffers)] == ['buffer', 'key']
+
+    other = []
+    thread = threading.Thread(target=lambda: other.append(pinned_buffer((1, 74, 74, 3), torch.uint8)))
+    thread.start()
+    thread.join()
+    assert other[0] is not pinned_buffer((1, 74, 74, 3), torch.uint8)
+
+
+def test_preprocess_images_returns_the_resized_uint8_images():
+    rng = np.random.default_rng(0)
+    imgs = [rng.integers(0, 256, (90, 70, 3), dtype=np.uint8) for _ in range(2)]
+    h, images = preprocess_images(imgs, 64, 64, 'cpu', torch.bfloat16)
+    assert h.dtype == torch.bfloat16
+    for img, image in zip(imgs, images):
+        np.testing.assert_array_equal(image, resize_and_center_crop(img, 64, 64))
+
+    h, images = preprocess_images(imgs, 64, 64, 'cpu', torch.bfloat16, backend='pytorch')
+    exact = numpy2pytorch_resized(imgs, 64, 64, 'cpu')
+    np.testing.assert_array_equal(np.stack(images), ((exact + 1.0) * 127.0).round().clamp(0, 255).to(torch.uint8).movedim(1, -1).numpy())
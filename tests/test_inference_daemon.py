@@ -0,0 +1,41 @@
+import os
+import json
+import socket
+import tempfile
+import threading
+import time
+
+import pytest
+
+from inference_daemon import serve, submit
+
+
+def send_line(socket_path, data):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(socket_path)
+    with conn:
+        conn.sendall(data)
+        return [json.loads(line) for line in conn.makefile('rb')]
+
+
+def test_daemon_survives_bad_requests_and_refuses_a_second_instance(monkeypatch):
+    module_dir = tempfile.mkdtemp()
+    with open(os.path.join(module_dir, 'echo_pipeline.py'), 'w') as file:
+        file.write('def main(argv):\n    print(" ".join(argv))\n')
+    monkeypatch.syspath_prepend(module_dir)
+    socket_path = os.path.join(module_dir, 'daemon.sock')
+    threading.Thread(target=serve, args=(socket_path, 'echo_pipeline'), daemon=True).start()
+    for _ in range(100):
+        if os.path.exists(socket_path):
+            break
+        time.sleep(0.05)
+
+    assert send_line(socket_path, b'not json\n')[-1] == dict(exit=2)
+    assert send_line(socket_path, b'["argv"]\n')[-1] == dict(exit=2)
+    # the job's output comes back as messages (in this process, the daemon thread redirects sys.stdout meanwhile)
+    messages = send_line(socket_path, (json.dumps(dict(argv=['--prompt', 'x'], cwd=os.getcwd())) + '\n').encode())
+    assert messages == [dict(out='--prompt x'), dict(out='\n'), dict(exit=0)]
+
+    with pytest.raises(SystemExit):
+        serve(socket_path, 'echo_pipeline')
+    assert submit(socket_path, []) == 0
@@ -0,0 +1,34 @@
+import os
+import json
+
+from input_manifest import iter_records, build_offset_index, offset_index_path
+
+
+def test_names_are_relative_paths(tmp_path):
+    path = tmp_path / 'manifest.jsonl'
+    path.write_text('\n'.join(json.dumps(dict(image=image)) for image in ['a/1.png', 'b/1.png', '2.png', '/elsewhere/3.png']) + '\n')
+    names = [record['name'] for index, record in iter_records(str(path))]
+    assert names == [os.path.join('a', '1.png'), os.path.join('b', '1.png'), '2.png', os.path.join('elsewhere', '3.png')]
+
+
+def test_csv_seeks_by_byte_offset_past_multibyte_text(tmp_path):
+    path = tmp_path / 'manifest.csv'
+    rows = [f'{i}.png,Left,"日本語のプロンプト {i}"' for i in range(5)]
+    path.write_bytes(('image,light_source,prompt\n' + '\n'.join(rows) + '\n').encode('utf-8'))
+    build_offset_index(str(path))
+    assert not [f for f in os.listdir(tmp_path) if '.tmp-' in f]
+    assert os.path.exists(offset_index_path(str(path)))
+    records = list(iter_records(str(path), start=3))
+    assert [(index, record['name'], record['overrides']['prompt']) for index, record in records] == \
+        [(3, '3.png', '日本語のプロンプト 3'), (4, '4.png', '日本語のプロンプト 4')]
+
+
+def test_csv_quoted_newlines_stay_in_one_record(tmp_path):
+    path = tmp_path / 'manifest.csv'
+    path.write_bytes('\ufeffimage,prompt\r\n0.png,"first line\nsecond line"\r\n\r\n1.png,"a ""quoted"" word"\r\n2.png,"x\n\ny"\r\n3.png,plain\r\n'.encode('utf-8'))
+    records = [(index, record['name'], record['overrides']['prompt']) for index, record in iter_records(str(path))]
+    assert records == [(0, '0.png', 'first line\nsecond line'), (1, '1.png', 'a "quoted" word'), (2, '2.png', 'x\n\ny'), (3, '3.png', 'plain')]
+    assert len(build_offset_index(str(path))) == 4
+    for start in range(4):
+        assert [record for record in records if record[0] >= start] == \
+            [(index, record['name'], record['overrides']['prompt']) for index, record in iter_records(str(path), start=start)]
@@ -0,0 +1,60 @@
+import os
+import numpy as np
+
+from PIL import Image
+from image_utils import split_alpha
+from input_manifest import normalize_record
+from matting import MaskCache, MissingMask, skip_unmasked
+
+
+def load(record):
+    mask = Image.open(record['mask']) if record['mask'] is not None else None
+    return record, split_alpha(Image.open(record['image']), mask)
+
+
+def test_skip_unmasked_keeps_going_past_inputs_without_mask(tmp_path):
+    rgb = np.full((8, 8, 3), 128, dtype=np.uint8)
+    alpha = np.zeros((8, 8), dtype=np.uint8)
+    alpha[2:6, 2:6] = 255
+    Image.fromarray(np.dstack([rgb, alpha])).save(tmp_path / 'rgba.png')
+    Image.fromarray(rgb).save(tmp_path / 'plain.png')
+    Image.fromarray(rgb).save(tmp_path / 'sidecar.png')
+    Image.fromarray(alpha).save(tmp_path / 'sidecar_mask.png')
+    Image.fromarray(np.dstack([rgb, np.full((8, 8), 255, dtype=np.uint8)])).save(tmp_path / 'opaque.png')
+
+    records = [normalize_record(dict(image='plain.png'), str(tmp_path)),
+               normalize_record(dict(image='rgba.png'), str(tmp_path)),
+               normalize_record(dict(image='opaque.png'), str(tmp_path)),
+               normalize_record(dict(image='sidecar.png', mask='sidecar_mask.png'), str(tmp_path))]
+    missing = []
+    kept = list(skip_unmasked((load(record) for record in records), lambda record, error: missing.append((record, error))))
+
+    assert [record['name'] for record, _ in kept] == ['rgba.png', 'sidecar.png']
+    for record, (img, record_alpha) in kept:
+        assert img.shape == (8, 8, 3)
+        np.testing.assert_array_equal(record_alpha[..., 0], alpha / 255.0)
+    assert [record['name'] for record, error in missing] == ['plain.png', 'opaque.png']
+    assert all(isinstance(error, MissingMask) for record, error in missing)
+
+
+def test_mask_cache_budget_is_shared_between_workers(tmp_path):
+    rng = np.random.default_rng(0)
+    imgs = [rng.integers(0, 256, (64, 64, 3), dtype=np.uint8) for _ in range(40)]
+    alphas = [rng.random((64, 64, 1)) for _ in range(40)]
+    probe = MaskCache(str(tmp_path), 'v', 2**30)
+    probe.put(imgs[0], alphas[0])
+    budget = probe.total_bytes * 10
+    os.remove(probe.path(imgs[0]))
+
+    workers = [MaskCache(str(tmp_path), 'v', budget) for _ in range(4)]
+    for i, (img, alpha) in enumerate(zip(imgs, alphas)):
+        workers[i % 4].put(img, alpha)
+    assert sum(size for mtime, size, path in workers[0].entries()) <= budget
+
+
+def test_mask_cache_key_includes_the_engine(tmp_path):
+    img = np.zeros((8, 8, 3), dtype=np.uint8)
+    torch_cache = MaskCache(str(tmp_path), 'rmbg:torch:float32:contiguous:pil', 2**30)
+    onnx_cache = MaskCache(str(tmp_path), 'rmbg:onnx:pil', 2**30)
+    torch_cache.put(img, np.ones((8, 8, 1)))
+    assert onnx_cache.get(img) is None
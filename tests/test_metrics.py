@@ -0,0 +1,26 @@
+import socket
+import urllib.request
+
+from metrics import serve_metrics, start_file_exporter, render, QUEUE_DEPTH, _exporters
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_exporters_start_once_per_process(tmp_path):
+    port = free_port()
+    server = serve_metrics(port)
+    assert serve_metrics(port) is server  # a second job in the same process must not fail with "address in use"
+    assert server.server_address[0] == '127.0.0.1'
+    QUEUE_DEPTH.set(3, queue='batch')
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+        assert 'iclight_queue_depth{queue="batch"} 3' in response.read().decode()
+
+    path = str(tmp_path / 'metrics.prom')
+    start_file_exporter(path)
+    start_file_exporter(path)
+    assert sum(1 for key in _exporters if key[:2] == ('file', path)) == 1
+    assert '# EOF' in render()
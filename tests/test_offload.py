@@ -0,0 +1,17 @@
+import torch
+
+from offload import ModelResidency
+
+
+def test_removed_model_is_dropped_and_the_next_one_used(tmp_path):
+    residency = ModelResidency('cpu')
+    old = residency.add(torch.nn.Linear(4, 4), str(tmp_path / 'old.pt'), key='old')
+    new = torch.nn.Linear(4, 4, dtype=torch.float64)
+    with residency.use(old):
+        assert old.weight.device.type == 'cpu'
+    residency.remove(old)
+    assert residency.active is None
+    assert id(old) not in residency.paths
+    residency.add(new, str(tmp_path / 'new.pt'), key='new')
+    with residency.use(new):
+        assert new.weight.dtype == torch.float64 and new.weight.device.type == 'cpu'
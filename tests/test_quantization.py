@@ -0,0 +1,25 @@
+import torch
+import torch.nn as nn
+import torch.ao.nn.quantized.dynamic as nnqd
+
+from quantization import quantize_int8
+
+
+def model():
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Linear(8, 8), nn.ReLU(), nn.Linear(8, 4))
+
+
+def test_cache_is_reused_and_a_cache_without_a_module_is_a_miss(tmp_path):
+    path = str(tmp_path / 'model.int8.pt')
+    x = torch.randn(2, 8)
+    first = model()
+    assert not quantize_int8(dict(unet=first), path, 'key')
+    again = model()
+    assert quantize_int8(dict(unet=again), path, 'key')
+    assert torch.equal(first(x), again(x))
+
+    modules = dict(unet=model(), text_encoder=model())
+    assert not quantize_int8(modules, path, 'key')
+    assert all(isinstance(m[0], nnqd.Linear) and isinstance(m[2], nnqd.Linear) for m in modules.values())
+    assert quantize_int8(dict(unet=model(), text_encoder=model()), path, 'key')
@@ -0,0 +1,17 @@
+import os
+import glob
+
+import torch
+
+from briarmbg import BriaRMBG
+from rmbg_onnx import export
+
+
+def test_export_leaves_the_callers_model_alone_and_writes_atomically(tmp_path):
+    model = BriaRMBG().eval().half()
+    path = str(tmp_path / 'briarmbg.onnx')
+    export(model, path)
+    assert os.path.getsize(path) > 0
+    assert glob.glob(f'{path}.tmp-*') == []
+    assert not isinstance(model.stage1.rebnconvin.bn_s1, torch.nn.Identity)
+    assert model.conv_in.weight.dtype == torch.float16
@@ -0,0 +1,24 @@
+import numpy as np
+import torch
+
+from run_manifest import latents_key, save_latents_checkpoint, load_latents_checkpoint
+
+
+def test_latents_checkpoint_is_ignored_when_the_parameters_change(tmp_path):
+    path = str(tmp_path / 'item.png.none.pt')
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    key = latents_key(image, [12345], 512, 640, 25, 2.0, ['prompt'])
+    rng = torch.Generator().manual_seed(12345)
+    save_latents_checkpoint(path, torch.ones(1, 4, 8, 8), rng, key=key)
+
+    resumed = torch.Generator().manual_seed(0)
+    latents = load_latents_checkpoint(path, resumed, device='cpu', dtype=torch.float32, key=key)
+    assert torch.equal(latents, torch.ones(1, 4, 8, 8))
+    assert torch.equal(resumed.get_state(), rng.get_state())
+
+    for changed in [latents_key(image, [54321], 512, 640, 25, 2.0, ['prompt']),
+                    latents_key(image, [12345], 512, 768, 25, 2.0, ['prompt']),
+                    latents_key(image, [12345], 512, 640, 25, 2.0, ['another prompt']),
+                    latents_key(image + 1, [12345], 512, 640, 25, 2.0, ['prompt'])]:
+        assert load_latents_checkpoint(path, torch.Generator(), device='cpu', dtype=torch.float32, key=changed) is None
+    assert load_latents_checkpoint(str(tmp_path / 'missing.pt'), torch.Generator(), device='cpu', dtype=torch.float32, key=key) is None
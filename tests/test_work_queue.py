@@ -0,0 +1,68 @@
+import os
+import time
+
+from work_queue import LockFileQueue
+
+
+def test_lease_is_renewed_while_the_item_is_processed(tmp_path):
+    slow = LockFileQueue(str(tmp_path), worker_id='slow', lease_timeout=0.4)
+    other = LockFileQueue(str(tmp_path), worker_id='other', lease_timeout=0.4)
+    try:
+        assert slow.try_claim('a.png')
+        time.sleep(1.0)
+        assert not other.try_claim('a.png')
+        slow.mark_done('a.png')
+        assert slow.is_done('a.png')
+        assert not os.path.exists(slow.path('a.png', '.lock'))
+    finally:
+        slow.close()
+        other.close()
+
+
+def test_release_after_takeover_keeps_the_new_owners_lock(tmp_path):
+    slow = LockFileQueue(str(tmp_path), worker_id='slow', lease_timeout=0.2)
+    other = LockFileQueue(str(tmp_path), worker_id='other', lease_timeout=0.2)
+    try:
+        assert slow.try_claim('a.png')
+        slow.close()  # stops renewing, like a worker stuck past its lease
+        time.sleep(0.3)
+        assert other.try_claim('a.png')
+        slow.release('a.png')
+        assert other.owner('a.png') == other.lease('a.png')
+        other.release('a.png')
+        assert not os.path.exists(other.path('a.png', '.lock'))
+    finally:
+        other.close()
+
+
+def test_second_taker_of_an_expired_lease_backs_off(tmp_path):
+    slow = LockFileQueue(str(tmp_path), worker_id='slow', lease_timeout=0.2)
+    first = LockFileQueue(str(tmp_path), worker_id='first', lease_timeout=0.2)
+    second = LockFileQueue(str(tmp_path), worker_id='second', lease_timeout=0.2)
+    try:
+        assert slow.try_claim('a.png')
+        slow.close()
+        time.sleep(0.3)
+        expired = second.lock_state('a.png')  # both takers see the expired lease ...
+        assert first.try_claim('a.png')  # ... and the first one takes it over
+        second.lock_state = lambda name: expired
+        assert not second.try_claim('a.png')
+        assert first.owner('a.png') == first.lease('a.png')
+        assert second.lease('a.png') is None
+        assert [f for f in os.listdir(tmp_path) if 'expired' in f] == []
+    finally:
+        first.close()
+        second.close()
+
+
+def test_adopted_lease_is_released_by_the_adopting_worker(tmp_path):
+    lowres = LockFileQueue(str(tmp_path), worker_id='lowres')
+    highres = LockFileQueue(str(tmp_path), worker_id='highres')
+    try:
+        assert lowres.try_claim('a.png')
+        highres.adopt('a.png', lowres.lease('a.png'))
+        highres.mark_done('a.png')
+        assert not os.path.exists(lowres.path('a.png', '.lock'))
+    finally:
+        lowres.close()
+        highres.close()
@@ -0,0 +1,46 @@
+import os
+import signal
+
+import pytest
+
+from worker_pool import StageHandoff
+
+
+def test_handoff_passes_items_to_consumers():
+    handoff = StageHandoff(1, 1, poll_interval=0.1)
+    pid = os.fork()
+    if pid == 0:
+        handoff.register_consumer(0)
+        os._exit(0 if [item['name'] for item in handoff] == ['a', 'b', 'c'] else 1)
+    for name in 'abc':
+        handoff.put(dict(name=name))
+    handoff.close()
+    assert os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]) == 0
+
+
+def test_put_fails_once_every_consumer_has_exited():
+    handoff = StageHandoff(1, 1, capacity=1, poll_interval=0.1)
+    pid = os.fork()
+    if pid == 0:
+        handoff.register_consumer(0)
+        os._exit(1)  # a highres worker that died
+    os.waitpid(pid, 0)
+    handoff.put(dict(name='a'))
+    with pytest.raises(RuntimeError):
+        handoff.put(dict(name='b'))
+
+
+def test_consumer_fails_once_a_producer_dies_without_closing():
+    handoff = StageHandoff(2, 1, poll_interval=0.1)
+    pid = os.fork()
+    if pid == 0:
+        handoff.register_producer(0)
+        handoff.put(dict(name='a'))
+        os.kill(os.getpid(), signal.SIGKILL)  # a lowres worker killed by the OOM killer
+    os.waitpid(pid, 0)
+    handoff.register_producer(1)
+    handoff.close()
+    items = iter(handoff)
+    assert next(items)['name'] == 'a'
+    with pytest.raises(RuntimeError):
+        next(items)
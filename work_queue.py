@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import uuid
+import socket
+import argparse
+import threading
+import multiprocessing
+
+
+def parse_shard(text):
+    # "i/n" -> (i, n), 0-based
+    index, count = (int(x) for x in text.split('/'))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'shard index must be in [0, {count}), got {text}')
+    return index, count
+
+
+def static_shard(records, shard_index, shard_count):
+    # records are (index, record) pairs; every n-th one belongs to shard i
+    for index, record in records:
+        if index % shard_count == shard_index:
+            yield index, record
+
+
+def default_worker_id():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def read_token(lock_path):
+    try:
+        with open(lock_path) as file:
+            return json.load(file).get('token')
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class LockFileQueue:
+    # dynamic work distribution over a shared directory. A worker owns an item while <name>.lock exists and holds
+    # its token; locks are created with O_EXCL (atomic on local and NFS filesystems) and an item is finished once
+    # <name>.done exists. While an item is processed, a heartbeat thread renews the lease by touching the lock
+    # every lease_timeout / 4 seconds. A lock older than lease_timeout belongs to a crashed worker and is taken
+    # over by the next worker that asks; the old owner then no longer matches the token and leaves it alone.
+    # Outputs are written atomically and are the same whichever worker produces them, so an item occasionally
+    # processed twice after a takeover is harmless.
+    def __init__(self, queue_dir, worker_id=None, lease_timeout=900.0, poll_interval=10.0):
+        self.queue_dir = queue_dir
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+        self.leases = {}  # name -> token of the locks this worker holds
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat = None
+        os.makedirs(queue_dir, exist_ok=True)
+
+    def path(self, name, suffix):
+        # one flat directory: names that are relative paths get their separators escaped (a/1.png -> a%2F1.png)
+        return os.path.join(self.queue_dir, name.replace('%', '%25').replace(os.sep, '%2F') + suffix)
+
+    def is_done(self, name):
+        return os.path.exists(self.path(name, '.done'))
+
+    def try_claim(self, name):
+        return self.create_lock(name) or self.take_over_expired(name)
+
+    def create_lock(self, name, **fields):
+        try:
+            fd = os.open(self.path(name, '.lock'), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        token = uuid.uuid4().hex
+        with os.fdopen(fd, 'w') as file:
+            json.dump(dict(worker=self.worker_id, time=time.time(), token=token, **fields), file)
+        self.adopt(name, token)
+        return True
+
+    def take_over_expired(self, name):
+        lock_path = self.path(name, '.lock')
+        mtime, expired_token = self.lock_state(name)
+        if mtime is None or time.time() - mtime < self.lease_timeout:
+            return False
+        # rename is atomic, but two workers may both have seen the lease expired: the second one's rename then
+        # moves away the fresh lock the first has just created. The moved lock's token tells which one it got.
+        expired_path = f'{lock_path}.expired-{self.worker_id}'
+        try:
+            os.rename(lock_path, expired_path)
+        except FileNotFoundError:
+            return False
+        if read_token(expired_path) != expired_token:
+            try:
+                os.link(expired_path, lock_path)  # put the other taker's lock back, unless a new one exists already
+            except FileExistsError:
+                pass
+            os.remove(expired_path)
+            return False
+        os.remove(expired_path)
+        if not self.create_lock(name, took_over=True):
+            return False
+        if self.owner(name) != self.lease(name):
+            # a racing taker replaced the new lock after all: it is theirs now
+            with self.lock:
+                self.leases.pop(name, None)
+            return False
+        print(f'{self.worker_id} took over expired item {name}')
+        return True
+
+    def lock_state(self, name):
+        # (mtime, token) of the item's lock, read from one open file so both belong to the same lock
+        try:
+            with open(self.path(name, '.lock')) as file:
+                mtime = os.fstat(file.fileno()).st_mtime
+                return mtime, json.load(file).get('token')
+        except FileNotFoundError:
+            return None, None
+        except ValueError:
+            return mtime, None  # being written by create_lock()
+
+    def owner(self, name):
+        # token in the item's lock, or None without a (readable) lock
+        return read_token(self.path(name, '.lock'))
+
+    def lease(self, name):
+        # token of an item this worker holds, for handing the item to another process that adopt()s it
+        with self.lock:
+            return self.leases.get(name)
+
+    def adopt(self, name, token):
+        # renews (and may release) the lease with token from now on, e.g. in the --stage_workers process
+        # that finishes an item another worker claimed
+        with self.lock:
+            self.leases[name] = token
+            if self.heartbeat is None:
+                self.heartbeat = threading.Thread(target=self.renew_leases, name='lease-heartbeat', daemon=True)
+                self.heartbeat.start()
+
+    def renew_leases(self):
+        while not self.stopped.wait(self.lease_timeout / 4):
+            with self.lock:
+                leases = dict(self.leases)
+            for name, token in leases.items():
+                if self.owner(name) == token:
+                    try:
+                        os.utime(self.path(name, '.lock'))
+                        continue
+                    except FileNotFoundError:
+                        pass
+                with self.lock:
+                    if self.leases.get(name) == token:
+                        del self.leases[name]
+                if not self.is_done(name):
+                    print(f'{self.worker_id} lost the lease of {name}')
+
+    def mark_done(self, name):
+        with open(self.path(name, '.done'), 'w') as file:
+            json.dump(dict(worker=self.worker_id, time=time.time()), file)
+        self.release(name)
+
+    def release(self, name):
+        # removes the lock only while it is still this worker's: after a takeover it belongs to the new owner
+        with self.lock:
+            token = self.leases.pop(name, None)
+        if token is None or self.owner(name) != token:
+            return
+        try:
+            os.remove(self.path(name, '.lock'))
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        self.stopped.set()
+
+    def claim(self, records, key=lambda record: record['name']):
+        # yields the records this worker claimed. Items held by other workers are polled until they are
+        # done or their lease expires, so the queue drains even if a worker dies near the end.
+        pending = []
+        for record in records:
+            name = key(record)
+            if self.is_done(name):
+                continue
+            if self.try_claim(name):
+                yield record
+            else:
+                pending.append(record)
+        while pending:
+            time.sleep(self.poll_interval)
+            still_pending = []
+            for record in pending:
+                name = key(record)
+                if self.is_done(name):
+                    continue
+                if self.try_claim(name):
+                    yield record
+                else:
+                    still_pending.append(record)
+            pending = still_pending
+
+
+def simulated_worker(queue_dir, worker_index, num_items, work_time, lease_timeout, crash_after):
+    queue = LockFileQueue(queue_dir, worker_id=f'worker{worker_index}', lease_timeout=lease_timeout, poll_interval=0.05)
+    records = ({'name': f'item{i:06d}'} for i in range(num_items))
+    for count, record in enumerate(queue.claim(records)):
+        if count == crash_after:
+            os._exit(1)  # die holding a lease, like a killed worker
+        time.sleep(work_time)
+        with open(os.path.join(queue_dir, record['name'] + '.out'), 'a') as file:
+            file.write(queue.worker_id + '\n')
+        queue.mark_done(record['name'])
+
+
+parser = argparse.ArgumentParser(description="Local simulation of the lock-file work queue with several CPU worker processes")
+parser.add_argument('--queue_dir', type=str, required=True, help="Empty directory for the simulated queue")
+parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help="Worker counts to measure")
+parser.add_argument('--items', type=int, default=200, help="Items per run")
+parser.add_argument('--work_time', type=float, default=0.05, help="Simulated seconds per item")
+parser.add_argument('--lease_timeout', type=float, default=1.0, help="Lease timeout in seconds")
+parser.add_argument('--crash', action='store_true', help="Let worker 0 die after its first claim to exercise lease takeover")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    baseline = None
+    for num_workers in args.workers:
+        run_dir = os.path.join(args.queue_dir, f'workers{num_workers}')
+        t0 = time.perf_counter()
+        processes = [multiprocessing.Process(target=simulated_worker, args=(run_dir, i, args.items, args.work_time, args.lease_timeout,
+                                                                           1 if args.crash and i == 0 else -1))
+                     for i in range(num_workers)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        elapsed = time.perf_counter() - t0
+        outputs = [f for f in os.listdir(run_dir) if f.endswith('.out')]
+        duplicates = sum(len(open(os.path.join(run_dir, f)).readlines()) - 1 for f in outputs)
+        throughput = args.items / elapsed
+        baseline = baseline or throughput / num_workers
+        print(f'{num_workers} workers: {len(outputs)}/{args.items} items in {elapsed:.2f}s, {throughput:.1f} items/s '
+              f'({throughput / (baseline * num_workers):.0%} of linear), {duplicates} duplicates')
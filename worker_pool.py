@@ -0,0 +1,149 @@
+import os
+import sys
+import multiprocessing
+import torch
+
+
+def share_weights(*modules):
+    # move parameters and buffers into shared memory once, so forked workers map the same pages
+    # instead of each touching (and copying on write) its own copy
+    for module in modules:
+        module.share_memory()
+
+
+def core_groups(num_workers, cores=None):
+    # split the cores this process may run on into num_workers contiguous, non-overlapping groups
+    # (contiguous core ids usually share a socket); workers share cores only if there are too few
+    cores = sorted(cores or os.sched_getaffinity(0))
+    groups = []
+    for i in range(num_workers):
+        group = cores[i * len(cores) // num_workers:(i + 1) * len(cores) // num_workers]
+        groups.append(group or [cores[i % len(cores)]])
+    return groups
+
+
+def fork_workers(num_workers, threads_per_worker=None):
+    # forks num_workers children from a process that has already loaded the models. In each child this
+    # returns the worker index, with the child pinned to its core group and torch limited to that many
+    # intra-op threads. The parent never returns: it waits for all children and exits, with status 1
+    # if any of them failed.
+    pids = {}
+    for index, cores in enumerate(core_groups(num_workers)):
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            os.sched_setaffinity(0, cores)
+            torch.set_num_threads(threads_per_worker or len(cores))
+            return index
+        pids[pid] = index
+        print(f'cpu worker {index} (pid {pid}) on cores {cores[0]}-{cores[-1]}')
+
+    failed = []
+    while pids:
+        pid, status = os.wait()
+        index = pids.pop(pid)
+        if os.waitstatus_to_exitcode(status) != 0:
+            failed.append(index)
+    if failed:
+        print(f'cpu workers {failed} failed')
+    raise SystemExit(1 if failed else 0)
+
+
+def is_alive(pid):
+    # the parent in fork_workers() reaps its children right away, so an exited worker's pid is gone
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+
+
+class TicketCounter:
+    # process-shared counter; create it before fork_workers()
+    def __init__(self):
+        self.value = multiprocessing.get_context('fork').Value('q', 0)
+
+    def take(self):
+        with self.value.get_lock():
+            ticket = self.value.value
+            self.value.value += 1
+        return ticket
+
+
+def claim_in_order(items, counter):
+    # every worker walks the same item sequence and processes the positions it draws from the shared
+    # counter, so a worker that finishes early simply draws more tickets (dynamic balancing without
+    # a separate dispatcher process)
+    ticket = counter.take()
+    for position, item in enumerate(items):
+        if position == ticket:
+            yield item
+            ticket = counter.take()
+
+
+class StageHandoff:
+    # process-shared queue between pipeline stages; create it before fork_workers(). Producers and consumers
+    # register right after the fork; producers put() items and close() once when they are done, consumers
+    # iterate until every producer has closed. Items should be small (names and paths, not arrays): at most
+    # capacity of them wait in the pipe, so a put() never blocks on a full pipe. Neither side hangs on a dead
+    # peer: a producer waiting for a free slot fails once every registered consumer has exited, and a consumer
+    # waiting for an item fails once a registered producer has exited without closing (killed, out of memory).
+    # SimpleQueue writes to the pipe synchronously; a Queue's feeder thread could lose the last items
+    # when a worker leaves with os._exit() (as under inference_daemon.py)
+    def __init__(self, num_producers, num_consumers, capacity=None, poll_interval=5.0):
+        context = multiprocessing.get_context('fork')
+        self.num_producers = num_producers
+        self.poll_interval = poll_interval
+        self.queue = context.SimpleQueue()
+        self.closed = context.Value('i', 0)
+        self.slots = context.BoundedSemaphore(capacity or 4 * num_consumers)
+        self.items = context.Semaphore(0)  # items (and end markers) in the queue not yet taken by a consumer
+        self.producers = context.Array('q', num_producers)  # pids, 0 until registered, -1 once closed
+        self.consumers = context.Array('q', num_consumers)  # pids, 0 until registered
+        self.producer_index = None
+
+    def register_producer(self, index):
+        self.producers[index] = os.getpid()
+        self.producer_index = index
+
+    def register_consumer(self, index):
+        self.consumers[index] = os.getpid()
+
+    def consumers_alive(self):
+        # a consumer that has not registered yet counts as alive
+        return any(pid == 0 or is_alive(pid) for pid in self.consumers[:])
+
+    def producer_lost(self):
+        # a registered producer that exited without close(): the end of the stream will never come
+        return any(pid > 0 and not is_alive(pid) for pid in self.producers[:])
+
+    def put(self, item):
+        while not self.slots.acquire(timeout=self.poll_interval):
+            if not self.consumers_alive():
+                raise RuntimeError('every consumer of the stage handoff has exited')
+        self.queue.put(item)
+        self.items.release()
+
+    def close(self):
+        if self.producer_index is not None:
+            self.producers[self.producer_index] = -1
+        self.queue.put(None)
+        self.items.release()
+
+    def __iter__(self):
+        while True:
+            while not self.items.acquire(timeout=self.poll_interval):
+                if self.producer_lost():
+                    raise RuntimeError('a producer of the stage handoff exited without closing it')
+            item = self.queue.get()
+            if item is not None:
+                self.slots.release()
+                yield item
+                continue
+            with self.closed.get_lock():
+                self.closed.value += 1
+                finished = self.closed.value >= self.num_producers
+            if finished:
+                self.queue.put(None)  # pass the end on to the other consumers
+                self.items.release()
+                return